@@ -0,0 +1,498 @@
+"""Benchmarks of the listing, scan and transfer engine against a local SFTP server
+
+    python sftp_bench.py --latency 20 --bandwidth 100 --output bench.json
+    python sftp_bench.py --compare bench.json
+
+A paramiko SFTPServer serves generated test data on loopback. An optional
+link emulator between client and server adds one-way latency and limits
+bandwidth in both directions. Results are written as JSON; every result is
+identified by its name and parameters, so two runs can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import paramiko
+
+from sftp_listing import TreeScanner, stream_listing
+from sftp_pool import ConnectionPool
+from sftp_transfer import DEFAULT_SEGMENTS, DEFAULT_WORKERS, ParallelDownloader, TransferTask
+
+RESULT_FORMAT_VERSION = 1
+
+DEFAULT_LISTING_SIZES = (10, 1000, 10000, 200000)
+DEFAULT_SMALL_FILES = 2000
+DEFAULT_SMALL_FILE_SIZE = 4096
+DEFAULT_LARGE_FILE_MB = 128
+DEFAULT_TREE_DEPTH = 5
+DEFAULT_TREE_FANOUT = 4
+DEFAULT_REPEAT = 3
+
+BENCHMARKS = ("listing", "small_files", "large_file", "tree_scan")
+
+# Fixtures live in this subdirectory of --data-dir, the only part of it the suite ever deletes
+FIXTURE_DIR = "sftp_bench_fixtures"
+# Marks a fixture directory whose fixtures were generated completely
+FIXTURE_MARKER = ".bench_fixtures.json"
+
+
+class _BenchServer(paramiko.ServerInterface):
+    """Accepts any password; the server only listens on loopback"""
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class _BenchHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _BenchSFTP(paramiko.SFTPServerInterface):
+    """Read-only view of the fixture directory"""
+    root = None
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def list_folder(self, path):
+        local = self._local(path)
+        try:
+            items = []
+            with os.scandir(local) as entries:
+                for entry in entries:
+                    attr = paramiko.SFTPAttributes.from_stat(entry.stat(follow_symlinks=False))
+                    attr.filename = entry.name
+                    items.append(attr)
+            return items
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            readfile = open(self._local(path), "rb")
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _BenchHandle(flags)
+        handle.filename = path
+        handle.readfile = readfile
+        return handle
+
+
+class BenchServer:
+    """paramiko SFTP server on a loopback port, serving root read-only"""
+
+    def __init__(self, root):
+        self.root = root
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._socket = None
+        self._transports = []
+
+    def start(self):
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen(64)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self._socket.getsockname()[1]
+
+    def _accept_loop(self):
+        sftp_class = type("BoundBenchSFTP", (_BenchSFTP,), {'root': self.root})
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, sftp_class)
+            transport.start_server(server=_BenchServer())
+            self._transports.append(transport)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+
+class LinkEmulator:
+    """TCP relay on loopback that adds one-way latency and a bandwidth limit per direction
+
+    Bytes are delivered once they have been "serialized" at bandwidth bytes
+    per second and then spent latency seconds in flight, like a real link.
+    """
+
+    def __init__(self, target_port, latency=0.0, bandwidth=0):
+        self.target_port = target_port
+        self.latency = latency
+        # Bytes per second, 0 for unlimited
+        self.bandwidth = bandwidth
+        self._socket = None
+        self._connections = []
+
+    def start(self):
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", 0))
+        self._socket.listen(64)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self._socket.getsockname()[1]
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connections.extend((client, upstream))
+            self._relay(client, upstream)
+            self._relay(upstream, client)
+
+    def _relay(self, source, destination):
+        pending = deque()
+        cond = threading.Condition()
+
+        def reader():
+            link_free = 0.0
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b""
+                now = time.monotonic()
+                if data and self.bandwidth:
+                    link_free = max(now, link_free) + len(data) / self.bandwidth
+                    due = link_free + self.latency
+                else:
+                    due = now + self.latency
+                with cond:
+                    pending.append((due, data))
+                    cond.notify()
+                if not data:
+                    return
+
+        def writer():
+            while True:
+                with cond:
+                    while not pending:
+                        cond.wait()
+                    due, data = pending.popleft()
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    if not data:
+                        destination.shutdown(socket.SHUT_WR)
+                        return
+                    destination.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=reader, daemon=True).start()
+        threading.Thread(target=writer, daemon=True).start()
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+        for sock in self._connections:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+def create_fixtures(root, args):
+    """Generate the test data below root unless a complete set with the same parameters is there
+
+    root is emptied first otherwise, so it must be a directory the suite owns.
+    """
+    params = {
+        'listing_sizes': args.listing_sizes,
+        'small_files': args.small_files,
+        'small_file_size': args.small_file_size,
+        'large_file_mb': args.large_file_mb,
+        'tree_depth': args.tree_depth,
+        'tree_fanout': args.tree_fanout
+    }
+    marker = os.path.join(root, FIXTURE_MARKER)
+    try:
+        with open(marker) as f:
+            if json.load(f) == params:
+                return
+    except (OSError, ValueError):
+        pass
+    for name in os.listdir(root) if os.path.isdir(root) else []:
+        path = os.path.join(root, name)
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    os.makedirs(root, exist_ok=True)
+
+    for size in args.listing_sizes:
+        directory = os.path.join(root, "listing", str(size))
+        os.makedirs(directory)
+        for index in range(size):
+            open(os.path.join(directory, f"entry{index:07d}"), "wb").close()
+
+    directory = os.path.join(root, "small")
+    os.makedirs(directory)
+    payload = os.urandom(args.small_file_size)
+    for index in range(args.small_files):
+        with open(os.path.join(directory, f"file{index:06d}"), "wb") as f:
+            f.write(payload)
+
+    with open(os.path.join(root, "large.bin"), "wb") as f:
+        chunk = os.urandom(1024 * 1024)
+        for _ in range(args.large_file_mb):
+            f.write(chunk)
+
+    def build_tree(path, depth):
+        os.makedirs(path)
+        open(os.path.join(path, "file"), "wb").close()
+        if depth > 0:
+            for index in range(args.tree_fanout):
+                build_tree(os.path.join(path, f"d{index}"), depth - 1)
+
+    build_tree(os.path.join(root, "tree"), args.tree_depth)
+
+    with open(marker, "w") as f:
+        json.dump(params, f)
+
+
+def _timed_runs(repeat, run):
+    """Call run() repeat times; it returns (seconds, extra metrics) for one run"""
+    runs = []
+    metrics = {}
+    for _ in range(repeat):
+        seconds, metrics = run()
+        runs.append(seconds)
+    return {'seconds': statistics.median(runs), 'min_seconds': min(runs), 'runs': runs, **metrics}
+
+
+def bench_listing(connection, size, repeat):
+    def run():
+        sftp = connection.open_channel()
+        first_batch = []
+        start = time.perf_counter()
+
+        def on_batch(batch):
+            if not first_batch:
+                first_batch.append(time.perf_counter() - start)
+
+        items = stream_listing(sftp, f"/listing/{size}", on_batch)
+        seconds = time.perf_counter() - start
+        sftp.close()
+        assert len(items) == size, f"listed {len(items)} of {size} entries"
+        return seconds, {'first_batch_seconds': first_batch[0] if first_batch else seconds,
+                         'entries_per_second': size / seconds if seconds else None}
+
+    return _timed_runs(repeat, run)
+
+
+def bench_download(connection, tasks_for, workers, segments, repeat):
+    def run():
+        destination = tempfile.mkdtemp(prefix="sftp_bench_dst_")
+        try:
+            tasks = tasks_for(destination)
+            total = sum(task.size for task in tasks)
+            downloader = ParallelDownloader(connection.open_channel, workers=workers, segments=segments)
+            start = time.perf_counter()
+            failed = downloader.run(tasks)
+            seconds = time.perf_counter() - start
+        finally:
+            shutil.rmtree(destination, ignore_errors=True)
+        assert not failed, f"{len(failed)} downloads failed: {failed[0].error}"
+        return seconds, {'files_per_second': len(tasks) / seconds if seconds else None,
+                         'bytes_per_second': total / seconds if seconds else None}
+
+    return _timed_runs(repeat, run)
+
+
+def bench_tree_scan(connection, workers, repeat):
+    def run():
+        start = time.perf_counter()
+        tree = TreeScanner(connection.open_channel, workers=workers).scan("/tree")
+        seconds = time.perf_counter() - start
+        directories = len(tree.directories) + 1
+        return seconds, {'directories': directories, 'files': tree.total_files,
+                         'directories_per_second': directories / seconds if seconds else None}
+
+    return _timed_runs(repeat, run)
+
+
+def run_benchmarks(args, connection, log):
+    results = []
+
+    def record(name, params, measurement):
+        result = {'name': name, 'params': params, **measurement}
+        results.append(result)
+        log(f"{name} {json.dumps(params)}: {measurement['seconds']:.3f}s")
+
+    selected = set(args.only)
+    if "listing" in selected:
+        for size in args.listing_sizes:
+            record("listing", {'entries': size}, bench_listing(connection, size, args.repeat))
+
+    if "small_files" in selected:
+        def small_tasks(destination):
+            return [TransferTask(f"/small/file{index:06d}", os.path.join(destination, f"file{index:06d}"),
+                                 args.small_file_size) for index in range(args.small_files)]
+        params = {'files': args.small_files, 'file_size': args.small_file_size, 'workers': args.workers}
+        record("small_files", params, bench_download(connection, small_tasks, args.workers, 1, args.repeat))
+
+    if "large_file" in selected:
+        def large_tasks(destination):
+            return [TransferTask("/large.bin", os.path.join(destination, "large.bin"), args.large_file_mb * 1024 * 1024)]
+        params = {'size_mb': args.large_file_mb, 'segments': args.segments}
+        record("large_file", params, bench_download(connection, large_tasks, args.workers, args.segments, args.repeat))
+
+    if "tree_scan" in selected:
+        params = {'depth': args.tree_depth, 'fanout': args.tree_fanout, 'workers': args.scan_workers}
+        record("tree_scan", params, bench_tree_scan(connection, args.scan_workers, args.repeat))
+
+    return results
+
+
+def compare(baseline, current):
+    """Print the change of each result's median time against a baseline run"""
+    def key(result):
+        return result['name'], json.dumps(result['params'], sort_keys=True)
+
+    previous = {key(result): result for result in baseline.get('results', [])}
+    lines = []
+    if baseline.get('link') != current['link']:
+        lines.append(f"Warning: link settings differ from the baseline ({baseline.get('link')} vs {current['link']})")
+    for result in current['results']:
+        old = previous.get(key(result))
+        if old is None:
+            lines.append(f"{result['name']} {json.dumps(result['params'])}: new")
+            continue
+        change = (result['seconds'] - old['seconds']) / old['seconds'] * 100 if old['seconds'] else 0.0
+        lines.append(f"{result['name']} {json.dumps(result['params'])}: "
+                     f"{old['seconds']:.3f}s -> {result['seconds']:.3f}s ({change:+.1f}%)")
+    return lines
+
+
+def parse_sizes(text):
+    return [int(size) for size in text.split(",") if size.strip()]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the SFTP browser engine against a local server")
+    parser.add_argument("--latency", type=float, default=0.0, metavar="MS", help="One-way latency to inject")
+    parser.add_argument("--bandwidth", type=float, default=0.0, metavar="MBIT",
+                        help="Link bandwidth per direction in Mbit/s (0 for unlimited)")
+    parser.add_argument("--only", type=lambda text: text.split(","), default=list(BENCHMARKS),
+                        help=f"Comma separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--listing-sizes", type=parse_sizes, default=list(DEFAULT_LISTING_SIZES),
+                        help="Comma separated directory sizes to list")
+    parser.add_argument("--small-files", type=int, default=DEFAULT_SMALL_FILES)
+    parser.add_argument("--small-file-size", type=int, default=DEFAULT_SMALL_FILE_SIZE, metavar="BYTES")
+    parser.add_argument("--large-file-mb", type=int, default=DEFAULT_LARGE_FILE_MB)
+    parser.add_argument("--tree-depth", type=int, default=DEFAULT_TREE_DEPTH)
+    parser.add_argument("--tree-fanout", type=int, default=DEFAULT_TREE_FANOUT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS)
+    parser.add_argument("--scan-workers", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--data-dir",
+                        help=f"Keep generated fixtures in {FIXTURE_DIR} below this directory and reuse them")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="Print the change against an earlier JSON result")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    unknown = set(args.only) - set(BENCHMARKS)
+    if unknown:
+        print(f"Unknown benchmarks: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    def log(message):
+        print(message, file=sys.stderr, flush=True)
+
+    if args.data_dir:
+        data_dir = os.path.join(args.data_dir, FIXTURE_DIR)
+    else:
+        data_dir = tempfile.mkdtemp(prefix="sftp_bench_data_")
+    server = link = pool = None
+    try:
+        log(f"Preparing fixtures in {data_dir}...")
+        create_fixtures(data_dir, args)
+
+        server = BenchServer(data_dir)
+        port = server.start()
+        if args.latency or args.bandwidth:
+            link = LinkEmulator(port, args.latency / 1000.0, args.bandwidth * 1000 * 1000 / 8)
+            port = link.start()
+
+        pool = ConnectionPool()
+        connection = pool.get("127.0.0.1", port, "bench", "bench")
+        started = time.time()
+        results = run_benchmarks(args, connection, log)
+        connection.release()
+    finally:
+        if pool is not None:
+            pool.close_all()
+        if link is not None:
+            link.close()
+        if server is not None:
+            server.close()
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        'format': RESULT_FORMAT_VERSION,
+        'started': started,
+        'environment': {
+            'python': platform.python_version(),
+            'paramiko': paramiko.__version__,
+            'platform': platform.platform()
+        },
+        'link': {'latency_ms': args.latency, 'bandwidth_mbit': args.bandwidth},
+        'results': results
+    }
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(json.load(f), report):
+                log(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
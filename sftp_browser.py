@@ -1,10 +1,18 @@
+import sys
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+    # Headless sub-commands run before Tk is ever imported
+    from sftp_cli import COMMANDS, main as cli_main
+    if sys.argv[1] in COMMANDS:
+        sys.exit(cli_main(sys.argv[1:]))
+
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
+from tkinter import simpledialog
 import paramiko
 import urllib.parse
 import os
-import sys
 from tkinter import filedialog
 import stat
 import subprocess
@@ -14,6 +22,24 @@ import time
 import platform
 import sv_ttk
 
+from sftp_events import UI_FRAME_INTERVAL, UpdateBus
+from sftp_history import EXISTS_CHECK_INTERVAL, DownloadHistory, check_exists
+from sftp_metrics import METRICS
+from sftp_pool import ConnectionPool, connection_key
+from sftp_listing import (DEFAULT_SCAN_WORKERS, PREFETCH_CACHE_ENTRIES, ListingCache, ListingEntry,
+                          ListingPrefetcher, ListingStore, TreeScanner, feed_tree, stream_listing)
+from sftp_search import RemoteSearch, parse_query
+from sftp_tar import TarRefused, TarStreamDownloader
+from sftp_throttle import BandwidthLimiter, RateSchedule, parse_rate
+from sftp_tuning import (AUTO_PROFILE, PROFILES, TUNE_MIN_SAMPLE_SIZE, TUNE_SAMPLE_SIZE, TuningStore,
+                         autotune, resolve_profile)
+from sftp_upload import (MIN_REQUEST_SIZE, UPLOAD_REQUEST_SIZE, ParallelUploader, feed_local_tree,
+                         scan_remote_state)
+from sftp_transfer import (DEFAULT_MAX_TRANSFERS, DEFAULT_SEGMENTS, DEFAULT_WORKERS, MAX_SEGMENTS,
+                           MAX_WORKERS, SEGMENT_THRESHOLD, ParallelDownloader, SyncManifest,
+                           TransferScheduler, TransferTask)
+from sftp_verify import IntegrityVerifier, shutdown_hash_pool, verify_downloads
+
 class ThemedToplevel(tk.Toplevel):
     def __init__(self, parent, **kwargs):
         super().__init__(parent, **kwargs)
@@ -22,6 +48,214 @@ class ThemedToplevel(tk.Toplevel):
         except tk.TclError:
             pass
 
+class VirtualListView:
+    """Show a long list in a Treeview by only creating rows around the visible window
+
+    Rows use their list index as item id and are formatted by format_row(index)
+    when they are created, so the cost of a listing depends on the viewport and
+    not on the length of the list. The Treeview never scrolls on its own: every
+    scroll moves the window instead, keeping the top rendered row at the top.
+    """
+    MARGIN = 100       # Rows rendered below the viewport
+    FILL_CHUNK = 50    # Margin rows created per idle callback
+
+    def __init__(self, tree, scrollbar, format_row):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.format_row = format_row
+
+        self.count = 0
+        self.start = 0        # First rendered index, always at the top of the view
+        self.end = 0          # One past the last rendered index
+        self.selected = set()
+        self._fill_job = None
+
+        tree.configure(yscrollcommand=self._on_tree_scroll)
+        scrollbar.configure(command=self._on_scrollbar)
+
+        tree.bind("<<TreeviewSelect>>", self.sync_selection, add="+")
+        tree.bind("<Configure>", lambda e: self.render(self.start), add="+")
+        tree.bind("<MouseWheel>", self._on_mousewheel)
+        tree.bind("<Button-4>", lambda e: self._scroll_by(-3))
+        tree.bind("<Button-5>", lambda e: self._scroll_by(3))
+        tree.bind("<Up>", self._on_key_up)
+        tree.bind("<Prior>", lambda e: self._scroll_by(-self.visible_rows()))
+        tree.bind("<Next>", lambda e: self._scroll_by(self.visible_rows()))
+        tree.bind("<Home>", lambda e: self._jump_to(0))
+        tree.bind("<End>", lambda e: self._jump_to(self.count - 1))
+
+    def visible_rows(self):
+        """Number of rows that fit in the Treeview right now"""
+        children = self.tree.get_children()
+        bbox = self.tree.bbox(children[0]) if children else None
+        if bbox:
+            heading, row_height = bbox[1], bbox[3]
+        else:
+            heading, row_height = 25, 20
+        return max(1, (self.tree.winfo_height() - heading) // max(1, row_height) + 1)
+
+    def reset(self, count):
+        """Show a new list of count rows from the top, with nothing selected"""
+        self._cancel_fill()
+        self.tree.delete(*self.tree.get_children())
+        self.count = count
+        self.start = self.end = 0
+        self.selected = set()
+        self.render(0)
+
+    def extend(self, count):
+        """The list grew to count rows; render the new ones only if they are in view"""
+        self.count = count
+        if self.end < min(self.count, self.start + self.visible_rows() + self.MARGIN):
+            self.render(self.start)
+        else:
+            self._update_scrollbar()
+
+    def render(self, top):
+        """Make top the first visible row, creating and deleting rows as needed"""
+        visible = self.visible_rows()
+        top = max(0, min(top, self.count - visible))
+        visible_end = min(self.count, top + visible)
+        limit = min(self.count, top + visible + self.MARGIN)
+
+        self._cancel_fill()
+        if top >= self.end or limit <= self.start:
+            # Nothing rendered is still in range: start over at top
+            self.tree.delete(*self.tree.get_children())
+            self.start = self.end = top
+        else:
+            # Drop rows that scrolled out above or fell out of the margin below
+            self._delete_range(self.start, top)
+            self._delete_range(limit, self.end)
+            self.end = min(self.end, limit)
+            if top < self.start:
+                self._insert_range(top, self.start, position=0)
+            self.start = top
+
+        # The viewport itself is rendered right away, the margin at idle time
+        if self.end < visible_end:
+            self._insert_range(self.end, visible_end)
+            self.end = visible_end
+        self.tree.yview_moveto(0)
+        self._schedule_fill()
+        self._update_scrollbar()
+
+    def refresh(self, count, changed=None):
+        """The list was replaced by one of count rows; redraw it without moving the view
+
+        If only the rows at the indices in changed differ, those are updated
+        in place. Otherwise every rendered row is created again from the same
+        top row. The selection is kept by index; set it beforehand if it moved.
+        """
+        if changed is not None and count == self.count:
+            for index in changed:
+                if self.start <= index < self.end:
+                    text, values = self.format_row(index)
+                    self.tree.item(str(index), text=text, values=values)
+            return
+        self._cancel_fill()
+        self.tree.delete(*self.tree.get_children())
+        self.count = count
+        self.selected = {index for index in self.selected if index < count}
+        top, self.start, self.end = self.start, 0, 0
+        self.render(top)
+
+    def _insert_range(self, first, last, position=tk.END):
+        for index in range(first, last):
+            text, values = self.format_row(index)
+            iid = str(index)
+            row_position = tk.END if position == tk.END else position + index - first
+            self.tree.insert("", row_position, iid=iid, text=text, values=values)
+            if index in self.selected:
+                self.tree.selection_add(iid)
+
+    def _delete_range(self, first, last):
+        rows = [str(index) for index in range(max(first, self.start), min(last, self.end))]
+        if rows:
+            self.tree.delete(*rows)
+
+    def _schedule_fill(self):
+        if self._fill_job is None and self.end < min(self.count, self.start + self.visible_rows() + self.MARGIN):
+            self._fill_job = self.tree.after_idle(self._fill_margin)
+
+    def _fill_margin(self):
+        """Create the next chunk of margin rows below the viewport"""
+        self._fill_job = None
+        target = min(self.count, self.start + self.visible_rows() + self.MARGIN, self.end + self.FILL_CHUNK)
+        if self.end < target:
+            self._insert_range(self.end, target)
+            self.end = target
+            self._schedule_fill()
+
+    def _cancel_fill(self):
+        if self._fill_job is not None:
+            self.tree.after_cancel(self._fill_job)
+            self._fill_job = None
+
+    def _update_scrollbar(self):
+        if self.count == 0:
+            self.scrollbar.set(0.0, 1.0)
+            return
+        visible = self.visible_rows()
+        self.scrollbar.set(self.start / self.count, min(1.0, (self.start + visible) / self.count))
+
+    def _on_tree_scroll(self, first, last):
+        """The Treeview scrolled by itself (e.g. keyboard focus moved): turn that into a window move"""
+        first = float(first)
+        if first > 0 and self.end > self.start:
+            top = self.start + round(first * (self.end - self.start))
+            self.tree.after_idle(lambda: self.render(top))
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.render(int(float(amount) * self.count))
+        elif unit == "pages":
+            self._scroll_by(int(amount) * self.visible_rows())
+        else:
+            self._scroll_by(int(amount))
+
+    def _on_mousewheel(self, event):
+        if platform.system() == 'Darwin':
+            rows = -event.delta
+        else:
+            rows = -3 * int(event.delta / 120)
+        return self._scroll_by(rows or (-1 if event.delta > 0 else 1))
+
+    def _scroll_by(self, rows):
+        self.render(self.start + rows)
+        return "break"
+
+    def _jump_to(self, index):
+        if self.count == 0:
+            return "break"
+        self.render(index)
+        iid = str(max(0, min(index, self.count - 1)))
+        self.tree.selection_set(iid)
+        self.tree.focus(iid)
+        return "break"
+
+    def _on_key_up(self, event):
+        """Arrow up on the top row moves the window, since the Treeview cannot scroll there"""
+        focus = self.tree.focus()
+        if focus and int(focus) == self.start and self.start > 0:
+            return self._jump_to(self.start - 1)
+        return None
+
+    def sync_selection(self, event=None):
+        """Mirror the selection of the rendered rows into the full-list selection"""
+        rendered = range(self.start, self.end)
+        current = {int(iid) for iid in self.tree.selection()}
+        self.selected = {index for index in self.selected if index not in rendered} | current
+
+    def select_all(self):
+        self.selected = set(range(self.count))
+        self.tree.selection_set(*self.tree.get_children())
+
+    def clear_selection(self):
+        self.selected = set()
+        self.tree.selection_remove(*self.tree.selection())
+
+
 class SFTPBrowser:
     def __init__(self, root):
         self.root = root
@@ -31,12 +265,36 @@ class SFTPBrowser:
         # Apply Sun Valley theme
         sv_ttk.set_theme("light")  # Start with light theme
 
-        # SFTP client
-        self.sftp = None
-        self.transport = None
+        # Connections are pooled per host, port and user so reconnecting is cheap
+        self.connection_pool = ConnectionPool()
+        self.connection = None
         self.current_path = "/"
         self.path_history = []
 
+        # Entries of the directory shown in the browser, in display order
+        self.listing_items = []
+
+        # Directory listings cached per "user@host:port" and path
+        self.connection_key = None
+        self.listing_cache = ListingCache()
+        # Listings from earlier sessions, shown at once while the directory is listed again
+        try:
+            self.listing_store = ListingStore()
+        except Exception as e:
+            print(f"Error opening the listing store, keeping it in memory: {e}")
+            self.listing_store = ListingStore(":memory:")
+        # Subdirectories of the listing on screen, listed ahead of a visit while no transfer runs
+        self.prefetch_cache = ListingCache(max_entries=PREFETCH_CACHE_ENTRIES)
+        self.prefetcher = None
+
+        # Background listings: a dedicated channel and a counter that marks older requests stale
+        self.listing_sftp = None
+        self.listing_generation = 0
+        self._listing_lock = threading.Lock()
+
+        # Recursive search whose matches are shown in place of the listing
+        self.active_search = None
+
         # Progress tracking
         self.current_operation = None
         self.progress_var = tk.DoubleVar()
@@ -45,23 +303,55 @@ class SFTPBrowser:
         # Connection panel state
         self.connection_expanded = True
 
-        # Downloads tracking
-        self.downloads = []
-
-        # Directory download progress tracking
-        self.download_stats = {
-            'total_files': 0,
-            'downloaded_files': 0,
-            'total_size': 0,
-            'downloaded_size': 0
-        }
+        # Download history on disk; the sidebar holds one compact record per row, keyed by row id
+        try:
+            self.history = DownloadHistory()
+        except Exception as e:
+            print(f"Error opening download history, keeping it in memory: {e}")
+            self.history = DownloadHistory(":memory:")
+        self.download_records = {}
+        self.missing_downloads = set()
+        self._history_cancel = threading.Event()
+        self._checking_downloads = False
+
+        # Transfer settings
+        self.transfer_workers = tk.IntVar(value=DEFAULT_WORKERS)
+        self.segment_count = tk.IntVar(value=DEFAULT_SEGMENTS)
+        self.segment_threshold_mb = tk.IntVar(value=SEGMENT_THRESHOLD // (1024 * 1024))
+        self.sync_mode = tk.BooleanVar(value=False)
+        self.bulk_mode = tk.BooleanVar(value=False)
+        self.verify_mode = tk.BooleanVar(value=False)
+        self.max_transfers = tk.IntVar(value=DEFAULT_MAX_TRANSFERS)
+        self.upload_request_kb = tk.IntVar(value=UPLOAD_REQUEST_SIZE // 1024)
+
+        # Bandwidth limits shared by every job, applied to running transfers as they are edited
+        self.bandwidth = BandwidthLimiter()
+        self.bandwidth_limit = tk.StringVar(value="")
+        self.bandwidth_schedule = tk.StringVar(value="")
+        self.bandwidth_limit.trace_add("write", lambda *args: self._apply_bandwidth_settings())
+        self.bandwidth_schedule.trace_add("write", lambda *args: self._apply_bandwidth_settings())
+
+        # Cipher and window settings for new connections; "auto" uses the tuned profile of each host
+        self.transport_profile = tk.StringVar(value=AUTO_PROFILE)
+        self.tuning_store = TuningStore()
+
+        # Worker threads hand UI updates to the Tk loop through this bus
+        self.ui_bus = UpdateBus()
+
+        # Every download runs as a job of the transfer scheduler
+        self.scheduler = TransferScheduler(max_transfers=DEFAULT_MAX_TRANSFERS, on_change=self._on_job_changed)
+        self.max_transfers.trace_add("write", lambda *args: self.scheduler.set_max_transfers(
+            self._read_int_setting(self.max_transfers, DEFAULT_MAX_TRANSFERS, 1, 64)))
 
         # GUI elements
         self.setup_gui()
+        self._drain_ui_bus()
 
         # Register protocol handler
         root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+        self.load_download_history()
+
         # Check for initial connection
         self.initial_connect()
 
@@ -108,6 +398,34 @@ class SFTPBrowser:
                                      state=tk.DISABLED)
         self.download_btn.pack(side=tk.RIGHT, padx=(0, 4))
 
+        self.upload_btn = ttk.Button(nav_frame, text="⬆ Upload",
+                                   command=self.show_upload_menu,
+                                   state=tk.DISABLED)
+        self.upload_btn.pack(side=tk.RIGHT, padx=(0, 4))
+        self.upload_menu = tk.Menu(self.root, tearoff=0, font=('Segoe UI', 9))
+        self.upload_menu.add_command(label="Upload Files...", command=self.upload_files)
+        self.upload_menu.add_command(label="Upload Folder...", command=self.upload_folder)
+
+        self.settings_btn = ttk.Button(nav_frame, text="⚙ Transfers",
+                                     command=self.open_transfer_settings)
+        self.settings_btn.pack(side=tk.RIGHT, padx=(0, 4))
+
+        self.stats_btn = ttk.Button(nav_frame, text="📊 Stats",
+                                  command=self.open_stats_panel)
+        self.stats_btn.pack(side=tk.RIGHT, padx=(0, 4))
+
+        # Recursive search below the current directory
+        self.search_btn = ttk.Button(nav_frame, text="🔍 Search",
+                                   command=self.toggle_search,
+                                   state=tk.DISABLED)
+        self.search_btn.pack(side=tk.RIGHT, padx=(0, 4))
+
+        self.search_var = tk.StringVar()
+        self.search_entry = ttk.Entry(nav_frame, textvariable=self.search_var, width=28)
+        self.search_entry.pack(side=tk.RIGHT, padx=(0, 4))
+        self.search_entry.bind("<Return>", self.start_search)
+        self.search_entry.bind("<Escape>", self.cancel_search)
+
         # File browser
         browser_container = ttk.Frame(browser_frame)
         browser_container.pack(fill=tk.BOTH, expand=True, padx=8, pady=(0, 8))
@@ -124,9 +442,12 @@ class SFTPBrowser:
         self.tree.column("permissions", width=100, anchor="c")
 
         # Scrollbars for treeview
-        tree_scroll_y = ttk.Scrollbar(browser_container, orient=tk.VERTICAL, command=self.tree.yview)
+        tree_scroll_y = ttk.Scrollbar(browser_container, orient=tk.VERTICAL)
         tree_scroll_x = ttk.Scrollbar(browser_container, orient=tk.HORIZONTAL, command=self.tree.xview)
-        self.tree.configure(yscrollcommand=tree_scroll_y.set, xscrollcommand=tree_scroll_x.set)
+        self.tree.configure(xscrollcommand=tree_scroll_x.set)
+
+        # Only the rows around the viewport exist in the Treeview
+        self.listing_view = VirtualListView(self.tree, tree_scroll_y, self._format_listing_row)
 
         self.tree.grid(row=0, column=0, sticky="nsew")
         tree_scroll_y.grid(row=0, column=1, sticky="ns")
@@ -142,9 +463,13 @@ class SFTPBrowser:
         # Add context menu for multi-select operations
         self.browser_menu = tk.Menu(self.root, tearoff=0, font=('Segoe UI', 9))
         self.browser_menu.add_command(label="Download Selected", command=self.download_selected)
+        self.browser_menu.add_command(label="Open Folder", command=self.open_selected_directory)
         self.browser_menu.add_separator()
         self.browser_menu.add_command(label="Select All", command=self.select_all)
         self.browser_menu.add_command(label="Clear Selection", command=self.clear_selection)
+        self.browser_menu.add_separator()
+        self.browser_menu.add_command(label="Upload Files Here...", command=self.upload_files)
+        self.browser_menu.add_command(label="Upload Folder Here...", command=self.upload_folder)
         
         self.tree.bind("<Button-3>", self.show_browser_context_menu)
         self.tree.bind("<Control-a>", self.select_all)
@@ -167,6 +492,8 @@ class SFTPBrowser:
 
     def setup_sidebar(self, parent):
         """Setup the downloads sidebar"""
+        self.setup_transfers_panel(parent)
+
         # Header
         header_frame = ttk.Frame(parent)
         header_frame.pack(fill=tk.X, padx=6, pady=6)
@@ -210,6 +537,51 @@ class SFTPBrowser:
 
         self.downloads_tree.bind("<Button-3>", self.show_downloads_context_menu)
 
+    def setup_transfers_panel(self, parent):
+        """Setup the list of queued and running transfer jobs"""
+        header_frame = ttk.Frame(parent)
+        header_frame.pack(fill=tk.X, padx=6, pady=6)
+
+        ttk.Label(header_frame, text="Transfers", font=('Segoe UI', 12, 'bold')).pack(side=tk.LEFT)
+
+        ttk.Button(header_frame, text="🗑 Clear Finished",
+                   command=self.clear_finished_transfers).pack(side=tk.RIGHT)
+
+        transfers_container = ttk.Frame(parent)
+        transfers_container.pack(fill=tk.X, padx=6, pady=(0, 6))
+
+        self.transfers_tree = ttk.Treeview(transfers_container, columns=("state", "progress"), show="tree headings", height=5)
+        self.transfers_tree.heading("#0", text="Job", anchor="c")
+        self.transfers_tree.heading("state", text="State", anchor="c")
+        self.transfers_tree.heading("progress", text="Progress", anchor="c")
+
+        self.transfers_tree.column("#0", width=120, anchor="w")
+        self.transfers_tree.column("state", width=60, anchor="c")
+        self.transfers_tree.column("progress", width=80, anchor="e")
+
+        transfers_scroll = ttk.Scrollbar(transfers_container, orient=tk.VERTICAL, command=self.transfers_tree.yview)
+        self.transfers_tree.configure(yscrollcommand=transfers_scroll.set)
+
+        self.transfers_tree.grid(row=0, column=0, sticky="nsew")
+        transfers_scroll.grid(row=0, column=1, sticky="ns")
+        transfers_container.grid_columnconfigure(0, weight=1)
+
+        # Context menu for transfer jobs
+        self.transfers_menu = tk.Menu(self.root, tearoff=0, font=('Segoe UI', 9))
+        self.transfers_menu.add_command(label="Pause", command=lambda: self._apply_to_selected_jobs(self.scheduler.pause))
+        self.transfers_menu.add_command(label="Resume", command=lambda: self._apply_to_selected_jobs(self.scheduler.resume))
+        self.transfers_menu.add_command(label="Cancel", command=lambda: self._apply_to_selected_jobs(self.scheduler.cancel))
+        self.transfers_menu.add_separator()
+        self.transfers_menu.add_command(label="Raise Priority", command=lambda: self._apply_to_selected_jobs(
+            lambda job: self.scheduler.set_priority(job, job.priority + 1)))
+        self.transfers_menu.add_command(label="Lower Priority", command=lambda: self._apply_to_selected_jobs(
+            lambda job: self.scheduler.set_priority(job, job.priority - 1)))
+        self.transfers_menu.add_command(label="Limit Speed...", command=self.limit_selected_jobs)
+        self.transfers_menu.add_separator()
+        self.transfers_menu.add_command(label="Clear Finished", command=self.clear_finished_transfers)
+
+        self.transfers_tree.bind("<Button-3>", self.show_transfers_context_menu)
+
     def setup_connection_panel(self, parent):
         # Connection panel container
         connection_container = ttk.Frame(parent)
@@ -312,6 +684,8 @@ class SFTPBrowser:
             self.back_btn.config(state=tk.NORMAL)
             self.refresh_btn.config(state=tk.NORMAL)
             self.download_btn.config(state=tk.NORMAL)
+            self.upload_btn.config(state=tk.NORMAL)
+            self.search_btn.config(state=tk.NORMAL)
             self.disconnect_btn.config(state=tk.NORMAL)
             
             # Disable connection controls
@@ -331,6 +705,8 @@ class SFTPBrowser:
             self.back_btn.config(state=tk.DISABLED)
             self.refresh_btn.config(state=tk.DISABLED)
             self.download_btn.config(state=tk.DISABLED)
+            self.upload_btn.config(state=tk.DISABLED)
+            self.search_btn.config(state=tk.DISABLED)
             self.disconnect_btn.config(state=tk.DISABLED)
             
             # Enable connection controls
@@ -350,29 +726,35 @@ class SFTPBrowser:
         """Update progress bar and status text"""
         self.progress_var.set(value)
         self.progress_text.set(text)
-        self.root.update_idletasks()
+
+    def _drain_ui_bus(self):
+        """Apply the updates posted by worker threads, once per frame"""
+        self.ui_bus.drain()
+        self.root.after(int(UI_FRAME_INTERVAL * 1000), self._drain_ui_bus)
 
     def _clear_browser_state(self):
         """Clears the browser's view, path history, and closes the SFTP connection."""
-        if self.sftp:
-            try:
-                self.sftp.close()
-            except Exception:
-                pass
-            self.sftp = None
-        if self.transport:
-            try:
-                self.transport.close()
-            except Exception:
-                pass
-            self.transport = None
+        self.cancel_search()
+        self.listing_generation += 1
+        if self.prefetcher:
+            self.prefetcher.close()
+            self.prefetcher = None
+        with self._listing_lock:
+            listing_sftp, self.listing_sftp = self.listing_sftp, None
+        if listing_sftp:
+            self._close_channel(listing_sftp)
+        if self.connection:
+            # The pool keeps the transport open for a while in case we come back
+            self.connection.release()
+            self.connection = None
+        self.connection_key = None
         
         self.current_path = "/"
         self.path_history = []
         self.path_label.config(text="Not Connected")
         
-        for item in self.tree.get_children():
-            self.tree.delete(item)
+        self.listing_items = []
+        self.listing_view.reset(0)
         
         self.update_ui_state(connected=False)
         self.update_progress(0, "Disconnected")
@@ -408,33 +790,35 @@ class SFTPBrowser:
     def connect_manual(self, hostname, port, username, password, retry_count=0):
         """Connect to SFTP server with manual credentials"""
         self._clear_browser_state()
+        profile_name = self.transport_profile.get()
         
         def connect_thread():
             try:
-                self.update_progress(25, f"Connecting to {hostname}...")
-                
-                self.transport = paramiko.Transport((hostname, port))
-                self.update_progress(50, "Authenticating...")
+                self.ui_bus.post(self.update_progress, 25, f"Connecting to {hostname}...")
                 
-                self.transport.connect(username=username, password=password)
-                self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+                # Reuses a pooled transport to the same server when one is still open
+                profile = resolve_profile(profile_name, self.tuning_store, connection_key(hostname, port, username))
+                self.connection = self.connection_pool.get(hostname, port, username, password, profile)
+                self.connection_key = self.connection.key
                 
-                self.update_progress(75, "Loading directory...")
+                self.ui_bus.post(self.update_progress, 75, "Loading directory...")
                 self.current_path = "/"
                 
                 # Switch to main thread for UI updates
-                self.root.after(0, lambda: self.finish_connection())
+                self.ui_bus.post(self.finish_connection)
                 
             except paramiko.AuthenticationException:
-                self.root.after(0, lambda: self.handle_auth_error(hostname, port, username, retry_count))
+                self.ui_bus.post(self.handle_auth_error, hostname, port, username, retry_count)
             except Exception as e:
-                self.root.after(0, lambda: self.handle_connection_error(str(e)))
+                self.ui_bus.post(self.handle_connection_error, str(e))
 
         threading.Thread(target=connect_thread, daemon=True).start()
 
     def finish_connection(self):
         """Finish connection setup in main thread"""
         try:
+            self.prefetcher = ListingPrefetcher(self.connection.open_channel, self.prefetch_cache,
+                                                self.listing_store, is_busy=lambda: self.scheduler.busy)
             self.load_directory()
             self.update_ui_state(connected=True)
             self.update_progress(100, f"Connected to {self.hostname_entry.get()}")
@@ -492,26 +876,26 @@ class SFTPBrowser:
             self.port_entry.insert(0, str(port))
             self.username_entry.delete(0, tk.END)
             self.username_entry.insert(0, username)
+            profile_name = self.transport_profile.get()
 
             def connect_thread():
                 try:
-                    self.update_progress(25, f"Connecting to {hostname}...")
-                    
-                    self.transport = paramiko.Transport((hostname, port))
-                    self.update_progress(50, "Authenticating...")
+                    self.ui_bus.post(self.update_progress, 25, f"Connecting to {hostname}...")
                     
-                    self.transport.connect(username=username, password=password)
-                    self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+                    # Reuses a pooled transport to the same server when one is still open
+                    profile = resolve_profile(profile_name, self.tuning_store, connection_key(hostname, port, username))
+                    self.connection = self.connection_pool.get(hostname, port, username, password, profile)
+                    self.connection_key = self.connection.key
                     
-                    self.update_progress(75, "Loading directory...")
+                    self.ui_bus.post(self.update_progress, 75, "Loading directory...")
                     self.current_path = path
                     
-                    self.root.after(0, lambda: self.finish_connection())
+                    self.ui_bus.post(self.finish_connection)
                     
                 except paramiko.AuthenticationException:
-                    self.root.after(0, lambda: self.handle_auth_error(hostname, port, username, retry_count))
+                    self.ui_bus.post(self.handle_auth_error, hostname, port, username, retry_count)
                 except Exception as e:
-                    self.root.after(0, lambda: self.handle_connection_error(str(e)))
+                    self.ui_bus.post(self.handle_connection_error, str(e))
 
             threading.Thread(target=connect_thread, daemon=True).start()
 
@@ -546,49 +930,311 @@ class SFTPBrowser:
             
         return path
 
-    def load_directory(self):
-        """Load directory contents"""
-        if not self.sftp:
+    def load_directory(self, force=False):
+        """Load directory contents, from the listing cache unless force is set
+
+        Uncached directories are listed in a background thread. A listing
+        stored by an earlier session is shown right away and then brought up
+        to date; otherwise rows appear batch by batch. Starting another
+        listing makes the running one stale.
+        """
+        if not self.connection:
             return
 
+        self.cancel_search()
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.listing_generation += 1
+        generation = self.listing_generation
+        path = self.current_path
+
         try:
             # Clear current items
-            for item in self.tree.get_children():
-                self.tree.delete(item)
+            self.listing_items = []
+            self.listing_view.reset(0)
 
             # Update path display
-            self.path_label.config(text=self.current_path)
+            self.path_label.config(text=path)
+
+            items = None if force else self.listing_cache.get(self.connection_key, path)
+            source = "from cache"
+            if items is None and not force:
+                items = self.prefetch_cache.get(self.connection_key, path)
+                source = "prefetched"
+                if items is not None:
+                    self.listing_cache.put(self.connection_key, path, items)
+            if items is not None:
+                self.listing_items = items
+                self.listing_view.reset(len(items))
+                self._show_browsing_status(len(items), source)
+                self._prefetch_subdirectories()
+                return
 
-            # List directory contents
-            items = self.sftp.listdir_attr(self.current_path)
-            
-            # Sort items: directories first, then files
-            items.sort(key=lambda x: (not stat.S_ISDIR(x.st_mode), x.filename.lower()))
+            self.update_progress(0, f"Listing {path}...")
+            threading.Thread(target=self._list_directory_thread,
+                             args=(generation, path, self.connection_key, not force), daemon=True).start()
 
-            for item in items:
-                is_dir = stat.S_ISDIR(item.st_mode)
-                icon = "📁" if is_dir else "📄"
-                
-                # Format size
-                if is_dir:
-                    size = "<DIR>"
-                else:
-                    size = self.format_size(item.st_size)
-                
-                # Format date
-                try:
-                    modified = datetime.datetime.fromtimestamp(item.st_mtime).strftime("%Y-%m-%d %H:%M")
-                except (OSError, ValueError):
-                    modified = "Unknown"
-                
-                # Format permissions
-                permissions = stat.filemode(item.st_mode)
+        except Exception as e:
+            messagebox.showerror("Directory Error", f"Failed to load directory: {e}")
+
+    def _list_directory_thread(self, generation, path, connection_key, use_store=True):
+        """List a directory from a worker thread, showing its stored listing meanwhile if there is one"""
+        def is_stale():
+            return generation != self.listing_generation
 
-                self.tree.insert("", tk.END, text=f"{icon} {item.filename}", 
-                                values=(size, modified, permissions))
+        stored = None
+        if use_store:
+            try:
+                stored, fetched = self.listing_store.get(connection_key, path)
+            except Exception as e:
+                print(f"Error reading the listing store: {e}")
+            if stored is not None:
+                self.ui_bus.post(self._show_stored_listing, generation, stored, fetched)
 
+        def on_batch(batch):
+            # Rows of a stored listing on screen are updated once the new listing is complete
+            if stored is None:
+                self.ui_bus.post(self._append_listing_batch, generation, batch)
+
+        sftp = None
+        try:
+            sftp = self._take_listing_channel()
+            items = stream_listing(sftp, path, on_batch, is_cancelled=is_stale)
         except Exception as e:
-            messagebox.showerror("Directory Error", f"Failed to load directory: {e}")
+            if sftp:
+                self._close_channel(sftp)
+            if not is_stale():
+                self.ui_bus.post(self._listing_failed, generation, str(e))
+            return
+
+        if items is None:
+            # Abandoned mid-listing, the channel cannot be reused
+            self._close_channel(sftp)
+            return
+
+        self._return_listing_channel(sftp)
+
+        # Sort items: directories first, then files
+        items.sort(key=lambda x: (not stat.S_ISDIR(x.st_mode), x.filename.lower()))
+        self.listing_cache.put(connection_key, path, items)
+        try:
+            self.listing_store.put(connection_key, path, items)
+        except Exception as e:
+            print(f"Error storing the listing of {path}: {e}")
+        if stored is None:
+            self.ui_bus.post(self._finish_listing, generation, items)
+        else:
+            self.ui_bus.post(self._revalidate_listing, generation, items)
+
+    def _take_listing_channel(self):
+        """Hand out the idle listing channel, or open a new one if it is busy"""
+        with self._listing_lock:
+            sftp, self.listing_sftp = self.listing_sftp, None
+        return sftp or self.open_sftp_channel()
+
+    def _return_listing_channel(self, sftp):
+        """Keep a finished listing channel for the next listing if it is still needed"""
+        with self._listing_lock:
+            transport = self.connection.transport if self.connection else None
+            if self.listing_sftp is None and sftp.get_channel().get_transport() is transport:
+                self.listing_sftp = sftp
+                return
+        self._close_channel(sftp)
+
+    def _close_channel(self, sftp):
+        try:
+            sftp.close()
+        except Exception:
+            pass
+
+    def _append_listing_batch(self, generation, batch):
+        """Show rows of a listing that is still arriving"""
+        if generation != self.listing_generation:
+            return
+        self.listing_items.extend(batch)
+        self.listing_view.extend(len(self.listing_items))
+        self.update_progress(0, f"Listing {self.current_path}: {len(self.listing_items)} items...")
+
+    def _finish_listing(self, generation, items):
+        """Replace the streamed rows with the complete, sorted listing"""
+        if generation != self.listing_generation:
+            return
+        self.listing_items = items
+        self.listing_view.reset(len(items))
+        self._show_browsing_status(len(items))
+        self._prefetch_subdirectories()
+
+    def _show_stored_listing(self, generation, items, fetched):
+        """Show the listing kept from an earlier visit while the directory is listed again"""
+        if generation != self.listing_generation:
+            return
+        self.listing_items = items
+        self.listing_view.reset(len(items))
+        age = self.format_duration(max(0, time.time() - fetched))
+        self._show_browsing_status(len(items), f"stored {age} ago, refreshing...")
+
+    def _revalidate_listing(self, generation, items):
+        """Bring the stored listing on screen up to date, touching only the rows that changed"""
+        if generation != self.listing_generation:
+            return
+        old = self.listing_items
+        if len(old) == len(items) and all(a.filename == b.filename for a, b in zip(old, items)):
+            changed = [index for index, (a, b) in enumerate(zip(old, items))
+                       if (a.st_mode, a.st_size, a.st_mtime) != (b.st_mode, b.st_size, b.st_mtime)]
+            self.listing_items = items
+            self.listing_view.refresh(len(items), changed)
+            self._show_browsing_status(len(items), f"refreshed, {len(changed)} changed")
+            self._prefetch_subdirectories()
+            return
+
+        # Entries were added or removed: keep the selection on the same names
+        selected = {old[index].filename for index in self.listing_view.selected if index < len(old)}
+        self.listing_items = items
+        self.listing_view.selected = {index for index, item in enumerate(items) if item.filename in selected}
+        self.listing_view.refresh(len(items))
+        self._show_browsing_status(len(items), f"refreshed, was {len(old)}")
+        self._prefetch_subdirectories()
+
+    def _prefetch_subdirectories(self):
+        """List the subdirectories of the listing on screen in the background, likely ones first"""
+        if not self.prefetcher:
+            return
+        names = [item.filename for item in self.listing_items if stat.S_ISDIR(item.st_mode)
+                 and not self.listing_cache.contains(self.connection_key,
+                                                     self.normalize_path(self.current_path, item.filename))]
+        if names:
+            self.prefetcher.prefetch(self.connection_key, self.current_path, names)
+
+    def _show_browsing_status(self, count, source="listed"):
+        cache = self.listing_cache.stats()
+        self.update_progress(0, f"Browsing: {self.current_path} ({count} items {source}; "
+                                f"listing cache {cache['hits']} hits, {cache['misses']} misses)")
+
+    def _listing_failed(self, generation, error):
+        if generation != self.listing_generation:
+            return
+        self.update_progress(0, "Listing failed")
+        messagebox.showerror("Directory Error", f"Failed to load directory: {error}")
+
+    def toggle_search(self):
+        if self.active_search is not None:
+            self.cancel_search()
+        else:
+            self.start_search()
+
+    def start_search(self, event=None):
+        """Search below the current directory, streaming matches into the browser as they are found
+
+        Matches are named by their path relative to the directory searched, so
+        they can be opened and downloaded like entries of a listing. Back
+        returns to the listing.
+        """
+        if not self.connection:
+            return
+        text = self.search_var.get().strip()
+        if not text:
+            return
+        try:
+            query = parse_query(text)
+        except ValueError as e:
+            messagebox.showerror("Search", f"Invalid search: {e}")
+            return
+
+        self.cancel_search()
+        self.listing_generation += 1
+        generation = self.listing_generation
+        root = self.current_path
+        self.path_history.append(root)
+
+        self.listing_items = []
+        self.listing_view.reset(0)
+        self.path_label.config(text=f"Search in {root}: {text}")
+        self.search_btn.config(text="■ Stop")
+        self.update_progress(0, f"Searching {root}...")
+
+        search = RemoteSearch(self.connection.open_channel, query)
+        self.active_search = search
+
+        def on_matches(entries):
+            self.ui_bus.post(self._append_search_results, generation, entries)
+
+        def on_progress(directories, matches):
+            self.ui_bus.post_latest("search", self._show_search_progress, generation, root, directories, matches)
+
+        def search_thread():
+            error = None
+            try:
+                search.run(root, on_matches, on_progress)
+            except Exception as e:
+                error = str(e)
+            self.ui_bus.post(self._finish_search, generation, search, root, error)
+
+        threading.Thread(target=search_thread, daemon=True).start()
+
+    def cancel_search(self, event=None):
+        """Stop the running search; the matches found so far stay in the browser"""
+        if self.active_search is not None:
+            self.active_search.cancel()
+
+    def _append_search_results(self, generation, entries):
+        if generation != self.listing_generation:
+            return
+        self.listing_items.extend(entries)
+        self.listing_view.extend(len(self.listing_items))
+
+    def _show_search_progress(self, generation, root, directories, matches):
+        if generation != self.listing_generation:
+            return
+        self.update_progress(0, f"Searching {root}: {matches} matches in {directories} directories...")
+
+    def _finish_search(self, generation, search, root, error):
+        if self.active_search is search:
+            self.active_search = None
+            self.search_btn.config(text="🔍 Search")
+        if generation != self.listing_generation:
+            return
+        if error:
+            self.update_progress(0, "Search failed")
+            messagebox.showerror("Search", f"Search failed: {error}")
+            return
+
+        status = f"Found {search.matches} matches in {search.directories} directories below {root}"
+        if search.truncated:
+            status += f" (stopped at {search.max_results})"
+        elif search.cancelled:
+            status += " (stopped)"
+        self.update_progress(0, status)
+
+    def _format_listing_row(self, index):
+        """Format the browser row of one listing entry, called only when the row is shown"""
+        item = self.listing_items[index]
+        is_dir = stat.S_ISDIR(item.st_mode)
+        icon = "📁" if is_dir else "📄"
+        
+        # Format size
+        if is_dir:
+            size = "<DIR>"
+        else:
+            size = self.format_size(item.st_size)
+        
+        # Format date
+        try:
+            modified = datetime.datetime.fromtimestamp(item.st_mtime).strftime("%Y-%m-%d %H:%M")
+        except (OSError, ValueError, TypeError):
+            modified = "Unknown"
+        
+        # Format permissions
+        permissions = stat.filemode(item.st_mode)
+
+        return f"{icon} {item.filename}", (size, modified, permissions)
+
+    def format_duration(self, seconds):
+        """Format a duration as h:mm:ss or m:ss"""
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return f"{hours}:{minutes:02d}:{seconds:02d}"
+        return f"{minutes}:{seconds:02d}"
 
     def format_size(self, size):
         """Format file size in human readable format"""
@@ -600,35 +1246,50 @@ class SFTPBrowser:
 
     def on_double_click(self, event=None):
         """Handle double click on tree item"""
-        if not self.sftp:
+        if not self.connection:
             return
 
         selection = self.tree.selection()
         if not selection:
             return
 
-        item = selection[0]
-        item_text = self.tree.item(item, "text")
-        filename = item_text.split(" ", 1)[1]  # Remove icon
+        entry = self.entry_for_item(selection[0])
+        if entry is None:
+            return
 
         try:
-            # Get file attributes
-            item_path = self.normalize_path(self.current_path, filename)
-            attrs = self.sftp.stat(item_path)
+            if entry.is_link:
+                # The listing describes the link itself, so resolve what it points to
+                item_path = self.normalize_path(self.current_path, entry.filename)
+                entry = ListingEntry.from_attributes(self.sftp.stat(item_path), entry.filename)
             
-            if stat.S_ISDIR(attrs.st_mode):
+            if entry.is_dir:
                 # It's a directory, navigate to it
-                self.navigate_to_directory(filename)
+                self.navigate_to_directory(entry.filename)
             else:
                 # It's a file, download it
-                self.download_file(filename)
+                self.download_file(entry.filename, entry)
 
         except Exception as e:
             messagebox.showerror("Error", f"Failed to access item: {e}")
 
+    def entry_for_item(self, item):
+        """Return the listing entry behind a browser row id"""
+        try:
+            return self.listing_items[int(item)]
+        except (ValueError, IndexError):
+            return None
+
+    def find_listing_entry(self, filename):
+        """Return the entry of the current listing called filename, if any"""
+        for entry in self.listing_items:
+            if entry.filename == filename:
+                return entry
+        return None
+
     def navigate_to_directory(self, dirname):
         """Navigate to a directory"""
-        if not self.sftp:
+        if not self.connection:
             return
 
         try:
@@ -639,7 +1300,6 @@ class SFTPBrowser:
             self.current_path = self.normalize_path(self.current_path, dirname)
             
             self.load_directory()
-            self.update_progress(0, f"Browsing: {self.current_path}")
 
         except Exception as e:
             # Restore previous path if navigation fails
@@ -649,20 +1309,18 @@ class SFTPBrowser:
 
     def go_back(self):
         """Go back to previous directory"""
-        if not self.sftp or not self.path_history:
+        if not self.connection or not self.path_history:
             return
 
         self.current_path = self.path_history.pop()
         self.load_directory()
-        self.update_progress(0, f"Browsing: {self.current_path}")
 
     def refresh_directory(self):
         """Refresh current directory"""
-        if not self.sftp:
+        if not self.connection:
             return
             
-        self.load_directory()
-        self.update_progress(0, f"Refreshed: {self.current_path}")
+        self.load_directory(force=True)
 
     def show_browser_context_menu(self, event):
         """Show context menu for browser items"""
@@ -670,38 +1328,49 @@ class SFTPBrowser:
         item = self.tree.identify_row(event.y)
         if item and item not in self.tree.selection():
             self.tree.selection_set(item)
+        self.listing_view.sync_selection()
         
         # Update menu labels based on selection
-        selection_count = len(self.tree.selection())
-        if selection_count == 0:
+        selection = self.listing_view.selected
+        entry = self.entry_for_item(next(iter(selection))) if len(selection) == 1 else None
+        if not selection:
             self.browser_menu.entryconfig(0, label="Download Selected", state="disabled")
-        elif selection_count == 1:
-            self.browser_menu.entryconfig(0, label="Download Selected", state="normal")
+        elif entry is not None:
+            self.browser_menu.entryconfig(0, label=f"Download {entry.filename}", state="normal")
         else:
-            self.browser_menu.entryconfig(0, label=f"Download {selection_count} Items", state="normal")
+            self.browser_menu.entryconfig(0, label=f"Download {len(selection)} Items", state="normal")
+        self.browser_menu.entryconfig(1, state="normal" if entry is not None and entry.is_dir else "disabled")
         
         self.browser_menu.post(event.x_root, event.y_root)
 
+    def open_selected_directory(self):
+        """Navigate into the single selected directory"""
+        selection = self.listing_view.selected
+        if len(selection) == 1:
+            entry = self.entry_for_item(next(iter(selection)))
+            if entry is not None and entry.is_dir:
+                self.navigate_to_directory(entry.filename)
+
     def select_all(self, event=None):
         """Select all items in the current directory"""
-        if not self.sftp:
+        if not self.connection:
             return "break"  # Prevent default handling
         
-        for child in self.tree.get_children():
-            self.tree.selection_add(child)
+        self.listing_view.select_all()
         return "break"
 
     def clear_selection(self, event=None):
         """Clear all selections"""
-        self.tree.selection_remove(*self.tree.selection())
+        self.listing_view.clear_selection()
         return "break"
 
     def download_selected(self):
         """Download selected files and directories"""
-        if not self.sftp:
+        if not self.connection:
             return
 
-        selection = self.tree.selection()
+        self.listing_view.sync_selection()
+        selection = sorted(self.listing_view.selected)
         if not selection:
             messagebox.showinfo("No Selection", "Please select files or directories to download.")
             return
@@ -711,160 +1380,599 @@ class SFTPBrowser:
         if not local_dir:
             return
 
-        # Process each selected item
-        for item in selection:
-            item_text = self.tree.item(item, "text")
-            filename = item_text.split(" ", 1)[1]  # Remove icon
-            
-            # Check if it is a directory
-            if item_text.startswith("📁"):
-                self.download_directory_to_path(filename, local_dir)
-            else:
-                self.download_file_to_path(filename, local_dir)
+        # Collect every selected item into a single parallel batch
+        self._start_batch_download([self.listing_items[index] for index in selection], local_dir)
 
     def download_file_to_path(self, filename, local_dir):
         """Download a file to a specific local directory"""
-        if not self.sftp:
+        if not self.connection:
             return
 
-        try:
-            # Construct remote path
-            remote_path = self.normalize_path(self.current_path, filename)
-            
-            # Create local file path
-            local_path = os.path.join(local_dir, filename)
-
-            # Start download in separate thread
-            def download_thread():
-                try:
-                    # Get file size for progress tracking
-                    file_attrs = self.sftp.stat(remote_path)
-                    file_size = file_attrs.st_size
-                    
-                    self.root.after(0, lambda: self.update_progress(0, f"Downloading {filename}..."))
-                    
-                    def progress_callback(transferred, total):
-                        if total > 0:
-                            progress = (transferred / total) * 100
-                            self.root.after(0, lambda: self.update_progress(
-                                progress, 
-                                f"Downloading {filename}: {self.format_size(transferred)}/{self.format_size(total)}"
-                            ))
-
-                    # Download file with progress callback
-                    self.sftp.get(remote_path, local_path, callback=progress_callback)
-                    
-                    # Add to downloads list
-                    download_info = {
-                        "filename": filename,
-                        "local_path": local_path,
-                        "remote_path": remote_path,
-                        "size": file_size,
-                        "timestamp": datetime.datetime.now(),
-                        "is_directory": False
-                    }
-                    self.downloads.append(download_info)
-                    
-                    # Update downloads sidebar
-                    self.root.after(0, lambda: self.update_downloads_list())
-                    self.root.after(0, lambda: self.update_progress(100, f"Downloaded {filename} successfully"))
-                    
-                except Exception as e:
-                    self.root.after(0, lambda error=str(e): messagebox.showerror("Download Error", f"Failed to download file {filename}: {error}"))
-
-            threading.Thread(target=download_thread, daemon=True).start()
-
-        except Exception as e:
-            messagebox.showerror("Download Error", f"Failed to initiate download of {filename}: {e}")
+        entry = self.find_listing_entry(filename) or ListingEntry(filename, stat.S_IFREG)
+        self._start_batch_download([entry], local_dir)
 
     def download_directory_to_path(self, dirname, local_dir):
         """Download a directory to a specific local directory"""
-        if not self.sftp:
+        if not self.connection:
             return
 
+        self._start_batch_download([ListingEntry(dirname, stat.S_IFDIR)], local_dir)
+
+    @property
+    def sftp(self):
+        """Primary SFTP client of the current connection, reconnected if the transport dropped"""
+        return self.connection.sftp if self.connection else None
+
+    def open_sftp_channel(self):
+        """Open an additional SFTP channel on the current transport"""
+        return self.connection.open_channel()
+
+    def _read_int_setting(self, variable, default, minimum, maximum):
+        """Read an integer Tk variable, falling back to default on bad input"""
         try:
-            # Create local directory path
-            local_path = os.path.join(local_dir, dirname)
-            os.makedirs(local_path, exist_ok=True)
+            value = int(variable.get())
+        except (tk.TclError, ValueError):
+            value = default
+        return max(minimum, min(value, maximum))
+
+    def get_transfer_settings(self):
+        """Collect the transfer settings in the main thread for a download thread to use"""
+        threshold_mb = self._read_int_setting(self.segment_threshold_mb, SEGMENT_THRESHOLD // (1024 * 1024), 1, 1024 * 1024)
+        return {
+            'workers': self._read_int_setting(self.transfer_workers, DEFAULT_WORKERS, 1, MAX_WORKERS),
+            'segments': self._read_int_setting(self.segment_count, DEFAULT_SEGMENTS, 1, MAX_SEGMENTS),
+            'segment_threshold': threshold_mb * 1024 * 1024
+        }
 
-            # Remote directory path
-            remote_path = self.normalize_path(self.current_path, dirname)
+    def _apply_bandwidth_settings(self):
+        """Hand the limits typed in the settings to the limiter once they parse"""
+        try:
+            rate = parse_rate(self.bandwidth_limit.get())
+            schedule = RateSchedule.parse(self.bandwidth_schedule.get())
+        except ValueError:
+            # Probably still being typed; the last valid limits stay in force
+            return
+        self.bandwidth.set_rate(rate)
+        self.bandwidth.set_schedule(schedule)
+
+    def open_transfer_settings(self):
+        """Show the transfer settings dialog"""
+        dialog = ThemedToplevel(self.root)
+        dialog.title("Transfer Settings")
+        dialog.transient(self.root)
+        dialog.resizable(False, False)
+
+        frame = ttk.Frame(dialog, padding=12)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        rows = [
+            ("Max concurrent transfers:", self.max_transfers, 1, 64),
+            ("Parallel streams:", self.transfer_workers, 1, MAX_WORKERS),
+            ("Segments per large file:", self.segment_count, 1, MAX_SEGMENTS),
+            ("Segment files above (MB):", self.segment_threshold_mb, 1, 1024 * 1024),
+            ("Upload request size (KB):", self.upload_request_kb, MIN_REQUEST_SIZE // 1024, UPLOAD_REQUEST_SIZE // 1024),
+        ]
+        for row, (text, variable, minimum, maximum) in enumerate(rows):
+            ttk.Label(frame, text=text, font=('Segoe UI', 9)).grid(row=row, column=0, sticky="w", pady=2)
+            ttk.Spinbox(frame, from_=minimum, to=maximum, width=8,
+                        textvariable=variable).grid(row=row, column=1, sticky="ew", padx=(8, 0), pady=2)
+
+        ttk.Checkbutton(frame, text="Sync: only download new or changed files",
+                        variable=self.sync_mode).grid(row=len(rows), column=0, columnspan=2, sticky="w", pady=(6, 2))
+        ttk.Checkbutton(frame, text="Bulk: stream folders as tar when the server allows exec",
+                        variable=self.bulk_mode).grid(row=len(rows) + 1, column=0, columnspan=2, sticky="w", pady=2)
+        ttk.Checkbutton(frame, text="Verify: compare checksums with the server after downloading",
+                        variable=self.verify_mode).grid(row=len(rows) + 2, column=0, columnspan=2, sticky="w", pady=2)
+
+        row = len(rows) + 3
+        ttk.Label(frame, text="Bandwidth limit (e.g. 10M):", font=('Segoe UI', 9)).grid(row=row, column=0, sticky="w", pady=2)
+        ttk.Entry(frame, textvariable=self.bandwidth_limit, width=10).grid(row=row, column=1, sticky="ew", padx=(8, 0), pady=2)
+        ttk.Label(frame, text="Limit schedule:", font=('Segoe UI', 9)).grid(row=row + 1, column=0, sticky="w", pady=2)
+        ttk.Entry(frame, textvariable=self.bandwidth_schedule, width=24).grid(row=row + 1, column=1, sticky="ew", padx=(8, 0), pady=2)
+        ttk.Label(frame, text='e.g. "22:00-06:00=off, 09:00-17:00=2M"; blank or off for no limit',
+                  font=('Segoe UI', 8)).grid(row=row + 2, column=0, columnspan=2, sticky="w", pady=(0, 4))
+
+        row += 3
+        ttk.Label(frame, text="Connection profile:", font=('Segoe UI', 9)).grid(row=row, column=0, sticky="w", pady=2)
+        ttk.Combobox(frame, textvariable=self.transport_profile, state="readonly", width=10,
+                     values=[AUTO_PROFILE] + list(PROFILES)).grid(row=row, column=1, sticky="ew", padx=(8, 0), pady=2)
+
+        tuned = self.tuning_store.get(self.connection_key) if self.connection_key else None
+        tuned_text = f"Tuned: {tuned.describe()}" if tuned else "Not tuned for this server yet"
+        ttk.Label(frame, text=tuned_text, font=('Segoe UI', 8)).grid(row=row + 1, column=0, sticky="w", pady=2)
+        ttk.Button(frame, text="Auto-tune", command=self.autotune_connection).grid(row=row + 1, column=1, sticky="ew", padx=(8, 0), pady=2)
+
+        ttk.Button(frame, text="Close", command=dialog.destroy).grid(row=row + 2, column=0, columnspan=2, pady=(10, 0))
+
+    def autotune_connection(self):
+        """Benchmark ciphers and window sizes against the current server and remember the fastest"""
+        if not self.connection:
+            messagebox.showwarning("Auto-tune", "Connect to a server first.")
+            return
 
-            # Start download in separate thread
-            def download_thread():
-                try:
-                    # First, scan the directory structure
-                    self.root.after(0, lambda: self.update_progress(5, f"Scanning directory {dirname}..."))
-                    
-                    total_files, total_size, file_list = self.scan_directory_structure(remote_path)
-                    
-                    # Initialize download stats
-                    self.download_stats = {
-                        "total_files": total_files,
-                        "downloaded_files": 0,
-                        "total_size": total_size,
-                        "downloaded_size": 0
-                    }
-                    
-                    self.root.after(0, lambda: self.update_progress(10, f"Found {total_files} files ({self.format_size(total_size)}) - Starting download..."))
-                    
-                    # Download the directory recursively
-                    self._download_directory_recursive(remote_path, local_path)
-                    
-                    # Add directory to downloads list
-                    download_info = {
-                        "filename": dirname,
-                        "local_path": local_path,
-                        "remote_path": remote_path,
-                        "size": total_size,
-                        "timestamp": datetime.datetime.now(),
-                        "is_directory": True
-                    }
-                    self.downloads.append(download_info)
-                    
-                    # Final UI updates
-                    self.root.after(0, lambda: self.update_downloads_list())
-                    self.root.after(0, lambda: self.update_progress(100, f"Downloaded directory {dirname} successfully ({total_files} files)"))
-                    
-                except Exception as e:
-                    self.root.after(0, lambda error=str(e): messagebox.showerror("Download Error", f"Failed to download directory {dirname}: {error}"))
-                    self.root.after(0, lambda: self.update_progress(0, "Download failed"))
+        # Read a large file from the current directory as the benchmark sample
+        samples = [entry for entry in self.listing_items
+                   if not entry.is_dir and not entry.is_link and (entry.st_size or 0) >= TUNE_MIN_SAMPLE_SIZE]
+        if not samples:
+            messagebox.showwarning("Auto-tune", "Open a directory containing a file of at least "
+                                   f"{self.format_size(TUNE_MIN_SAMPLE_SIZE)} to benchmark with.")
+            return
+        sample = max(samples, key=lambda entry: entry.st_size)
+        sample_path = self.normalize_path(self.current_path, sample.filename)
+        sample_size = min(sample.st_size, TUNE_SAMPLE_SIZE)
+        connection = self.connection
 
-            threading.Thread(target=download_thread, daemon=True).start()
+        def on_result(profile, rate):
+            result = f"{self.format_size(rate)}/s" if rate else "failed"
+            self.ui_bus.post(self.update_progress, 0, f"Auto-tune: {profile.describe()}: {result}")
 
-        except Exception as e:
-            messagebox.showerror("Download Error", f"Failed to initiate directory download of {dirname}: {e}")
+        def tune_thread():
+            try:
+                profile, rate = autotune(connection.hostname, connection.port, connection.username,
+                                         connection.password, sample_path, sample_size, on_result=on_result)
+                self.tuning_store.put(connection.key, profile, rate)
+                summary = f"Fastest for {connection.key}: {profile.describe()} at {self.format_size(rate)}/s"
+                self.ui_bus.post(self.update_progress, 100, summary)
+                self.ui_bus.post(lambda: messagebox.showinfo("Auto-tune Complete",
+                    f"{summary}\n\nUsed for new connections with the \"{AUTO_PROFILE}\" profile."))
+            except Exception as e:
+                self.ui_bus.post(lambda error=str(e): messagebox.showerror("Auto-tune Error", f"Auto-tune failed: {error}"))
+                self.ui_bus.post(self.update_progress, 0, "Auto-tune failed")
 
-    def scan_directory_structure(self, remote_path):
-        """Scan directory structure to get total files and size"""
-        total_files = 0
-        total_size = 0
-        file_list = []
-        
-        def scan_recursive(path):
-            nonlocal total_files, total_size
+        self.update_progress(0, f"Auto-tuning with {sample.filename}...")
+        threading.Thread(target=tune_thread, daemon=True).start()
+
+    def open_stats_panel(self):
+        """Show per-operation timings of SFTP calls, local writes and UI updates"""
+        dialog = ThemedToplevel(self.root)
+        dialog.title("Performance Stats")
+        dialog.transient(self.root)
+        dialog.geometry("760x360")
+
+        frame = ttk.Frame(dialog, padding=12)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        controls = ttk.Frame(frame)
+        controls.pack(fill=tk.X, pady=(0, 8))
+
+        enabled = tk.BooleanVar(value=METRICS.enabled)
+
+        def toggle():
+            METRICS.enabled = enabled.get()
+
+        ttk.Checkbutton(controls, text="Record metrics", variable=enabled, command=toggle).pack(side=tk.LEFT)
+        ttk.Button(controls, text="Reset", command=METRICS.reset).pack(side=tk.LEFT, padx=(8, 0))
+        ttk.Button(controls, text="Save JSON...", command=self.save_metrics).pack(side=tk.LEFT, padx=(8, 0))
+
+        log_text = tk.StringVar()
+
+        def toggle_log():
+            if METRICS.log_path:
+                METRICS.stop_log()
+            else:
+                path = filedialog.asksaveasfilename(parent=dialog, title="Log metrics to...",
+                                                    defaultextension=".jsonl", initialfile="sftp_metrics.jsonl")
+                if not path:
+                    return
+                METRICS.start_log(path)
+                enabled.set(True)
+            log_text.set("Stop Log" if METRICS.log_path else "Log to File...")
+
+        log_text.set("Stop Log" if METRICS.log_path else "Log to File...")
+        ttk.Button(controls, textvariable=log_text, command=toggle_log).pack(side=tk.LEFT, padx=(8, 0))
+
+        columns = ("count", "p50", "p95", "p99", "max", "total", "rate", "errors")
+        table = ttk.Treeview(frame, columns=columns, show="tree headings")
+        table.heading("#0", text="Operation", anchor="c")
+        table.column("#0", width=150, anchor="w")
+        for column, text in zip(columns, ("Count", "p50", "p95", "p99", "Max", "Total", "Rate", "Errors")):
+            table.heading(column, text=text, anchor="c")
+            table.column(column, width=70, anchor="e")
+        table.pack(fill=tk.BOTH, expand=True)
+
+        def milliseconds(seconds):
+            return f"{seconds * 1000:.1f} ms"
+
+        def rate(operation, stats):
+            # Listings count entries and UI drains count updates instead of bytes
+            if not stats['bytes']:
+                return ""
+            if operation.startswith("sftp.listdir"):
+                return f"{stats['bytes_per_second']:.0f} entries/s"
+            if operation.startswith("ui."):
+                return f"{stats['bytes_per_second']:.0f} updates/s"
+            return f"{self.format_size(stats['bytes_per_second'])}/s"
+
+        def refresh():
+            if not dialog.winfo_exists():
+                return
+            snapshot = METRICS.snapshot()
+            for item in table.get_children():
+                if item not in snapshot:
+                    table.delete(item)
+            for operation, stats in snapshot.items():
+                values = (stats['count'], milliseconds(stats['p50_seconds']), milliseconds(stats['p95_seconds']),
+                          milliseconds(stats['p99_seconds']), milliseconds(stats['max_seconds']),
+                          f"{stats['total_seconds']:.2f} s", rate(operation, stats), stats['errors'])
+                if table.exists(operation):
+                    table.item(operation, values=values)
+                else:
+                    table.insert("", tk.END, iid=operation, text=operation, values=values)
+            dialog.after(1000, refresh)
+
+        refresh()
+
+    def save_metrics(self):
+        """Write the current metrics snapshot to a JSON file"""
+        path = filedialog.asksaveasfilename(title="Save metrics as...", defaultextension=".json",
+                                            initialfile="sftp_metrics.json")
+        if not path:
+            return
+        try:
+            METRICS.dump(path)
+        except OSError as e:
+            messagebox.showerror("Save Error", f"Failed to save metrics: {e}")
+
+    def _submit_download(self, label, target, priority=0):
+        """Queue target(job, connection) as a job holding a lease on the current connection
+
+        Jobs keep using the connection they started on, even after the browser
+        has moved on to another server.
+        """
+        connection = self.connection.lease()
+
+        def run(job):
             try:
-                items = self.sftp.listdir_attr(path)
-                for item in items:
-                    item_path = self.normalize_path(path, item.filename)
-                    
-                    if stat.S_ISDIR(item.st_mode):
-                        # It's a directory, scan recursively
-                        scan_recursive(item_path)
+                target(job, connection)
+            finally:
+                connection.release()
+
+        return self.scheduler.submit(label, run, priority)
+
+    def _create_downloader(self, settings, job, connection, filename=None, verifier=None):
+        """Create a parallel downloader for a job that reports into the progress bar"""
+        return ParallelDownloader(connection.open_channel, progress_callback=self._job_progress(job, filename),
+                                  job=job, file_callback=verifier.submit if verifier else None,
+                                  throttle=self.bandwidth.throttle(job.id), **settings)
+
+    def _create_uploader(self, settings, job, connection, request_size, filename=None):
+        """Create a parallel uploader for a job that reports into the progress bar"""
+        return ParallelUploader(connection.open_channel, request_size=request_size, resume_key=connection.key,
+                                progress_callback=self._job_progress(job, filename, "Uploading"), job=job,
+                                throttle=self.bandwidth.throttle(job.id), **settings)
+
+    def _job_progress(self, job, filename=None, action="Downloading"):
+        """Progress callback of a transfer job, updating its row and the progress bar"""
+        def progress_callback(stats):
+            job.update_stats(stats)
+            # Coalesced with the other progress of this job into one update per frame
+            self.ui_bus.post_progress(f"job{job.id}", show_progress, stats['downloaded_size'],
+                                      stats['total_size'], dict(stats))
+
+        def show_progress(stats, rate, eta):
+            speed = f" · {self.format_size(rate)}/s" if rate else ""
+            if eta is not None and stats['input_complete']:
+                speed += f" · {self.format_duration(eta)} left"
+
+            if filename:
+                # Single file: show bytes of that file only
+                total = stats['total_size']
+                progress = (stats['downloaded_size'] / total) * 100 if total > 0 else 0
+                self.update_progress(progress, f"{action} {filename}: "
+                                     f"{self.format_size(stats['downloaded_size'])}/{self.format_size(total)}{speed}")
+                return
+
+            if stats['total_size'] > 0:
+                progress = (stats['downloaded_size'] / stats['total_size']) * 90 + 10
+            else:
+                progress = 90
+
+            # Totals are still growing while the scan runs
+            more = "" if stats['input_complete'] else "+"
+            files_progress = f"{stats['downloaded_files']}/{stats['total_files']}{more}"
+            size_progress = f"{self.format_size(stats['downloaded_size'])}/{self.format_size(stats['total_size'])}{more}"
+
+            self.update_progress(progress, f"{action}: {files_progress} files, {size_progress}{speed}")
+
+        return progress_callback
+
+    def _create_verifier(self, connection):
+        """Verifier checking the files of a job against digests computed on its connection"""
+        connection.ensure_connected()
+        return IntegrityVerifier(connection.transport, connection.open_channel)
+
+    def _verify_downloads(self, downloader, verifier, label):
+        """Check the files of a finished downloader, fetching mismatched ones again
+
+        Returns all failed tasks, mismatches included, and a summary like ", 12 verified".
+        """
+        self.ui_bus.post(self.update_progress, 100, f"Verifying {label}...")
+        verify_downloads(downloader, verifier)
+        stats = verifier.stats
+        summary = f", {stats['verified']} verified" if stats['verified'] else ""
+        if stats['unverified']:
+            summary += f", {stats['unverified']} not verifiable"
+        return downloader.failed, summary
+
+    def _queue_directory(self, job, connection, downloader, remote_path, local_path, workers, manifest=None):
+        """Scan a remote directory and feed its files to a running downloader as they are found
+
+        Returns the scanned tree, the tasks queued and the tasks skipped as unchanged.
+        """
+        scanner = TreeScanner(connection.open_channel, workers=workers)
+        job.add_cancel_hook(scanner.cancel)
+        return feed_tree(scanner, downloader, remote_path, local_path, manifest)
+
+    def _stream_directory(self, job, connection, downloader, remote_path, local_path, workers):
+        """Download a directory as one tar stream over SSH exec
+
+        Returns the tasks extracted or failed, or None if the server refused
+        exec and the directory has to go through the SFTP engine.
+        """
+        connection.ensure_connected()
+        self.ui_bus.post(self.update_progress, 10, f"Streaming {remote_path} as tar...")
+        streamer = TarStreamDownloader(connection.transport, connection.open_channel, downloader, job, workers)
+        try:
+            extracted, failed = streamer.download(remote_path, local_path)
+        except TarRefused as e:
+            print(f"Bulk mode unavailable for {remote_path}, using SFTP: {e}")
+            return None
+        return extracted + failed
+
+    def _start_batch_download(self, items, local_dir, show_summary=False):
+        """Download listing entries of the current directory using the parallel engine
+
+        Directories are scanned while their files are already downloading, so
+        the totals shown grow until the scan is complete.
+        """
+        base_path = self.current_path
+        settings = self.get_transfer_settings()
+        sync = self.sync_mode.get()
+        bulk = self.bulk_mode.get()
+        verify = self.verify_mode.get()
+        label = items[0].filename if len(items) == 1 else f"{len(items)} items"
+
+        def download_job(job, connection):
+            downloader = None
+            try:
+                self.ui_bus.post(self.update_progress, 5, f"Scanning {label}...")
+
+                verifier = self._create_verifier(connection) if verify else None
+                downloader = self._create_downloader(settings, job, connection, verifier=verifier)
+                has_directories = any(entry.is_dir or entry.is_link for entry in items)
+                downloader.start(None if has_directories else min(settings['workers'], len(items)))
+
+                tasks = []
+                entries = []
+                manifests = []
+                skipped = []
+                for entry in items:
+                    name = entry.filename
+                    remote_path = self.normalize_path(base_path, name)
+                    local_path = os.path.join(local_dir, name)
+
+                    if entry.is_link or (entry.st_size is None and not entry.is_dir):
+                        # Only links and entries not taken from the listing need a stat
+                        entry = ListingEntry.from_attributes(connection.sftp.stat(remote_path), name)
+                    is_directory = entry.is_dir
+
+                    # Bulk mode does not know what is unchanged, so sync always uses SFTP
+                    item_tasks = None
+                    if is_directory and bulk and not sync:
+                        item_tasks = self._stream_directory(job, connection, downloader, remote_path,
+                                                            local_path, settings['workers'])
+                        size = sum(task.size for task in item_tasks or [])
+
+                    if item_tasks is not None:
+                        pass
+                    elif is_directory:
+                        manifest = SyncManifest(remote_path, local_path) if sync else None
+                        tree, item_tasks, unchanged = self._queue_directory(
+                            job, connection, downloader, remote_path, local_path, settings['workers'], manifest)
+                        size = tree.total_size
+                        skipped.extend(unchanged)
+                        if manifest is not None:
+                            manifests.append((manifest, item_tasks))
                     else:
-                        # It's a file
-                        total_files += 1
-                        total_size += item.st_size
-                        file_list.append((item_path, item.st_size))
+                        size = entry.st_size
+                        item_tasks = [TransferTask(remote_path, local_path, size, entry.st_mtime)]
+                        downloader.add(item_tasks)
+
+                    tasks.extend(item_tasks)
+                    entries.append({
+                        'filename': name,
+                        'local_path': local_path,
+                        'remote_path': remote_path,
+                        'size': size,
+                        'is_directory': is_directory
+                    })
+
+                downloader.close_input()
+                failed = downloader.wait()
+                verified_text = ""
+                if verifier is not None and not job.cancelled:
+                    failed, verified_text = self._verify_downloads(downloader, verifier, label)
+                if job.cancelled:
+                    self.ui_bus.post(self.update_progress, 0, f"Cancelled download of {label}")
+                    return
+                failed_paths = {task.remote_path for task in failed}
+
+                total_size = sum(task.size for task in tasks)
+                skipped_size = sum(task.size for task in skipped)
+                skipped_text = f", {len(skipped)} unchanged ({self.format_size(skipped_size)}) skipped" if skipped else ""
+
+                for manifest, manifest_tasks in manifests:
+                    manifest.record(task for task in manifest_tasks if task.remote_path not in failed_paths)
+                    manifest.save()
+
+                # Add finished items to the download history
+                finished = [entry for entry in entries
+                            if entry['is_directory'] or entry['remote_path'] not in failed_paths]
+                self.ui_bus.post(self.show_new_downloads, self.history.add(finished))
+
+                # Final UI updates
+                downloaded = len(tasks) - len(failed)
+                if failed:
+                    failed_list = "\n".join(sorted(failed_paths)[:10])
+                    self.ui_bus.post(self.update_progress, 100, f"Downloaded {label} with errors ({downloaded}/{len(tasks)} files)")
+                    self.ui_bus.post(lambda: messagebox.showerror("Download Error",
+                        f"Failed to download {len(failed)} of {len(tasks)} files:\n{failed_list}"))
+                    return
+
+                self.ui_bus.post(self.update_progress, 100, f"Downloaded {label} successfully ({downloaded} files{skipped_text}{verified_text})")
+                if show_summary:
+                    local_path = entries[0]['local_path']
+                    summary = f"Saved to:\n{local_path}\n\nFiles downloaded: {downloaded}\nTotal size: {self.format_size(total_size)}"
+                    if skipped:
+                        summary += f"\nUnchanged files skipped: {len(skipped)} ({self.format_size(skipped_size)})"
+                    if verifier is not None:
+                        summary += f"\nChecksums verified: {verifier.stats['verified']} of {downloaded}"
+                    self.ui_bus.post(lambda: messagebox.showinfo("Download Complete", summary))
+
+                    # Reset progress after a delay
+                    self.ui_bus.post(self.root.after, 3000, lambda: self.update_progress(0, "Ready"))
+
             except Exception as e:
-                print(f"Error scanning {path}: {e}")
-        
-        scan_recursive(remote_path)
-        return total_files, total_size, file_list
+                if downloader is not None:
+                    downloader.cancel()
+                    downloader.wait()
+                if job.cancelled:
+                    self.ui_bus.post(self.update_progress, 0, f"Cancelled download of {label}")
+                    return
+                self.ui_bus.post(lambda error=str(e): messagebox.showerror("Download Error", f"Failed to download {label}: {error}"))
+                self.ui_bus.post(self.update_progress, 0, "Download failed")
+                raise
+
+        self._submit_download(label, download_job)
+
+    def show_upload_menu(self):
+        self.upload_menu.post(self.upload_btn.winfo_rootx(),
+                              self.upload_btn.winfo_rooty() + self.upload_btn.winfo_height())
+
+    def upload_files(self):
+        """Upload local files into the current remote directory"""
+        if not self.connection:
+            return
+        paths = filedialog.askopenfilenames(title="Choose files to upload...")
+        if paths:
+            self._start_upload(list(paths))
+
+    def upload_folder(self):
+        """Upload a local folder, with everything in it, into the current remote directory"""
+        if not self.connection:
+            return
+        path = filedialog.askdirectory(title="Choose folder to upload...")
+        if path:
+            self._start_upload([path])
+
+    def _start_upload(self, local_paths):
+        """Upload local files and folders into the current directory as one transfer job
+
+        In sync mode, files whose remote copy has the same size and
+        modification time are skipped. The directory is listed again once
+        the upload is done.
+        """
+        remote_dir = self.current_path
+        settings = self.get_transfer_settings()
+        request_size = self._read_int_setting(self.upload_request_kb, UPLOAD_REQUEST_SIZE // 1024,
+                                              MIN_REQUEST_SIZE // 1024, UPLOAD_REQUEST_SIZE // 1024) * 1024
+        sync = self.sync_mode.get()
+        names = [os.path.basename(os.path.normpath(path)) for path in local_paths]
+        label = names[0] if len(names) == 1 else f"{len(names)} items"
+        single_file = len(local_paths) == 1 and not os.path.isdir(local_paths[0])
+
+        def upload_job(job, connection):
+            uploader = None
+            try:
+                self.ui_bus.post(self.update_progress, 5, f"Uploading {label}...")
+                uploader = self._create_uploader(settings, job, connection, request_size,
+                                                 filename=label if single_file else None)
+                uploader.start(1 if single_file else None)
+
+                tasks = []
+                skipped = []
+                directories = []
+                for local_path, name in zip(local_paths, names):
+                    remote_path = self.normalize_path(remote_dir, name)
+                    if os.path.isdir(local_path):
+                        remote_state = None
+                        if sync:
+                            scanner = TreeScanner(connection.open_channel, workers=settings['workers'])
+                            job.add_cancel_hook(scanner.cancel)
+                            remote_state = scan_remote_state(scanner, remote_path)
+                        item_tasks, unchanged, item_directories = feed_local_tree(
+                            uploader, local_path, remote_path, remote_state)
+                        tasks.extend(item_tasks)
+                        skipped.extend(unchanged)
+                        directories.extend(item_directories)
+                        continue
+
+                    local = os.stat(local_path)
+                    task = TransferTask(remote_path, local_path, local.st_size, local.st_mtime)
+                    if sync:
+                        try:
+                            remote = connection.sftp.stat(remote_path)
+                            if remote.st_size == task.size and int(remote.st_mtime or 0) == int(task.mtime):
+                                skipped.append(task)
+                                continue
+                        except FileNotFoundError:
+                            pass
+                    uploader.add([task])
+                    tasks.append(task)
+
+                uploader.close_input()
+                failed = uploader.wait()
+                if not job.cancelled:
+                    uploader.make_directories(directories)
+                self.ui_bus.post(self._uploads_finished, connection.key, remote_dir, directories)
+                if job.cancelled:
+                    self.ui_bus.post(self.update_progress, 0, f"Cancelled upload of {label}")
+                    return
+
+                uploaded = len(tasks) - len(failed)
+                skipped_size = sum(task.size for task in skipped)
+                skipped_text = f", {len(skipped)} unchanged ({self.format_size(skipped_size)}) skipped" if skipped else ""
+                if failed:
+                    failed_list = "\n".join(sorted(task.local_path for task in failed)[:10])
+                    self.ui_bus.post(self.update_progress, 100, f"Uploaded {label} with errors ({uploaded}/{len(tasks)} files)")
+                    self.ui_bus.post(lambda: messagebox.showerror("Upload Error",
+                        f"Failed to upload {len(failed)} of {len(tasks)} files:\n{failed_list}"))
+                    return
+                self.ui_bus.post(self.update_progress, 100, f"Uploaded {label} successfully ({uploaded} files{skipped_text})")
+                self.ui_bus.post(self.root.after, 3000, lambda: self.update_progress(0, "Ready"))
+
+            except Exception as e:
+                if uploader is not None:
+                    uploader.cancel()
+                    uploader.wait()
+                if job.cancelled:
+                    self.ui_bus.post(self.update_progress, 0, f"Cancelled upload of {label}")
+                    return
+                self.ui_bus.post(lambda error=str(e): messagebox.showerror("Upload Error", f"Failed to upload {label}: {error}"))
+                self.ui_bus.post(self.update_progress, 0, "Upload failed")
+                raise
+
+        self._submit_download(f"⬆ {label}", upload_job)
+
+    def _uploads_finished(self, host, remote_dir, directories=()):
+        """Forget the listings an upload changed, and list the directory again if it is on screen
+
+        directories are the remote directories of uploaded folders, which
+        files were written to or which were created.
+        """
+        for cache in (self.listing_cache, self.prefetch_cache):
+            cache.invalidate(host)
+        self.listing_store.invalidate_paths(host, [remote_dir, *directories])
+        if host == self.connection_key and remote_dir == self.current_path and self.active_search is None:
+            self.load_directory(force=True)
+
+    def scan_directory_structure(self, remote_path, workers=DEFAULT_SCAN_WORKERS, on_directory=None):
+        """Scan a remote directory tree with concurrent listings and return it as a RemoteTree"""
+        return TreeScanner(self.open_sftp_channel, workers=workers).scan(remote_path, on_directory)
 
     def download_directory(self, dirname):
         """Download an entire directory with improved progress tracking"""
-        if not self.sftp:
+        if not self.connection:
             return
 
         try:
@@ -873,114 +1981,14 @@ class SFTPBrowser:
             if not local_dir:
                 return
 
-            # Create local directory
-            local_path = os.path.join(local_dir, dirname)
-            os.makedirs(local_path, exist_ok=True)
-
-            # Remote directory path
-            remote_path = self.normalize_path(self.current_path, dirname)
-
-            # Start download in separate thread
-            def download_thread():
-                try:
-                    # First, scan the directory structure
-                    self.root.after(0, lambda: self.update_progress(5, f"Scanning directory {dirname}..."))
-                    
-                    total_files, total_size, file_list = self.scan_directory_structure(remote_path)
-                    
-                    # Initialize download stats
-                    self.download_stats = {
-                        'total_files': total_files,
-                        'downloaded_files': 0,
-                        'total_size': total_size,
-                        'downloaded_size': 0
-                    }
-                    
-                    self.root.after(0, lambda: self.update_progress(10, f"Found {total_files} files ({self.format_size(total_size)}) - Starting download..."))
-                    
-                    # Download the directory recursively
-                    self._download_directory_recursive(remote_path, local_path)
-                    
-                    # Add directory to downloads list
-                    download_info = {
-                        'filename': dirname,
-                        'local_path': local_path,
-                        'remote_path': remote_path,
-                        'size': total_size,
-                        'timestamp': datetime.datetime.now(),
-                        'is_directory': True
-                    }
-                    self.downloads.append(download_info)
-                    
-                    # Final UI updates
-                    self.root.after(0, lambda: self.update_downloads_list())
-                    self.root.after(0, lambda: self.update_progress(100, f"Downloaded directory {dirname} successfully ({total_files} files)"))
-                    self.root.after(0, lambda: messagebox.showinfo("Download Complete", 
-                        f"Directory saved to:\n{local_path}\n\nFiles downloaded: {total_files}\nTotal size: {self.format_size(total_size)}"))
-                    
-                    # Reset progress after a delay
-                    self.root.after(3000, lambda: self.update_progress(0, "Ready"))
-                    
-                except Exception as e:
-                    self.root.after(0, lambda error=str(e): messagebox.showerror("Download Error", f"Failed to download directory: {error}"))
-                    self.root.after(0, lambda: self.update_progress(0, "Download failed"))
-
-            threading.Thread(target=download_thread, daemon=True).start()
+            self._start_batch_download([ListingEntry(dirname, stat.S_IFDIR)], local_dir, show_summary=True)
 
         except Exception as e:
             messagebox.showerror("Download Error", f"Failed to initiate directory download: {e}")
 
-    def _download_directory_recursive(self, remote_dir, local_dir):
-        """Recursively download directory contents with proper progress tracking"""
-        try:
-            # Ensure local directory exists
-            os.makedirs(local_dir, exist_ok=True)
-            
-            # List directory contents
-            items = self.sftp.listdir_attr(remote_dir)
-            
-            for item in items:
-                remote_item_path = self.normalize_path(remote_dir, item.filename)
-                local_item_path = os.path.join(local_dir, item.filename)
-                
-                if stat.S_ISDIR(item.st_mode):
-                    # It's a directory, create it locally and recurse
-                    os.makedirs(local_item_path, exist_ok=True)
-                    self._download_directory_recursive(remote_item_path, local_item_path)
-                else:
-                    # It's a file, download it
-                    try:
-                        def progress_callback(transferred, total):
-                            # Update stats
-                            if transferred == total:
-                                self.download_stats['downloaded_files'] += 1
-                                self.download_stats['downloaded_size'] += total
-                                
-                                # Update progress bar
-                                if self.download_stats['total_size'] > 0:
-                                    progress = (self.download_stats['downloaded_size'] / self.download_stats['total_size']) * 90 + 10
-                                else:
-                                    progress = 90
-                                
-                                files_progress = f"{self.download_stats['downloaded_files']}/{self.download_stats['total_files']}"
-                                size_progress = f"{self.format_size(self.download_stats['downloaded_size'])}/{self.format_size(self.download_stats['total_size'])}"
-                                
-                                self.root.after(0, lambda p=progress, fp=files_progress, sp=size_progress: 
-                                    self.update_progress(p, f"Downloading: {fp} files, {sp}"))
-                        
-                        # Download the file
-                        self.sftp.get(remote_item_path, local_item_path, callback=progress_callback)
-                        
-                    except Exception as e:
-                        print(f"Error downloading {remote_item_path}: {e}")
-                        # Continue with other files even if one fails
-                        
-        except Exception as e:
-            raise Exception(f"Error downloading directory {remote_dir}: {e}")
-
-    def download_file(self, filename):
-        """Download a file from the server"""
-        if not self.sftp:
+    def download_file(self, filename, entry=None):
+        """Download a file from the server, using the listing entry for its size if given"""
+        if not self.connection:
             return
 
         try:
@@ -990,90 +1998,233 @@ class SFTPBrowser:
             # Choose local save location
             local_path = filedialog.asksaveasfilename(
                 title="Save file as...",
-                initialfile=filename,
+                initialfile=os.path.basename(filename),
                 defaultextension=""
             )
             
             if not local_path:
                 return
 
-            # Start download in separate thread
-            def download_thread():
+            settings = self.get_transfer_settings()
+            verify = self.verify_mode.get()
+
+            # Queue the download as a job, ahead of bulk transfers
+            def download_job(job, connection):
                 try:
                     # Get file size for progress tracking
-                    file_attrs = self.sftp.stat(remote_path)
+                    file_attrs = entry if entry is not None and entry.st_size is not None else connection.sftp.stat(remote_path)
                     file_size = file_attrs.st_size
                     
-                    self.root.after(0, lambda: self.update_progress(0, f"Downloading {filename}..."))
+                    self.ui_bus.post(self.update_progress, 0, f"Downloading {filename}...")
+
+                    # Large files are split into segments by the engine
+                    verifier = self._create_verifier(connection) if verify else None
+                    downloader = self._create_downloader(settings, job, connection, filename=filename, verifier=verifier)
+                    failed = downloader.run([TransferTask(remote_path, local_path, file_size, file_attrs.st_mtime)])
+                    verified_text = ""
+                    if verifier is not None and not job.cancelled and not failed:
+                        failed, verified_text = self._verify_downloads(downloader, verifier, filename)
+                    if job.cancelled:
+                        self.ui_bus.post(self.update_progress, 0, f"Cancelled download of {filename}")
+                        return
+                    if failed:
+                        raise Exception(failed[0].error)
                     
-                    def progress_callback(transferred, total):
-                        if total > 0:
-                            progress = (transferred / total) * 100
-                            self.root.after(0, lambda: self.update_progress(
-                                progress, 
-                                f"Downloading {filename}: {self.format_size(transferred)}/{self.format_size(total)}"
-                            ))
-
-                    # Download file with progress callback
-                    self.sftp.get(remote_path, local_path, callback=progress_callback)
-                    
-                    # Add to downloads list
+                    # Add to the download history
                     download_info = {
                         'filename': filename,
                         'local_path': local_path,
                         'remote_path': remote_path,
                         'size': file_size,
-                        'timestamp': datetime.datetime.now(),
                         'is_directory': False
                     }
-                    self.downloads.append(download_info)
                     
                     # Update downloads sidebar
-                    self.root.after(0, lambda: self.update_downloads_list())
-                    self.root.after(0, lambda: self.update_progress(100, f"Downloaded {filename} successfully"))
-                    self.root.after(0, lambda: messagebox.showinfo("Download Complete", f"File saved to:\n{local_path}"))
+                    self.ui_bus.post(self.show_new_downloads, self.history.add([download_info]))
+                    self.ui_bus.post(self.update_progress, 100, f"Downloaded {filename} successfully{verified_text}")
+                    self.ui_bus.post(lambda: messagebox.showinfo("Download Complete", f"File saved to:\n{local_path}"))
                     
                     # Reset progress after a delay
-                    self.root.after(3000, lambda: self.update_progress(0, "Ready"))
+                    self.ui_bus.post(self.root.after, 3000, lambda: self.update_progress(0, "Ready"))
                     
                 except Exception as e:
-                    self.root.after(0, lambda error=str(e): messagebox.showerror("Download Error", f"Failed to download file: {error}"))
+                    self.ui_bus.post(lambda error=str(e): messagebox.showerror("Download Error", f"Failed to download file: {error}"))
+                    raise
 
-            threading.Thread(target=download_thread, daemon=True).start()
+            self._submit_download(filename, download_job, priority=1)
 
         except Exception as e:
             messagebox.showerror("Download Error", f"Failed to initiate download: {e}")
 
-    def update_downloads_list(self):
-        """Update the downloads list in sidebar"""
-        # Clear existing items
-        for item in self.downloads_tree.get_children():
-            self.downloads_tree.delete(item)
-
-        # Add downloads to the tree (most recent first)
-        for download in reversed(self.downloads):
-            # Get just the filename from the local path
-            if download.get('is_directory', False):
-                display_name = f"📁 {download['filename']}"
+    def _on_job_changed(self, job):
+        """Called from any thread when a job changes; the transfers panel is redrawn once per frame"""
+        self.ui_bus.post_latest("transfers", self.update_transfers_list)
+        if job.finished:
+            self.ui_bus.discard(f"job{job.id}")
+            self.bandwidth.forget(job.id)
+
+    def _format_job_progress(self, job):
+        stats = job.stats
+        total_size = stats.get('total_size', 0)
+        if not total_size:
+            return ""
+        percent = stats.get('downloaded_size', 0) / total_size * 100
+        return f"{percent:.0f}% · {stats.get('downloaded_files', 0)}/{stats.get('total_files', 0)}"
+
+    def update_transfers_list(self):
+        """Update the transfer job rows in place"""
+        jobs = list(self.scheduler.jobs)
+        current = {f"job{job.id}" for job in jobs}
+        for item in self.transfers_tree.get_children():
+            if item not in current:
+                self.transfers_tree.delete(item)
+
+        for job in jobs:
+            item = f"job{job.id}"
+            state = job.state if job.priority == 0 else f"{job.state} ({job.priority:+d})"
+            cap = self.bandwidth.job_rate(job.id)
+            if cap and not job.finished:
+                state += f" ≤{self.format_size(cap)}/s"
+            values = (state, self._format_job_progress(job))
+            if self.transfers_tree.exists(item):
+                self.transfers_tree.item(item, values=values)
             else:
-                display_name = f"📄 {os.path.basename(download['local_path'])}"
-            
-            size_str = self.format_size(download['size'])
-            
-            # Check if file/directory still exists
-            if os.path.exists(download['local_path']):
-                icon = ""
+                self.transfers_tree.insert("", tk.END, iid=item, text=job.label, values=values)
+
+    def selected_jobs(self):
+        selected = set(self.transfers_tree.selection())
+        return [job for job in self.scheduler.jobs if f"job{job.id}" in selected]
+
+    def _apply_to_selected_jobs(self, action):
+        for job in self.selected_jobs():
+            action(job)
+
+    def limit_selected_jobs(self):
+        """Ask for a speed cap for the selected jobs; it applies to their running transfers at once"""
+        jobs = [job for job in self.selected_jobs() if not job.finished]
+        if not jobs:
+            return
+        current = self.bandwidth.job_rate(jobs[0].id)
+        text = simpledialog.askstring("Limit Speed", "Maximum speed of the selected transfers\n"
+                                      "(e.g. 2M or 512K; blank for no cap):", parent=self.root,
+                                      initialvalue=f"{current // 1024}K" if current else "")
+        if text is None:
+            return
+        try:
+            rate = parse_rate(text)
+        except ValueError as e:
+            messagebox.showerror("Limit Speed", str(e))
+            return
+        for job in jobs:
+            self.bandwidth.set_job_rate(job.id, rate)
+        self.update_transfers_list()
+
+    def show_transfers_context_menu(self, event):
+        """Show context menu for transfer jobs"""
+        item = self.transfers_tree.identify_row(event.y)
+        if item:
+            if item not in self.transfers_tree.selection():
+                self.transfers_tree.selection_set(item)
+            self.transfers_menu.post(event.x_root, event.y_root)
+
+    def clear_finished_transfers(self):
+        self.scheduler.remove_finished()
+        self.update_transfers_list()
+
+    def _download_row_text(self, record, missing=False):
+        if record.is_directory:
+            display_name = f"📁 {record.filename}"
+        else:
+            display_name = f"📄 {os.path.basename(record.local_path)}"
+        return "❌ " + display_name if missing else display_name
+
+    def _insert_download_rows(self, records, index):
+        for record in records:
+            iid = f"dl{record.id}"
+            if iid in self.download_records:
+                continue
+            self.download_records[iid] = record
+            self.downloads_tree.insert("", index, iid=iid, text=self._download_row_text(record),
+                                       values=(self.format_size(record.size),))
+
+    def show_new_downloads(self, records):
+        """Add rows for downloads that just finished to the top of the sidebar"""
+        self._insert_download_rows(records, 0)
+
+    def load_download_history(self):
+        """Fill the downloads sidebar from the history, newest first, without blocking the UI
+
+        Records are read on a background thread and added one chunk per UI
+        update. Once everything is shown, deleted files are looked for.
+        """
+        cancelled = self._history_cancel
+
+        def append_rows(records):
+            if not cancelled.is_set():
+                self._insert_download_rows(records, tk.END)
+
+        def load_thread():
+            try:
+                for records in self.history.iter_chunks():
+                    if cancelled.is_set():
+                        return
+                    self.ui_bus.post(append_rows, records)
+            except Exception as e:
+                print(f"Error loading download history: {e}")
+            self.ui_bus.post(self.check_downloads_exist)
+
+        threading.Thread(target=load_thread, daemon=True).start()
+
+    def check_downloads_exist(self):
+        """Mark rows whose local file is gone, checking in batches on a background thread
+
+        Runs again every EXISTS_CHECK_INTERVAL seconds; only rows whose state changed are redrawn.
+        """
+        if self._checking_downloads:
+            return
+        self._checking_downloads = True
+        records = list(self.download_records.values())
+        cancelled = self._history_cancel
+
+        def on_batch(batch, missing):
+            self.ui_bus.post(self._mark_missing_downloads, batch, missing)
+
+        def check_thread():
+            try:
+                check_exists(records, on_batch, cancelled)
+            finally:
+                self.ui_bus.post(self._downloads_checked)
+
+        threading.Thread(target=check_thread, daemon=True).start()
+
+    def _downloads_checked(self):
+        self._checking_downloads = False
+        self.root.after(EXISTS_CHECK_INTERVAL * 1000, self.check_downloads_exist)
+
+    def _mark_missing_downloads(self, batch, missing):
+        for record in batch:
+            iid = f"dl{record.id}"
+            is_missing = record.id in missing
+            if iid not in self.download_records or is_missing == (record.id in self.missing_downloads):
+                continue
+            if is_missing:
+                self.missing_downloads.add(record.id)
             else:
-                icon = "❌ "
-                display_name = icon + display_name
-            
-            self.downloads_tree.insert("", tk.END, text=display_name, values=(size_str,))
+                self.missing_downloads.discard(record.id)
+            self.downloads_tree.item(iid, text=self._download_row_text(record, is_missing))
 
     def clear_downloads(self):
         """Clear downloads list"""
         if messagebox.askyesno("Clear Downloads", "Remove all files from downloads list?"):
-            self.downloads.clear()
-            self.update_downloads_list()
+            # Chunks still being loaded or checked are dropped
+            self._history_cancel.set()
+            self._history_cancel = threading.Event()
+            self.history.clear()
+            rows = self.downloads_tree.get_children()
+            if rows:
+                self.downloads_tree.delete(*rows)
+            self.download_records.clear()
+            self.missing_downloads.clear()
 
     def show_downloads_context_menu(self, event):
         """Show context menu for downloads"""
@@ -1083,17 +2234,11 @@ class SFTPBrowser:
             self.downloads_menu.post(event.x_root, event.y_root)
 
     def get_selected_download(self):
-        """Get the selected download item"""
+        """Get the history record of the selected row"""
         selection = self.downloads_tree.selection()
         if not selection:
             return None
-        
-        # Get the index of the selected item (reversed order)
-        selected_index = len(self.downloads) - 1 - self.downloads_tree.index(selection[0])
-        
-        if 0 <= selected_index < len(self.downloads):
-            return self.downloads[selected_index]
-        return None
+        return self.download_records.get(selection[0])
 
     def open_downloaded_file(self, event=None):
         """Open downloaded file with default application"""
@@ -1101,7 +2246,7 @@ class SFTPBrowser:
         if not download:
             return
 
-        local_path = download['local_path']
+        local_path = download.local_path
         
         if os.path.exists(local_path):
             try:
@@ -1122,7 +2267,7 @@ class SFTPBrowser:
         if not download:
             return
 
-        local_path = download['local_path']
+        local_path = download.local_path
         
         if os.path.exists(local_path):
             try:
@@ -1144,8 +2289,11 @@ class SFTPBrowser:
         if not download:
             return
 
-        self.downloads.remove(download)
-        self.update_downloads_list()
+        self.history.remove([download.id])
+        iid = f"dl{download.id}"
+        self.download_records.pop(iid, None)
+        self.missing_downloads.discard(download.id)
+        self.downloads_tree.delete(iid)
 
     def initial_connect(self):
         """Check for initial connection from command line"""
@@ -1158,16 +2306,15 @@ class SFTPBrowser:
 
     def on_closing(self):
         """Handle application closing"""
-        if self.sftp:
-            try:
-                self.sftp.close()
-            except:
-                pass
-        if self.transport:
-            try:
-                self.transport.close()
-            except:
-                pass
+        for job in list(self.scheduler.jobs):
+            self.scheduler.cancel(job)
+        METRICS.stop_log()
+        shutdown_hash_pool()
+        if self.prefetcher:
+            self.prefetcher.close()
+        self.connection_pool.close_all()
+        self.history.close()
+        self.listing_store.close()
         self.root.destroy()
 
 def main():
@@ -0,0 +1,116 @@
+import queue
+import threading
+import time
+from collections import deque
+
+from sftp_metrics import METRICS
+
+# The Tk loop drains the bus this often
+UI_FRAME_INTERVAL = 0.05
+# Longest a single drain may run before the rest waits for the next frame
+UI_FRAME_BUDGET = 0.03
+# Throughput and ETA are averaged over this many seconds of progress
+RATE_WINDOW = 5.0
+
+
+class ThroughputMeter:
+    """Transfer rate over a sliding window of (time, bytes done) samples"""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self._samples = deque()
+
+    def add(self, done, now=None):
+        now = time.monotonic() if now is None else now
+        # Paused files give their bytes back; start measuring again from here
+        if self._samples and done < self._samples[-1][1]:
+            self._samples.clear()
+        self._samples.append((now, done))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+
+    def rate(self):
+        """Bytes per second over the window, or 0 until there are two samples"""
+        if len(self._samples) < 2:
+            return 0.0
+        (start, start_done), (end, end_done) = self._samples[0], self._samples[-1]
+        if end <= start:
+            return 0.0
+        return (end_done - start_done) / (end - start)
+
+    def eta(self, remaining):
+        """Seconds until remaining bytes are done at the current rate, or None if unknown"""
+        rate = self.rate()
+        if rate <= 0:
+            return None
+        return max(0.0, remaining) / rate
+
+
+class UpdateBus:
+    """Thread-safe queue of UI updates, drained by the Tk loop at a fixed frame rate
+
+    Worker threads post without blocking and never touch Tk themselves.
+    post() delivers every call in order. post_latest() and post_progress()
+    keep only the newest update per key, so a flood of progress events costs
+    one redraw per frame; it runs in the place of the first pending post.
+    """
+
+    def __init__(self, rate_window=RATE_WINDOW):
+        self.rate_window = rate_window
+        self._queue = queue.SimpleQueue()
+        self._latest = {}
+        self._meters = {}
+        self._lock = threading.Lock()
+
+    def post(self, func, *args):
+        """Run func(*args) on the Tk thread"""
+        self._queue.put((func, args))
+
+    def post_latest(self, key, func, *args):
+        """Run func(*args) on the Tk thread, replacing any pending update with the same key"""
+        with self._lock:
+            pending = key in self._latest
+            self._latest[key] = (func, args)
+        if not pending:
+            self._queue.put((None, key))
+
+    def post_progress(self, key, func, done, total, *args):
+        """Like post_latest, calling func(*args, rate, eta) with throughput and ETA over the window
+
+        done and total are byte counts; every post is sampled, even the ones
+        that get coalesced away.
+        """
+        with self._lock:
+            meter = self._meters.get(key)
+            if meter is None:
+                meter = self._meters[key] = ThroughputMeter(self.rate_window)
+            meter.add(done)
+            rate, eta = meter.rate(), meter.eta(total - done)
+        self.post_latest(key, func, *args, rate, eta)
+
+    def discard(self, key):
+        """Forget the throughput samples of key once its transfer is over"""
+        with self._lock:
+            self._meters.pop(key, None)
+
+    def drain(self, budget=UI_FRAME_BUDGET):
+        """Run queued updates until the queue is empty or budget seconds have passed"""
+        start = time.perf_counter()
+        deadline = time.monotonic() + budget
+        updates = 0
+        while time.monotonic() < deadline:
+            try:
+                func, args = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if func is None:
+                with self._lock:
+                    func, args = self._latest.pop(args)
+            updates += 1
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Error in UI update: {e}")
+        if updates:
+            # Time spent redrawing; updates are counted in place of bytes
+            METRICS.record("ui.drain", time.perf_counter() - start, updates)
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+
+from sftp_tuning import APP_DIR
+
+HISTORY_FILE = os.path.join(APP_DIR, "downloads.sqlite3")
+
+# Records handed to the sidebar per UI update while the history loads
+HISTORY_LOAD_CHUNK = 1000
+# Local paths checked for existence before the results are reported
+EXISTS_BATCH = 500
+# Seconds between background checks for downloads deleted since
+EXISTS_CHECK_INTERVAL = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    local_path TEXT NOT NULL,
+    remote_path TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    timestamp REAL NOT NULL,
+    is_directory INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_COLUMNS = "id, filename, local_path, remote_path, size, timestamp, is_directory"
+
+
+class DownloadRecord:
+    """One finished download in the history"""
+    __slots__ = ("id", "filename", "local_path", "remote_path", "size", "timestamp", "is_directory")
+
+    def __init__(self, id, filename, local_path, remote_path, size, timestamp, is_directory):
+        self.id = id
+        self.filename = filename
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.size = size
+        self.timestamp = timestamp
+        self.is_directory = bool(is_directory)
+
+
+class DownloadHistory:
+    """Finished downloads kept in SQLite, newest first
+
+    Safe to use from any thread; downloads are recorded by the transfer
+    threads and read by the UI. Ids grow with every download, so the
+    primary key doubles as the recency index.
+    """
+
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(_SCHEMA)
+
+    def add(self, entries):
+        """Record downloads, given as dicts like the listing entries, and return their records"""
+        records = []
+        now = time.time()
+        with self._lock, self._db:
+            for entry in entries:
+                values = (entry['filename'], entry['local_path'], entry['remote_path'], entry.get('size') or 0,
+                          entry.get('timestamp', now), int(entry.get('is_directory', False)))
+                cursor = self._db.execute(
+                    "INSERT INTO downloads (filename, local_path, remote_path, size, timestamp, is_directory) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", values)
+                records.append(DownloadRecord(cursor.lastrowid, *values))
+        return records
+
+    def recent(self, limit=HISTORY_LOAD_CHUNK, before_id=None):
+        """Up to limit records, newest first, older than before_id if given"""
+        with self._lock:
+            if before_id is None:
+                rows = self._db.execute(f"SELECT {_COLUMNS} FROM downloads ORDER BY id DESC LIMIT ?", (limit,))
+            else:
+                rows = self._db.execute(f"SELECT {_COLUMNS} FROM downloads WHERE id < ? ORDER BY id DESC LIMIT ?",
+                                        (before_id, limit))
+            return [DownloadRecord(*row) for row in rows.fetchall()]
+
+    def iter_chunks(self, chunk_size=HISTORY_LOAD_CHUNK):
+        """Every record, newest first, in lists of up to chunk_size"""
+        before_id = None
+        while True:
+            records = self.recent(chunk_size, before_id)
+            if not records:
+                return
+            yield records
+            before_id = records[-1].id
+
+    def remove(self, record_ids):
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM downloads WHERE id = ?", [(record_id,) for record_id in record_ids])
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM downloads")
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM downloads").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def check_exists(records, on_batch, cancelled=None, batch_size=EXISTS_BATCH):
+    """Check which records' local paths still exist, reporting each batch as it is done
+
+    on_batch(batch, missing_ids) is called with the records checked and the
+    ids of those whose local file or directory is gone. Meant to run on a
+    background thread; cancelled is an optional threading.Event.
+    """
+    for start in range(0, len(records), batch_size):
+        if cancelled is not None and cancelled.is_set():
+            return
+        batch = records[start:start + batch_size]
+        missing = {record.id for record in batch if not os.path.exists(record.local_path)}
+        on_batch(batch, missing)
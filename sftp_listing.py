@@ -0,0 +1,572 @@
+import json
+import os
+import sqlite3
+import stat
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+from sftp_transfer import TransferTask, close_channels, open_channels, remote_to_local
+from sftp_tuning import APP_DIR
+
+# Listings older than this are fetched again on the next visit
+DEFAULT_CACHE_TTL = 60.0
+DEFAULT_CACHE_ENTRIES = 256
+
+# Listings of every host are also kept on disk, least recently used ones
+# evicted beyond LISTING_STORE_MAX_BYTES of compressed data
+LISTING_STORE_FILE = os.path.join(APP_DIR, "listings.sqlite3")
+LISTING_STORE_MAX_BYTES = 64 * 1024 * 1024
+
+# Subdirectories of the directory on screen listed ahead of a visit, kept in
+# a cache of their own that holds PREFETCH_CACHE_ENTRIES listings
+DEFAULT_PREFETCH_DIRS = 8
+PREFETCH_CACHE_ENTRIES = 64
+# Prefetching gives up on directories with more entries than this
+PREFETCH_MAX_ENTRIES = 5000
+
+# Streaming listings hand entries over in batches of this size, or sooner once
+# LISTING_FLUSH_INTERVAL seconds have passed since the last batch
+LISTING_BATCH_SIZE = 1000
+LISTING_FLUSH_INTERVAL = 0.1
+
+# Tree scans list this many directories at once, each on its own channel
+DEFAULT_SCAN_WORKERS = 6
+# Directories waiting in the shared scan queue before workers descend on their own
+MAX_SCAN_FRONTIER = 10000
+
+
+def join_remote(parent, name):
+    """Join a remote directory and an entry name with exactly one slash"""
+    return parent.rstrip("/") + "/" + name
+
+
+class ListingEntry:
+    """Compact record of one directory entry, with the field names of SFTPAttributes"""
+    __slots__ = ("filename", "st_mode", "st_size", "st_mtime")
+
+    def __init__(self, filename, st_mode=0, st_size=None, st_mtime=None):
+        self.filename = filename
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+
+    @classmethod
+    def from_attributes(cls, attr, filename=None):
+        return cls(filename or attr.filename, attr.st_mode or 0, attr.st_size, attr.st_mtime)
+
+    @property
+    def is_dir(self):
+        return stat.S_ISDIR(self.st_mode)
+
+    @property
+    def is_link(self):
+        return stat.S_ISLNK(self.st_mode)
+
+
+def stream_listing(sftp, path, on_batch, is_cancelled=None,
+                   batch_size=LISTING_BATCH_SIZE, flush_interval=LISTING_FLUSH_INTERVAL):
+    """List path with listdir_iter, passing ListingEntry batches to on_batch as they arrive
+
+    Returns the complete listing, or None if is_cancelled() became true first.
+    listdir_iter leaves unread replies behind when it is abandoned, so after a
+    cancelled listing the channel must be closed rather than reused.
+    """
+    items = []
+    batch = []
+    last_flush = 0.0
+    for attr in sftp.listdir_iter(path):
+        if is_cancelled is not None and is_cancelled():
+            return None
+        entry = ListingEntry.from_attributes(attr)
+        items.append(entry)
+        batch.append(entry)
+        now = time.monotonic()
+        if len(batch) >= batch_size or now - last_flush >= flush_interval:
+            on_batch(batch)
+            batch = []
+            last_flush = now
+    if batch:
+        on_batch(batch)
+    return items
+
+
+class ListingCache:
+    """Bounded LRU cache of directory listings keyed by host and path, with a time-to-live"""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # (host, path) -> (time stored, listing)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, host, path):
+        """Return the cached listing, or None if it is missing or expired"""
+        key = (host, path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, host, path, listing):
+        key = (host, path)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), listing)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def contains(self, host, path):
+        """True if a listing is cached and fresh, without counting a hit or miss"""
+        with self._lock:
+            entry = self._entries.get((host, path))
+            return entry is not None and time.monotonic() - entry[0] <= self.ttl
+
+    def invalidate(self, host, path=None):
+        """Drop one cached listing, or every listing of host when path is None"""
+        with self._lock:
+            if path is not None:
+                self._entries.pop((host, path), None)
+                return
+            for key in [key for key in self._entries if key[0] == host]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class ListingStore:
+    """Directory listings of every host kept on disk across sessions
+
+    Listings are stored compressed, keyed by host and path, and shown at
+    once on the next visit while a fresh listing is fetched. Once the stored
+    data exceeds max_bytes, the least recently used listings are evicted.
+    """
+
+    def __init__(self, path=LISTING_STORE_FILE, max_bytes=LISTING_STORE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS listings (
+                    host TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    used REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (host, path)
+                );
+                CREATE INDEX IF NOT EXISTS listings_used ON listings (used);
+            """)
+            self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM listings").fetchone()[0]
+
+    def get(self, host, path):
+        """Return (listing, time fetched), or (None, None) if the listing was never stored"""
+        with self._lock, self._db:
+            row = self._db.execute("SELECT fetched, data FROM listings WHERE host = ? AND path = ?",
+                                   (host, path)).fetchone()
+            if row is None:
+                return None, None
+            self._db.execute("UPDATE listings SET used = ? WHERE host = ? AND path = ?", (time.time(), host, path))
+        fetched, data = row
+        try:
+            rows = json.loads(zlib.decompress(data))
+            return [ListingEntry(*row) for row in rows], fetched
+        except (zlib.error, ValueError, TypeError) as e:
+            print(f"Error reading stored listing of {path}: {e}")
+            self.invalidate(host, path)
+            return None, None
+
+    def put(self, host, path, listing):
+        rows = [(entry.filename, entry.st_mode, entry.st_size, entry.st_mtime) for entry in listing]
+        data = zlib.compress(json.dumps(rows, separators=(",", ":")).encode("utf-8"), 1)
+        if len(data) > self.max_bytes // 4:
+            # One huge directory must not push out everything else
+            self.invalidate(host, path)
+            return
+        now = time.time()
+        with self._lock, self._db:
+            old = self._db.execute("SELECT size FROM listings WHERE host = ? AND path = ?", (host, path)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO listings (host, path, fetched, used, size, data) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (host, path, now, now, len(data), data))
+            self._total += len(data) - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def invalidate(self, host, path=None):
+        """Drop one stored listing, or every listing of host when path is None"""
+        with self._lock, self._db:
+            if path is None:
+                self._db.execute("DELETE FROM listings WHERE host = ?", (host,))
+            else:
+                self._db.execute("DELETE FROM listings WHERE host = ? AND path = ?", (host, path))
+            self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM listings").fetchone()[0]
+
+    def invalidate_paths(self, host, paths):
+        """Drop the stored listings of several paths of host at once"""
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM listings WHERE host = ? AND path = ?", [(host, path) for path in paths])
+            self._total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM listings").fetchone()[0]
+
+    def recent_children(self, host, parent):
+        """Return {path: time last shown} of the stored listings directly below parent"""
+        prefix = parent.rstrip("/") + "/"
+        with self._lock:
+            # Paths starting with prefix sort between prefix and prefix + U+10FFFF
+            rows = self._db.execute("SELECT path, used FROM listings WHERE host = ? AND path > ? AND path < ?",
+                                    (host, prefix, prefix + "\U0010ffff")).fetchall()
+        return {path: used for path, used in rows if "/" not in path[len(prefix):]}
+
+    def stats(self):
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+            return {'entries': count, 'bytes': self._total, 'max_bytes': self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict(self):
+        """Delete least recently used listings until the store is a tenth below its cap"""
+        target = self.max_bytes * 9 // 10
+        rows = self._db.execute("SELECT host, path, size FROM listings ORDER BY used")
+        doomed = []
+        for host, path, size in rows.fetchall():
+            if self._total <= target:
+                break
+            doomed.append((host, path))
+            self._total -= size
+        self._db.executemany("DELETE FROM listings WHERE host = ? AND path = ?", doomed)
+
+
+class ListingPrefetcher:
+    """Lists the subdirectories of the directory on screen before they are opened
+
+    Runs one listing at a time on a channel of its own, so it never has more
+    than one request in flight next to the browser's. Subdirectories shown
+    most recently according to the listing store go first, then the rest in
+    display order, up to max_dirs. A new prefetch() or cancel() drops what
+    is left of the previous one, and nothing is listed while is_busy() is
+    true, e.g. while a transfer is running.
+    """
+
+    def __init__(self, open_channel, cache, store=None, max_dirs=DEFAULT_PREFETCH_DIRS, is_busy=None,
+                 max_entries=PREFETCH_MAX_ENTRIES):
+        self.open_channel = open_channel
+        self.cache = cache
+        self.store = store
+        self.max_dirs = max_dirs
+        self.is_busy = is_busy
+        self.max_entries = max_entries
+        self.fetched = 0
+        self._request = None
+        self._generation = 0
+        self._closed = False
+        self._thread = None
+        self._sftp = None
+        self._cond = threading.Condition()
+
+    def prefetch(self, host, parent, names):
+        """Replace any pending work with listing the subdirectories called names of parent"""
+        with self._cond:
+            if self._closed:
+                return
+            self._generation += 1
+            self._request = (self._generation, host, parent, list(names))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def cancel(self):
+        """Stop prefetching; a listing in progress is abandoned after its current entry"""
+        with self._cond:
+            self._generation += 1
+            self._request = None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._generation += 1
+            self._request = None
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._request is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                generation, host, parent, names = self._request
+                self._request = None
+
+            def is_stale():
+                return generation != self._generation or (self.is_busy is not None and self.is_busy())
+
+            for path in self._plan(host, parent, names):
+                if is_stale():
+                    break
+                if self.cache.contains(host, path):
+                    continue
+                items = self._list(path, is_stale)
+                if items is not None:
+                    self.cache.put(host, path, items)
+                    self.fetched += 1
+        self._close_channel()
+
+    def _plan(self, host, parent, names):
+        """Paths to list, most recently shown first"""
+        paths = [join_remote(parent, name) for name in names]
+        used = {}
+        if self.store is not None:
+            try:
+                used = self.store.recent_children(host, parent)
+            except Exception as e:
+                print(f"Error reading the listing store: {e}")
+        # sorted() is stable, so unvisited directories keep their display order
+        return sorted(paths, key=lambda path: -used.get(path, 0))[:self.max_dirs]
+
+    def _list(self, path, is_stale):
+        count = [0]
+
+        def on_batch(batch):
+            count[0] += len(batch)
+
+        def is_cancelled():
+            return is_stale() or count[0] > self.max_entries
+
+        try:
+            if self._sftp is None:
+                self._sftp = self.open_channel()
+            items = stream_listing(self._sftp, path, on_batch, is_cancelled=is_cancelled)
+        except IOError as e:
+            # Unreadable directories are simply not prefetched
+            print(f"Error prefetching {path}: {e}")
+            return None
+        except Exception as e:
+            print(f"Error prefetching {path}: {e}")
+            self._close_channel()
+            return None
+        if items is None:
+            # listdir_iter left replies behind; the channel cannot be reused
+            self._close_channel()
+            return None
+        items.sort(key=lambda x: (not stat.S_ISDIR(x.st_mode), x.filename.lower()))
+        return items
+
+    def _close_channel(self):
+        if self._sftp is not None:
+            try:
+                self._sftp.close()
+            except Exception:
+                pass
+            self._sftp = None
+
+
+class RemoteTree:
+    """In-memory model of a scanned remote directory tree
+
+    With keep_entries off only the totals are kept, for walks that look at
+    every entry once, such as searches over millions of files.
+    """
+
+    def __init__(self, root, keep_entries=True):
+        self.root = root
+        self.keep_entries = keep_entries
+        # Directory path -> ListingEntry records of its children
+        self.listings = {}
+        # Every directory below root, in the order they were found
+        self.directories = []
+        # (path, size, mtime) of every file below root
+        self.files = []
+        self.total_size = 0
+        self.file_count = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    @property
+    def total_files(self):
+        return self.file_count
+
+    def add_listing(self, path, entries):
+        """Record the entries of one directory and return the paths of its subdirectories"""
+        subdirs = []
+        files = []
+        size = 0
+        for entry in entries:
+            item_path = join_remote(path, entry.filename)
+            if entry.is_dir:
+                subdirs.append(item_path)
+            else:
+                files.append((item_path, entry.st_size or 0, entry.st_mtime))
+                size += entry.st_size or 0
+
+        with self._lock:
+            if self.keep_entries:
+                self.listings[path] = entries
+                self.directories.extend(subdirs)
+                self.files.extend(files)
+            self.file_count += len(files)
+            self.total_size += size
+        return subdirs
+
+
+class TreeScanner:
+    """Breadth-first walk of a remote tree with several listings in flight at once
+
+    Every worker lists directories on its own channel and puts subdirectories
+    on a shared frontier. Once the frontier holds max_frontier paths, workers
+    walk further subdirectories themselves so memory stays bounded on very
+    wide trees.
+    """
+
+    def __init__(self, open_channel, workers=DEFAULT_SCAN_WORKERS, max_frontier=MAX_SCAN_FRONTIER):
+        self.open_channel = open_channel
+        self.workers = max(1, workers)
+        self.max_frontier = max_frontier
+
+        self._cond = threading.Condition()
+        self._cancelled = threading.Event()
+        self._frontier = deque()
+        self._pending = 0
+        self._callback_error = None
+
+    def scan(self, root, on_directory=None, descend=None, keep_entries=True):
+        """Walk the tree below root and return it as a RemoteTree
+
+        on_directory(path, entries) is called from the worker threads for every
+        directory as soon as it has been listed. descend(path), if given,
+        decides for every subdirectory found whether the walk enters it.
+        """
+        tree = RemoteTree(root, keep_entries)
+        self._frontier = deque([root])
+        self._pending = 1
+        self._callback_error = None
+
+        channels = open_channels(self.open_channel, self.workers)
+        threads = [threading.Thread(target=self._worker, args=(sftp, tree, on_directory, descend), daemon=True)
+                   for sftp in channels]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            close_channels(channels)
+
+        if self._callback_error is not None:
+            raise self._callback_error
+        return tree
+
+    def cancel(self):
+        self._cancelled.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _next_directory(self, own):
+        """Take a directory from this worker's own stack or the shared frontier, or None when done"""
+        if own:
+            return own.pop()
+        with self._cond:
+            while not self._frontier and self._pending > 0 and not self._cancelled.is_set():
+                self._cond.wait()
+            if self._cancelled.is_set() or not self._frontier:
+                return None
+            return self._frontier.popleft()
+
+    def _worker(self, sftp, tree, on_directory, descend):
+        own = []
+        while not self._cancelled.is_set():
+            path = self._next_directory(own)
+            if path is None:
+                return
+
+            subdirs = []
+            try:
+                entries = [ListingEntry.from_attributes(attr) for attr in sftp.listdir_attr(path)]
+            except Exception as e:
+                tree.errors.append((path, str(e)))
+                print(f"Error scanning {path}: {e}")
+            else:
+                subdirs = tree.add_listing(path, entries)
+                if descend is not None:
+                    subdirs = [subdir for subdir in subdirs if descend(subdir)]
+                if on_directory is not None:
+                    try:
+                        on_directory(path, entries)
+                    except Exception as e:
+                        self._callback_error = e
+                        self.cancel()
+
+            with self._cond:
+                self._pending += len(subdirs) - 1
+                for subdir in subdirs:
+                    if len(self._frontier) < self.max_frontier:
+                        self._frontier.append(subdir)
+                    else:
+                        own.append(subdir)
+                self._cond.notify_all()
+
+
+def feed_tree(scanner, downloader, remote_root, local_root, manifest=None):
+    """Scan remote_root and queue its files on a running downloader as they are found
+
+    The local directory tree is created as it is scanned, so empty
+    directories are kept too. With a SyncManifest only new or changed files
+    are queued. Returns the scanned tree, the tasks queued and the tasks
+    skipped as unchanged.
+    """
+    queued = []
+    skipped = []
+    lock = threading.Lock()
+
+    def on_directory(path, entries):
+        tasks = []
+        for entry in entries:
+            item_path = join_remote(path, entry.filename)
+            item_local_path = remote_to_local(remote_root, item_path, local_root)
+            if entry.is_dir:
+                os.makedirs(item_local_path, exist_ok=True)
+            else:
+                tasks.append(TransferTask(item_path, item_local_path, entry.st_size or 0, entry.st_mtime))
+
+        with lock:
+            if manifest is not None:
+                tasks, unchanged = manifest.filter(tasks)
+                skipped.extend(unchanged)
+            queued.extend(tasks)
+        downloader.add(tasks)
+
+    os.makedirs(local_root, exist_ok=True)
+    tree = scanner.scan(remote_root, on_directory)
+    return tree, queued, skipped
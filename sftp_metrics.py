@@ -0,0 +1,313 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency histograms use logarithmic buckets: bucket i holds durations up to
+# HISTOGRAM_BASE * HISTOGRAM_GROWTH ** i seconds, about 9% apart
+HISTOGRAM_BASE = 1e-6
+HISTOGRAM_GROWTH = 2 ** 0.125
+HISTOGRAM_BUCKETS = 320
+
+# Seconds between snapshots written to the metrics log
+DEFAULT_LOG_INTERVAL = 5.0
+
+
+class OperationStats:
+    """Count, errors, bytes and a latency histogram of one kind of operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds, nbytes=0, error=False):
+        self.count += 1
+        self.errors += error
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes += nbytes
+        if seconds <= HISTOGRAM_BASE:
+            index = 0
+        else:
+            index = min(HISTOGRAM_BUCKETS - 1, math.ceil(math.log(seconds / HISTOGRAM_BASE, HISTOGRAM_GROWTH)))
+        self.buckets[index] += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of all samples"""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(self.max_seconds, HISTOGRAM_BASE * HISTOGRAM_GROWTH ** index)
+        return self.max_seconds
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_seconds': self.total_seconds,
+            'mean_seconds': self.total_seconds / self.count if self.count else 0.0,
+            'p50_seconds': self.percentile(0.50),
+            'p95_seconds': self.percentile(0.95),
+            'p99_seconds': self.percentile(0.99),
+            'max_seconds': self.max_seconds,
+            'bytes': self.bytes,
+            'bytes_per_second': self.bytes / self.total_seconds if self.total_seconds else 0.0
+        }
+
+
+class Metrics:
+    """Per-operation timers and byte counters, switched on and off at runtime
+
+    While disabled, record() and timer() cost a single attribute check.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._operations = {}
+        self._lock = threading.Lock()
+        self._log_thread = None
+        self._log_stop = threading.Event()
+        self.log_path = None
+
+    def record(self, operation, seconds, nbytes=0, error=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = OperationStats()
+            stats.add(seconds, nbytes, error)
+
+    @contextmanager
+    def timer(self, operation, nbytes=0):
+        """Time the body of a with block as one operation of nbytes"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.record(operation, time.perf_counter() - start, nbytes, error=True)
+            raise
+        self.record(operation, time.perf_counter() - start, nbytes)
+
+    def snapshot(self):
+        """Summary of every operation, sorted by name"""
+        with self._lock:
+            return {operation: stats.summary() for operation, stats in sorted(self._operations.items())}
+
+    def reset(self):
+        with self._lock:
+            self._operations.clear()
+
+    def dump(self, path):
+        """Write a snapshot to path as JSON"""
+        data = {'time': time.time(), 'operations': self.snapshot()}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+
+    def start_log(self, path, interval=DEFAULT_LOG_INTERVAL):
+        """Enable metrics and append a JSON snapshot line to path every interval seconds"""
+        self.stop_log()
+        self.enabled = True
+        self.log_path = path
+        self._log_stop = threading.Event()
+        self._log_thread = threading.Thread(target=self._log_loop, args=(path, interval, self._log_stop), daemon=True)
+        self._log_thread.start()
+
+    def stop_log(self):
+        if self._log_thread is not None:
+            self._log_stop.set()
+            self._log_thread.join()
+            self._log_thread = None
+            self.log_path = None
+
+    def _log_loop(self, path, interval, stop):
+        while True:
+            stopped = stop.wait(interval)
+            try:
+                with open(path, "a") as f:
+                    f.write(json.dumps({'time': time.time(), 'operations': self.snapshot()}) + "\n")
+            except OSError as e:
+                print(f"Error writing metrics log {path}: {e}")
+            if stopped:
+                return
+
+
+# Process-wide metrics shared by the connection pool, the transfer engine and the UI
+METRICS = Metrics(enabled=bool(os.environ.get("SFTP_METRICS")))
+
+
+class InstrumentedFile:
+    """SFTPFile proxy that times reads, writes and closing
+
+    Attributes set on the proxy, such as MAX_REQUEST_SIZE, are set on the file.
+    """
+
+    def __init__(self, remote_file, metrics):
+        object.__setattr__(self, "_file", remote_file)
+        object.__setattr__(self, "_metrics", metrics)
+
+    def read(self, size=None):
+        start = time.perf_counter()
+        data = self._file.read(size)
+        self._metrics.record("sftp.read", time.perf_counter() - start, len(data))
+        return data
+
+    def readv(self, chunks):
+        """Time the wait for every block readv() yields"""
+        iterator = iter(self._file.readv(chunks))
+        while True:
+            start = time.perf_counter()
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return
+            self._metrics.record("sftp.readv", time.perf_counter() - start, len(data))
+            yield data
+
+    def write(self, data):
+        """Pipelined writes only time the sending; their replies are waited for in close()"""
+        start = time.perf_counter()
+        error = False
+        try:
+            self._file.write(data)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self._metrics.record("sftp.write", time.perf_counter() - start, len(data), error)
+
+    def close(self):
+        with self._metrics.timer("sftp.close"):
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._file, name, value)
+
+
+class InstrumentedSFTP:
+    """SFTPClient proxy that times every call and counts the bytes of transfers
+
+    Listings count entries instead of bytes. Anything not wrapped here is
+    passed to the client unchanged.
+    """
+
+    def __init__(self, sftp, metrics=METRICS):
+        self._sftp = sftp
+        self._metrics = metrics
+
+    @property
+    def client(self):
+        return self._sftp
+
+    def _timed(self, operation, func, *args, **kwargs):
+        if not self._metrics.enabled:
+            return func(*args, **kwargs)
+        with self._metrics.timer(operation):
+            return func(*args, **kwargs)
+
+    def stat(self, path):
+        return self._timed("sftp.stat", self._sftp.stat, path)
+
+    def lstat(self, path):
+        return self._timed("sftp.lstat", self._sftp.lstat, path)
+
+    def mkdir(self, path, mode=0o777):
+        return self._timed("sftp.mkdir", self._sftp.mkdir, path, mode)
+
+    def rename(self, oldpath, newpath):
+        return self._timed("sftp.rename", self._sftp.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self._timed("sftp.posix_rename", self._sftp.posix_rename, oldpath, newpath)
+
+    def remove(self, path):
+        return self._timed("sftp.remove", self._sftp.remove, path)
+
+    def utime(self, path, times):
+        return self._timed("sftp.utime", self._sftp.utime, path, times)
+
+    def listdir_attr(self, path="."):
+        """Entries listed are counted in place of bytes"""
+        start = time.perf_counter()
+        error = False
+        items = []
+        try:
+            items = self._sftp.listdir_attr(path)
+            return items
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self._metrics.record("sftp.listdir_attr", time.perf_counter() - start, len(items), error)
+
+    def listdir_iter(self, path=".", read_aheads=50):
+        """Time the whole iteration; entries are counted in place of bytes
+
+        A listing abandoned part way, e.g. because it was superseded, is not an error.
+        """
+        start = time.perf_counter()
+        entries = 0
+        error = False
+        try:
+            for attr in self._sftp.listdir_iter(path, read_aheads):
+                entries += 1
+                yield attr
+        except GeneratorExit:
+            raise
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self._metrics.record("sftp.listdir_iter", time.perf_counter() - start, entries, error)
+
+    def open(self, filename, mode="r", bufsize=-1):
+        remote_file = self._timed("sftp.open", self._sftp.open, filename, mode, bufsize)
+        return InstrumentedFile(remote_file, self._metrics) if self._metrics.enabled else remote_file
+
+    def getfo(self, remotepath, fl, callback=None, **kwargs):
+        transferred = [0]
+
+        def counting_callback(done, total):
+            transferred[0] = done
+            if callback is not None:
+                callback(done, total)
+
+        start = time.perf_counter()
+        error = False
+        try:
+            return self._sftp.getfo(remotepath, fl, callback=counting_callback, **kwargs)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self._metrics.record("sftp.get", time.perf_counter() - start, transferred[0], error)
+
+    def close(self):
+        self._timed("sftp.close_channel", self._sftp.close)
+
+    def __getattr__(self, name):
+        return getattr(self._sftp, name)
@@ -0,0 +1,223 @@
+import threading
+import time
+
+import paramiko
+
+from sftp_metrics import InstrumentedSFTP
+from sftp_tuning import PROFILES
+
+# Seconds between SSH keepalive packets on pooled transports
+DEFAULT_KEEPALIVE = 30
+# Connections nobody uses are closed after this many seconds
+DEFAULT_IDLE_TIMEOUT = 300
+# How often the pool looks for idle connections
+EVICT_INTERVAL = 30
+
+# Raised by a transport that died underneath a request
+CONNECTION_ERRORS = (paramiko.SSHException, EOFError, OSError)
+
+
+def connection_key(hostname, port, username):
+    return f"{username}@{hostname}:{port}"
+
+
+class PooledConnection:
+    """One authenticated transport with a primary SFTP client, reconnected when it dies
+
+    Any number of extra SFTP channels can be opened on the same transport.
+    Every client handed out is wrapped in InstrumentedSFTP for the metrics.
+    Users lease the connection while they need it; the pool only evicts
+    connections without leases.
+    """
+
+    def __init__(self, hostname, port, username, password, keepalive=DEFAULT_KEEPALIVE, profile=None):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.profile = profile or PROFILES["default"]
+        self.key = connection_key(hostname, port, username)
+
+        self.transport = None
+        self._sftp = None
+        self.leases = 0
+        self.last_used = time.monotonic()
+        # Set once the pool dropped this connection; the last release closes it
+        self.retired = False
+        self._lock = threading.RLock()
+
+    @property
+    def alive(self):
+        return self.transport is not None and self.transport.is_active()
+
+    @property
+    def sftp(self):
+        """The primary SFTP client, reconnecting first if the transport has died"""
+        with self._lock:
+            self.ensure_connected()
+            self.last_used = time.monotonic()
+            return self._sftp
+
+    def connect(self):
+        """Open the transport, authenticate and open the primary SFTP client"""
+        with self._lock:
+            self._close_transport()
+            transport = self.profile.create_transport(self.hostname, self.port)
+            try:
+                transport.set_keepalive(self.keepalive)
+                transport.connect(username=self.username, password=self.password)
+                self._sftp = InstrumentedSFTP(paramiko.SFTPClient.from_transport(transport))
+            except Exception:
+                transport.close()
+                raise
+            self.transport = transport
+            self.last_used = time.monotonic()
+
+    def ensure_connected(self):
+        with self._lock:
+            if not self.alive:
+                print(f"Reconnecting to {self.key}")
+                self.connect()
+
+    def open_channel(self):
+        """Open an additional SFTP channel on the shared transport"""
+        with self._lock:
+            self.ensure_connected()
+            self.last_used = time.monotonic()
+            transport = self.transport
+        try:
+            return InstrumentedSFTP(paramiko.SFTPClient.from_transport(transport))
+        except CONNECTION_ERRORS:
+            # The transport died since the check above: reconnect once and retry
+            with self._lock:
+                if self.transport is transport:
+                    self.connect()
+                transport = self.transport
+            return InstrumentedSFTP(paramiko.SFTPClient.from_transport(transport))
+
+    def lease(self):
+        with self._lock:
+            self.leases += 1
+            self.last_used = time.monotonic()
+        return self
+
+    def release(self):
+        with self._lock:
+            self.leases = max(0, self.leases - 1)
+            self.last_used = time.monotonic()
+            if self.retired and self.leases == 0:
+                self._close_transport()
+
+    def idle_for(self, now=None):
+        now = time.monotonic() if now is None else now
+        return 0.0 if self.leases else now - self.last_used
+
+    def close(self):
+        with self._lock:
+            self._close_transport()
+
+    def _close_transport(self):
+        if self._sftp is not None:
+            try:
+                self._sftp.close()
+            except Exception:
+                pass
+            self._sftp = None
+        if self.transport is not None:
+            try:
+                self.transport.close()
+            except Exception:
+                pass
+            self.transport = None
+
+
+class ConnectionPool:
+    """Authenticated connections shared per host, port and user
+
+    get() returns a leased connection, reusing a live one when the password
+    and transport profile match. Released connections stay open with keepalives until they have
+    been idle for idle_timeout seconds.
+    """
+
+    def __init__(self, keepalive=DEFAULT_KEEPALIVE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._closed = threading.Event()
+
+    def get(self, hostname, port, username, password, profile=None):
+        """Return a leased connection to username@hostname:port, connecting if needed"""
+        key = connection_key(hostname, port, username)
+        profile = profile or PROFILES["default"]
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and connection.password != password:
+                # Never hand out a session authenticated with other credentials
+                self._retire(connection)
+                connection = None
+            elif connection is not None and connection.profile.to_dict() != profile.to_dict():
+                self._retire(connection)
+                connection = None
+            if connection is None:
+                connection = PooledConnection(hostname, port, username, password, self.keepalive, profile)
+                self._connections[key] = connection
+            connection.lease()
+            self._start_reaper()
+
+        try:
+            with connection._lock:
+                if not connection.alive:
+                    connection.connect()
+        except Exception:
+            connection.release()
+            with self._lock:
+                if connection.leases == 0 and self._connections.get(key) is connection:
+                    del self._connections[key]
+            raise
+        return connection
+
+    def evict_idle(self):
+        """Close connections that have been idle too long or whose transport died unused"""
+        now = time.monotonic()
+        with self._lock:
+            evicted = [connection for connection in self._connections.values()
+                       if connection.leases == 0
+                       and (connection.idle_for(now) > self.idle_timeout or not connection.alive)]
+            for connection in evicted:
+                del self._connections[connection.key]
+        for connection in evicted:
+            connection.close()
+
+    def _retire(self, connection):
+        del self._connections[connection.key]
+        with connection._lock:
+            connection.retired = True
+            if connection.leases == 0:
+                connection._close_transport()
+
+    def close_all(self):
+        self._closed.set()
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections': len(self._connections),
+                'leased': sum(1 for connection in self._connections.values() if connection.leases)
+            }
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while not self._closed.wait(EVICT_INTERVAL):
+            self.evict_idle()
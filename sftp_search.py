@@ -0,0 +1,226 @@
+import fnmatch
+import re
+import threading
+import time
+
+from sftp_listing import ListingEntry, TreeScanner
+
+# Directories listed at once during a search, each on its own channel
+DEFAULT_SEARCH_WORKERS = 8
+# A search stops once it has found this many matches
+MAX_SEARCH_RESULTS = 100000
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+_SIZE_FILTER = re.compile(r"size([<>])(\d+(?:\.\d+)?)([bkmgt]?)b?$", re.IGNORECASE)
+_AGE = re.compile(r"(\d+(?:\.\d+)?)([smhdw])$", re.IGNORECASE)
+
+
+def _match_segments(segments, parts, prefix=False):
+    """Match path parts against glob segments, where "**" spans any number of directories
+
+    With prefix set, also true if parts is the start of a path that could match.
+    """
+    if not parts:
+        return prefix or all(segment == "**" for segment in segments)
+    if not segments:
+        return False
+    if segments[0] == "**":
+        return (_match_segments(segments[1:], parts, prefix)
+                or _match_segments(segments, parts[1:], prefix))
+    return (fnmatch.fnmatchcase(parts[0], segments[0])
+            and _match_segments(segments[1:], parts[1:], prefix))
+
+
+class SearchQuery:
+    """What a remote search looks for, and which directories it can skip
+
+    Names are compared case-insensitively. A glob containing "/" is matched
+    against the path relative to the search root, segment by segment, and
+    directories that cannot lead to a match are not listed at all; so are
+    directories deeper than max_depth and those matching an exclude glob.
+    """
+
+    def __init__(self, pattern=None, regex=None, min_size=None, max_size=None, newer_than=None,
+                 older_than=None, kind=None, max_depth=None, exclude=()):
+        self.pattern = pattern.lower() if pattern else None
+        self.regex = re.compile(regex, re.IGNORECASE) if regex else None
+        self.min_size = min_size
+        self.max_size = max_size
+        # Modification times as Unix timestamps
+        self.newer_than = newer_than
+        self.older_than = older_than
+        # "f" for files, "d" for directories, None for both
+        self.kind = kind
+        self.max_depth = max_depth
+        self.exclude = [glob.lower() for glob in exclude]
+        self.segments = self.pattern.strip("/").split("/") if self.pattern and "/" in self.pattern else None
+
+    def descend(self, relative_dir):
+        """False if nothing below the directory at this relative path can match"""
+        parts = relative_dir.lower().split("/")
+        if self.max_depth is not None and len(parts) >= self.max_depth:
+            return False
+        if self._excluded(parts[-1]):
+            return False
+        return self.segments is None or _match_segments(self.segments, parts, prefix=True)
+
+    def matches(self, relative_path, entry):
+        """True if the entry at this path relative to the search root is a result"""
+        name = entry.filename.lower()
+        if self._excluded(name):
+            return False
+        if self.kind == "f" and entry.is_dir or self.kind == "d" and not entry.is_dir:
+            return False
+        if self.min_size is not None or self.max_size is not None:
+            if entry.is_dir or entry.st_size is None:
+                return False
+            if self.min_size is not None and entry.st_size < self.min_size:
+                return False
+            if self.max_size is not None and entry.st_size > self.max_size:
+                return False
+        if self.newer_than is not None or self.older_than is not None:
+            if entry.st_mtime is None:
+                return False
+            if self.newer_than is not None and entry.st_mtime < self.newer_than:
+                return False
+            if self.older_than is not None and entry.st_mtime > self.older_than:
+                return False
+        if self.regex is not None and not self.regex.search(relative_path):
+            return False
+        if self.segments is not None:
+            return _match_segments(self.segments, relative_path.lower().split("/"))
+        return self.pattern is None or fnmatch.fnmatchcase(name, self.pattern)
+
+    def _excluded(self, name):
+        return any(fnmatch.fnmatchcase(name, glob) for glob in self.exclude)
+
+
+def parse_size(text):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([bkmgt]?)b?", text.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"not a size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_time(text, now=None):
+    """Timestamp of an age like "7d" or "12h" before now, or of a date like 2024-05-01"""
+    match = _AGE.fullmatch(text.strip())
+    if match:
+        now = time.time() if now is None else now
+        return now - float(match.group(1)) * AGE_UNITS[match.group(2).lower()]
+    try:
+        return time.mktime(time.strptime(text.strip(), "%Y-%m-%d"))
+    except ValueError:
+        raise ValueError(f"not an age or date: {text}")
+
+
+def parse_query(text, now=None):
+    """Build a SearchQuery from the text of the search box
+
+    Words are a name pattern (a glob, or a plain substring) unless they are
+    one of these filters:
+
+        re:REGEX        regular expression searched in the relative path
+        size>10M        size<1G, with B, K, M, G or T units
+        newer:7d        older:2024-01-31, with s, m, h, d or w units or a date
+        type:f          type:d, files or directories only
+        depth:3         list at most this many levels below the search root
+        not:GLOB        skip entries and directories matching GLOB, e.g. not:.git
+    """
+    words = []
+    options = {'exclude': []}
+    for word in text.split():
+        lower = word.lower()
+        size = _SIZE_FILTER.match(word)
+        if lower.startswith("re:"):
+            options['regex'] = word[3:]
+        elif size:
+            key = 'min_size' if size.group(1) == ">" else 'max_size'
+            options[key] = parse_size(size.group(2) + size.group(3))
+        elif lower.startswith("newer:"):
+            options['newer_than'] = parse_time(word[6:], now)
+        elif lower.startswith("older:"):
+            options['older_than'] = parse_time(word[6:], now)
+        elif lower.startswith("type:"):
+            kind = lower[5:6]
+            if kind not in ("f", "d"):
+                raise ValueError(f"type must be f or d: {word}")
+            options['kind'] = kind
+        elif lower.startswith("depth:"):
+            options['max_depth'] = max(1, int(word[6:]))
+        elif lower.startswith("not:"):
+            options['exclude'].append(word[4:])
+        else:
+            words.append(word)
+
+    pattern = " ".join(words)
+    if pattern and not any(char in pattern for char in "*?["):
+        pattern = f"*{pattern}*"
+    if options.get('regex'):
+        try:
+            re.compile(options['regex'])
+        except re.error as e:
+            raise ValueError(f"bad regular expression: {e}")
+    return SearchQuery(pattern or None, **options)
+
+
+class RemoteSearch:
+    """Recursive search below a remote directory with many listings in flight at once
+
+    Matches are handed over directory by directory while the walk goes on,
+    as ListingEntry records named by their path relative to the search root.
+    """
+
+    def __init__(self, open_channel, query, workers=DEFAULT_SEARCH_WORKERS, max_results=MAX_SEARCH_RESULTS):
+        self.query = query
+        self.max_results = max_results
+        self.scanner = TreeScanner(open_channel, workers=workers)
+        self.matches = 0
+        self.directories = 0
+        self._lock = threading.Lock()
+
+    def run(self, root, on_matches, on_progress=None):
+        """Search below root and return the RemoteTree of what was listed
+
+        on_matches(entries) and on_progress(directories, matches) are called
+        from the scanner's threads.
+        """
+        prefix = root.rstrip("/")
+
+        def relative(path):
+            return path[len(prefix):].strip("/")
+
+        def on_directory(path, entries):
+            relative_dir = relative(path)
+            found = []
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.filename}" if relative_dir else entry.filename
+                if self.query.matches(relative_path, entry):
+                    found.append(ListingEntry(relative_path, entry.st_mode, entry.st_size, entry.st_mtime))
+            with self._lock:
+                self.directories += 1
+                found = found[:self.max_results - self.matches]
+                self.matches += len(found)
+                directories, matches = self.directories, self.matches
+            if found:
+                on_matches(found)
+            if on_progress is not None:
+                on_progress(directories, matches)
+            if matches >= self.max_results:
+                self.scanner.cancel()
+
+        return self.scanner.scan(root, on_directory, descend=lambda path: self.query.descend(relative(path)),
+                                 keep_entries=False)
+
+    def cancel(self):
+        self.scanner.cancel()
+
+    @property
+    def cancelled(self):
+        return self.scanner.cancelled
+
+    @property
+    def truncated(self):
+        return self.matches >= self.max_results
@@ -0,0 +1,222 @@
+import os
+import posixpath
+import shlex
+import tarfile
+import threading
+import time
+
+from sftp_listing import TreeScanner
+from sftp_metrics import METRICS
+from sftp_transfer import TransferCancelled, TransferTask, remote_to_local
+
+# Bytes requested from the exec channel per read
+TAR_READ_SIZE = 256 * 1024
+# Lines of remote tar stderr kept for error reports
+TAR_MAX_ERRORS = 1000
+# Raised by the extraction filter; Pythons without filters never raise it
+TAR_FILTER_ERROR = getattr(tarfile, "FilterError", ())
+
+
+class TarRefused(Exception):
+    """The server refused exec or has no tar; download with the SFTP engine instead"""
+
+
+def tar_command(remote_path):
+    """Shell command that writes remote_path as a tar stream, with paths relative to its parent"""
+    parent, name = posixpath.split(remote_path.rstrip("/"))
+    return f"tar -C {shlex.quote(parent or '/')} -cf - {shlex.quote(name)}"
+
+
+class _ChannelReader:
+    """File-like view of an exec channel's stdout for tarfile's streaming mode
+
+    Reading blocks while the job is paused, which lets the SSH window fill
+    up and stalls the remote tar until the job is resumed.
+    """
+
+    def __init__(self, channel, job=None, cancelled=None, consume=None):
+        self.channel = channel
+        self.job = job
+        self.cancelled = cancelled
+        # Called with the size of every read, and blocks while over the bandwidth limit
+        self.consume = consume
+        self.received = 0
+
+    def read(self, size=TAR_READ_SIZE):
+        while self.job is not None and self.job.paused and not self.job.cancelled:
+            time.sleep(0.1)
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise TransferCancelled()
+        start = time.perf_counter()
+        data = self.channel.recv(size)
+        METRICS.record("tar.recv", time.perf_counter() - start, len(data))
+        self.received += len(data)
+        if self.consume is not None:
+            self.consume(len(data))
+        return data
+
+
+class TarStreamDownloader:
+    """Download a remote directory as one `tar cf -` stream over an SSH exec channel
+
+    One round trip replaces the open/read/close of every file, which is what
+    limits the SFTP engine on trees of many small files. Members are unpacked
+    as they arrive and counted in a ParallelDownloader's stats, so progress
+    and totals show up like any other transfer. Totals come from a tree scan
+    running alongside the stream.
+    """
+
+    def __init__(self, transport, open_channel, downloader, job=None, scan_workers=4):
+        self.transport = transport
+        self.open_channel = open_channel
+        self.downloader = downloader
+        self.job = job
+        self.scan_workers = scan_workers
+        self._cancelled = threading.Event()
+        self._scanner = None
+        # Totals the scan added to the downloader's stats, taken back if tar is refused
+        self._scanned = [0, 0]
+        self._scanned_lock = threading.Lock()
+        if job is not None:
+            job.add_cancel_hook(self.cancel)
+
+    def cancel(self):
+        self._cancelled.set()
+        if self._scanner is not None:
+            self._scanner.cancel()
+
+    def download(self, remote_path, local_path):
+        """Unpack remote_path into local_path and return (tasks extracted, tasks failed)
+
+        Raises TarRefused before anything is written if the server cannot
+        run tar, so the caller can fall back to the SFTP engine.
+        """
+        remote_path = remote_path.rstrip("/") or "/"
+        if remote_path == "/":
+            raise TarRefused("The root directory is always downloaded over SFTP")
+        local_root = os.path.dirname(local_path)
+
+        try:
+            channel = self.transport.open_session()
+            channel.exec_command(tar_command(remote_path))
+        except Exception as e:
+            raise TarRefused(f"exec is not available: {e}")
+
+        errors = []
+        stderr_thread = threading.Thread(target=self._read_errors, args=(channel, remote_path, errors), daemon=True)
+        stderr_thread.start()
+
+        self._scanner = TreeScanner(self.open_channel, workers=self.scan_workers)
+        if self._cancelled.is_set():
+            self._scanner.cancel()
+        scan_thread = threading.Thread(target=self._scan_totals, args=(remote_path,), daemon=True)
+        scan_thread.start()
+
+        reader = _ChannelReader(channel, self.job, self._cancelled, self.downloader.consume_bandwidth)
+        extracted = []
+        acquired = self.job is None or self.job.acquire_slot()
+        try:
+            if not acquired:
+                raise TransferCancelled()
+            try:
+                extracted = self._extract(reader, remote_path, local_root, local_path)
+            except tarfile.ReadError:
+                # An empty stream means tar never ran; anything else is a broken archive
+                if reader.received:
+                    raise
+                self._scanner.cancel()
+            status = channel.recv_exit_status()
+        except BaseException:
+            self.cancel()
+            raise
+        finally:
+            if acquired and self.job is not None:
+                self.job.release_slot()
+            channel.close()
+            stderr_thread.join(timeout=5)
+            scan_thread.join()
+
+        if self._cancelled.is_set():
+            raise TransferCancelled()
+        if not reader.received and status != 0:
+            self.downloader.account(total_files=-self._scanned[0], total_size=-self._scanned[1])
+            message = errors[0][1] if errors else f"tar exited with status {status}"
+            raise TarRefused(message)
+
+        failed = [TransferTask(path, remote_to_local(remote_path, path, local_path), 0) for path, _ in errors]
+        for task, (_, error) in zip(failed, errors):
+            task.error = error
+        if failed:
+            self.downloader.account(failed=failed)
+        return extracted, failed
+
+    def _extract(self, reader, remote_path, local_root, local_path):
+        extracted = []
+        remote_parent = posixpath.dirname(remote_path)
+        # The data filter rejects absolute paths, ".." and links leaving the target
+        extract_args = {'filter': 'data'} if hasattr(tarfile, "data_filter") else {}
+        with tarfile.open(fileobj=reader, mode="r|", bufsize=TAR_READ_SIZE) as archive:
+            for member in archive:
+                remote_member = posixpath.join(remote_parent, member.name)
+                if not extract_args and (member.name.startswith("/") or ".." in member.name.split("/")):
+                    self._skip_unsafe(remote_member, remote_path, local_path, "unsafe path")
+                    continue
+                target = os.path.join(local_root, *member.name.split("/"))
+                try:
+                    start = time.perf_counter()
+                    archive.extract(member, local_root, **extract_args)
+                    METRICS.record("tar.extract", time.perf_counter() - start, member.size)
+                except TAR_FILTER_ERROR as e:
+                    self._skip_unsafe(remote_member, remote_path, local_path, str(e))
+                    continue
+                except BaseException:
+                    # A member cut off mid-stream must not look like a finished file
+                    self._remove_partial(target, member)
+                    raise
+                if member.isfile():
+                    task = TransferTask(remote_member, target, member.size, member.mtime)
+                    task.transferred = member.size
+                    extracted.append(task)
+                    self.downloader.account(downloaded_files=1, downloaded_size=member.size, completed=[task])
+        return extracted
+
+    def _skip_unsafe(self, remote_member, remote_path, local_path, reason):
+        """Members that would land outside the target are reported as failed, not extracted"""
+        print(f"Skipping tar member {remote_member}: {reason}")
+        task = TransferTask(remote_member, remote_to_local(remote_path, remote_member, local_path), 0)
+        task.error = reason
+        self.downloader.account(failed=[task])
+
+    def _remove_partial(self, target, member):
+        if member.isfile():
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+
+    def _read_errors(self, channel, remote_path, errors):
+        """Collect "tar: <path>: <error>" lines from stderr; paths are relative to the parent"""
+        remote_parent = posixpath.dirname(remote_path)
+        for line in channel.makefile_stderr("r"):
+            line = line.strip()
+            if not line:
+                continue
+            print(f"Remote tar: {line}")
+            parts = line.split(": ", 2)
+            if len(parts) == 3 and parts[0] == "tar" and len(errors) < TAR_MAX_ERRORS:
+                errors.append((posixpath.join(remote_parent, parts[1]), parts[2]))
+
+    def _scan_totals(self, remote_path):
+        def on_directory(path, entries):
+            files = [entry for entry in entries if not entry.is_dir]
+            size = sum(entry.st_size or 0 for entry in files)
+            # Called from several scanner threads at once
+            with self._scanned_lock:
+                self._scanned[0] += len(files)
+                self._scanned[1] += size
+            self.downloader.account(total_files=len(files), total_size=size)
+
+        try:
+            self._scanner.scan(remote_path, on_directory)
+        except Exception as e:
+            print(f"Error scanning {remote_path} for totals: {e}")
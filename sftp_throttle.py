@@ -0,0 +1,235 @@
+import re
+import threading
+import time
+
+# A bucket holds at most this many seconds' worth of tokens, the largest burst a limited transfer makes
+BURST_SECONDS = 0.5
+# Jobs that took no tokens for this long give their share of the global limit to the others
+IDLE_AFTER = 1.0
+# Shares are recomputed at least this often, which also picks up schedule changes
+SHARE_INTERVAL = 0.5
+# Longest single sleep while waiting for tokens, so limit changes and cancels apply quickly
+MAX_WAIT = 0.1
+
+RATE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+UNLIMITED = ("", "0", "off", "none", "unlimited")
+
+_RATE = re.compile(r"(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s|ps)?", re.IGNORECASE)
+_WINDOW = re.compile(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\S*)")
+
+
+def parse_rate(text):
+    """Bytes per second of a rate like "10M", "512K/s" or "1.5MB/s"; None for no limit"""
+    text = (text or "").strip()
+    if text.lower() in UNLIMITED:
+        return None
+    match = _RATE.fullmatch(text)
+    if not match:
+        raise ValueError(f"not a rate: {text}")
+    rate = int(float(match.group(1)) * RATE_UNITS[match.group(2).lower()])
+    return rate or None
+
+
+class RateSchedule:
+    """Limits that apply during parts of the day, e.g. "22:00-06:00=off, 09:00-17:00=2M"
+
+    Windows may wrap past midnight. The first window containing the time
+    wins; outside every window the limit set without a schedule applies.
+    """
+
+    def __init__(self, windows=()):
+        # (start minute, end minute, bytes per second or None)
+        self.windows = list(windows)
+
+    @classmethod
+    def parse(cls, text):
+        windows = []
+        for part in (text or "").replace(";", ",").split(","):
+            part = part.strip()
+            if not part:
+                continue
+            match = _WINDOW.fullmatch(part)
+            if not match:
+                raise ValueError(f"not a schedule window (HH:MM-HH:MM=RATE): {part}")
+            start_hour, start_minute, end_hour, end_minute, rate = match.groups()
+            start = int(start_hour) * 60 + int(start_minute)
+            end = int(end_hour) * 60 + int(end_minute)
+            if start >= 24 * 60 or end > 24 * 60:
+                raise ValueError(f"not a time of day: {part}")
+            windows.append((start, end, parse_rate(rate)))
+        return cls(windows)
+
+    def rate_at(self, default, now=None):
+        """The limit in force at now (local time), default if no window contains it"""
+        local = time.localtime(time.time() if now is None else now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in self.windows:
+            if start <= minute < end if start < end else minute >= start or minute < end:
+                return rate
+        return default
+
+    def __bool__(self):
+        return bool(self.windows)
+
+
+class TokenBucket:
+    """Tokens accrue at rate bytes per second, up to BURST_SECONDS worth
+
+    take() never blocks: tokens may go negative, and callers wait until the
+    debt is paid off. A rate of None means no limit.
+    """
+
+    def __init__(self, rate=None, burst_seconds=BURST_SECONDS):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = 0.0
+        self._updated = time.monotonic()
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        if rate is None:
+            self.tokens = 0.0
+        else:
+            self.tokens = min(self.tokens, rate * self.burst_seconds)
+
+    def take(self, amount):
+        self._refill()
+        if self.rate is not None:
+            self.tokens -= amount
+
+    def wait_time(self):
+        """Seconds until the tokens taken so far are paid for"""
+        self._refill()
+        if self.rate is None or self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self._updated) * self.rate, self.rate * self.burst_seconds)
+        self._updated = now
+
+
+class _JobShare:
+    __slots__ = ("bucket", "cap", "last_used")
+
+    def __init__(self, cap=None):
+        self.bucket = TokenBucket()
+        self.cap = cap
+        self.last_used = 0.0
+
+
+class BandwidthLimiter:
+    """Global and per-job transfer rate limits shared by every worker
+
+    Each job draws from a token bucket of its own whose rate is its share of
+    the global limit, split evenly among the jobs transferring right now. A
+    job capped below its share keeps its cap and the rest is split among the
+    others. Shares are recomputed as jobs start and go idle and whenever a
+    limit changes, so new limits apply to transfers already running.
+    """
+
+    def __init__(self, rate=None, schedule=None):
+        self.rate = rate
+        self.schedule = schedule
+        self._jobs = {}
+        self._last_share = 0.0
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self._share(time.monotonic())
+
+    def set_schedule(self, schedule):
+        with self._lock:
+            self.schedule = schedule
+            self._share(time.monotonic())
+
+    def set_job_rate(self, key, rate):
+        with self._lock:
+            self._jobs.setdefault(key, _JobShare()).cap = rate
+            self._share(time.monotonic())
+
+    def job_rate(self, key):
+        """The cap set for a job, None if it has none"""
+        with self._lock:
+            share = self._jobs.get(key)
+            return share.cap if share else None
+
+    def forget(self, key):
+        """Drop a finished job"""
+        with self._lock:
+            if self._jobs.pop(key, None) is not None:
+                self._share(time.monotonic())
+
+    def current_rate(self):
+        """The global limit in force right now, after the schedule"""
+        with self._lock:
+            return self._current_rate()
+
+    def throttle(self, key):
+        return JobThrottle(self, key)
+
+    def consume(self, key, amount, cancelled=None):
+        """Take amount bytes for a job, sleeping until its bucket allows them
+
+        Returns early once cancelled, a threading.Event, is set.
+        """
+        now = time.monotonic()
+        with self._lock:
+            share = self._jobs.get(key)
+            if share is None:
+                share = self._jobs[key] = _JobShare()
+            was_idle = now - share.last_used > IDLE_AFTER
+            share.last_used = now
+            if was_idle or now - self._last_share > SHARE_INTERVAL:
+                self._share(now)
+            share.bucket.take(amount)
+
+        while True:
+            with self._lock:
+                if time.monotonic() - self._last_share > SHARE_INTERVAL:
+                    self._share(time.monotonic())
+                wait = share.bucket.wait_time()
+            if wait <= 0:
+                return
+            if cancelled is not None:
+                if cancelled.wait(min(wait, MAX_WAIT)):
+                    return
+            else:
+                time.sleep(min(wait, MAX_WAIT))
+
+    def _current_rate(self):
+        return self.schedule.rate_at(self.rate) if self.schedule else self.rate
+
+    def _share(self, now):
+        """Split the global limit among the active jobs, smallest caps first"""
+        self._last_share = now
+        rate = self._current_rate()
+        active = [share for share in self._jobs.values() if now - share.last_used <= IDLE_AFTER]
+        if rate is None:
+            for share in active:
+                share.bucket.set_rate(share.cap)
+            return
+        active.sort(key=lambda share: float("inf") if share.cap is None else share.cap)
+        remaining = rate
+        for index, share in enumerate(active):
+            fair = remaining / (len(active) - index)
+            job_rate = fair if share.cap is None else min(share.cap, fair)
+            share.bucket.set_rate(max(1.0, job_rate))
+            remaining -= job_rate
+
+
+class JobThrottle:
+    """A job's handle on the limiter, given to the transfer workers"""
+
+    def __init__(self, limiter, key):
+        self.limiter = limiter
+        self.key = key
+
+    def consume(self, amount, cancelled=None):
+        if amount > 0:
+            self.limiter.consume(self.key, amount, cancelled)
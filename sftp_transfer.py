@@ -0,0 +1,833 @@
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+from sftp_metrics import METRICS
+
+# Number of SFTP channels used for a transfer unless the user picks another value
+DEFAULT_WORKERS = 4
+MAX_WORKERS = 16
+
+# Files transferred at the same time across all jobs, and jobs running at once
+DEFAULT_MAX_TRANSFERS = 8
+DEFAULT_MAX_JOBS = 3
+
+# Files at least this large are split into byte ranges fetched over several channels
+SEGMENT_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_SEGMENTS = 4
+MAX_SEGMENTS = 16
+
+# Each segment reads SEGMENT_WINDOW bytes per readv() call, in SEGMENT_BLOCK_SIZE blocks
+SEGMENT_BLOCK_SIZE = 1024 * 1024
+SEGMENT_WINDOW = 8 * 1024 * 1024
+
+# Downloads land in "<name>.part" and are renamed into place once complete.
+# Files at least RESUME_MIN_SIZE large also get a "<name>.part.json" sidecar
+# recording the remote size, mtime and how far each byte range got.
+PART_SUFFIX = ".part"
+META_SUFFIX = ".json"
+RESUME_MIN_SIZE = 1024 * 1024
+
+# Sync mode keeps this manifest in the root of every downloaded directory
+SYNC_MANIFEST_NAME = ".sftp_sync.json"
+
+
+def open_channels(open_channel, count, required=True):
+    """Open up to count SFTP channels, settling for fewer if the server refuses more"""
+    channels = []
+    for _ in range(count):
+        try:
+            channels.append(open_channel())
+        except Exception as e:
+            if required and not channels:
+                raise
+            print(f"Opened only {len(channels)} of {count} SFTP channels: {e}")
+            break
+    return channels
+
+
+def close_channels(channels):
+    for sftp in channels:
+        try:
+            sftp.close()
+        except Exception:
+            pass
+
+
+class TransferCancelled(Exception):
+    """Raised inside a transfer callback to abort the running get()"""
+
+
+class TransferPaused(Exception):
+    """Raised inside a transfer callback to stop a file of a paused job so it can be requeued"""
+
+
+class TransferTask:
+    """A single remote file to fetch"""
+    __slots__ = ("remote_path", "local_path", "size", "mtime", "transferred", "error")
+
+    def __init__(self, remote_path, local_path, size, mtime=None):
+        self.remote_path = remote_path
+        self.local_path = local_path
+        self.size = size
+        self.mtime = mtime
+        self.transferred = 0
+        self.error = None
+
+
+def remote_to_local(remote_root, remote_path, local_root):
+    """Map a remote path below remote_root to the matching local path below local_root"""
+    relative = remote_path[len(remote_root):].strip("/")
+    if not relative:
+        return local_root
+    return os.path.join(local_root, *relative.split("/"))
+
+
+def split_ranges(size, count):
+    """Split size bytes into at most count contiguous (start, end) ranges"""
+    if size <= 0:
+        return [(0, 0)]
+    count = max(1, min(count, size // SEGMENT_BLOCK_SIZE or 1))
+    step = -(-size // count)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def preallocate_file(path, size):
+    """Create path with size bytes reserved so segments can be written in place"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def read_at(fd, length, offset):
+    """Read length bytes at offset, or fewer at the end of the file, without moving other readers"""
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def write_at(fd, data, offset):
+    """Write all of data at offset without touching other writers of the same file"""
+    start = time.perf_counter()
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # Every segment has its own descriptor, so seeking it is safe
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+    METRICS.record("local.write", time.perf_counter() - start, len(data))
+
+
+class TimedWriter:
+    """Local file wrapper that records each write as local.write, for SFTPClient.getfo"""
+
+    def __init__(self, local_file):
+        self._file = local_file
+
+    def write(self, data):
+        start = time.perf_counter()
+        self._file.write(data)
+        METRICS.record("local.write", time.perf_counter() - start, len(data))
+
+
+class PartialDownload:
+    """The .part file and sidecar record of a resumable download"""
+
+    def __init__(self, task):
+        self.task = task
+        self.part_path = task.local_path + PART_SUFFIX
+        self.meta_path = self.part_path + META_SUFFIX
+        # [start, done, end] for every byte range of the file
+        self.ranges = []
+        self._lock = threading.Lock()
+
+    def open(self, segments):
+        """Pick up a matching partial download or start a fresh one, returning the bytes already present"""
+        meta = self._read_meta()
+        if meta is not None:
+            self.ranges = [list(r) for r in meta['ranges']]
+            return sum(done - start for start, done, end in self.ranges)
+
+        preallocate_file(self.part_path, self.task.size)
+        self.ranges = [[start, start, end] for start, end in split_ranges(self.task.size, segments)]
+        self.save()
+        return 0
+
+    def _read_meta(self):
+        """Return the sidecar if it describes the same remote file as the task"""
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if (meta['remote_path'] != self.task.remote_path
+                    or meta['size'] != self.task.size
+                    or meta['mtime'] != self.task.mtime
+                    or not self._part_matches(meta)):
+                return None
+            return meta
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _part_matches(self, meta):
+        """True if the .part file is still the one the sidecar describes"""
+        return os.path.getsize(self.part_path) == self.task.size
+
+    def mark(self, index, done):
+        """Record that range index is complete up to done"""
+        with self._lock:
+            self.ranges[index][1] = done
+        self.save()
+
+    def save(self):
+        with self._lock:
+            meta = {
+                'remote_path': self.task.remote_path,
+                'size': self.task.size,
+                'mtime': self.task.mtime,
+                'ranges': self.ranges
+            }
+            tmp_path = self.meta_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, self.meta_path)
+
+    def finish(self):
+        """Move the completed file into place and drop the sidecar"""
+        os.replace(self.part_path, self.task.local_path)
+        try:
+            os.remove(self.meta_path)
+        except OSError:
+            pass
+
+
+class SyncManifest:
+    """Remote size and mtime of every file previously synced into a local directory"""
+
+    def __init__(self, remote_root, local_root):
+        self.remote_root = remote_root
+        self.local_root = local_root
+        self.path = os.path.join(local_root, SYNC_MANIFEST_NAME)
+        # Relative remote path -> [size, mtime]
+        self.entries = {}
+        self._seen = set()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get('remote_root') == self.remote_root:
+                self.entries = data.get('files', {})
+        except (OSError, ValueError, AttributeError):
+            self.entries = {}
+
+    def _key(self, task):
+        return task.remote_path[len(self.remote_root):].strip("/")
+
+    def is_current(self, task):
+        """True if the local copy of task already matches the remote file"""
+        try:
+            local = os.stat(task.local_path)
+        except OSError:
+            return False
+        if local.st_size != task.size:
+            return False
+        if self.entries.get(self._key(task)) == [task.size, task.mtime]:
+            return True
+        # Downloads carry the remote mtime, so a matching local mtime means the same version
+        return task.mtime is not None and int(local.st_mtime) == int(task.mtime)
+
+    def filter(self, tasks):
+        """Split tasks into (changed, unchanged) against the local tree"""
+        changed = []
+        unchanged = []
+        for task in tasks:
+            self._seen.add(self._key(task))
+            (unchanged if self.is_current(task) else changed).append(task)
+        # Files already in place are part of the synced state as well
+        self.record(unchanged)
+        return changed, unchanged
+
+    def record(self, tasks):
+        for task in tasks:
+            self.entries[self._key(task)] = [task.size, task.mtime]
+
+    def save(self):
+        """Write the manifest, dropping files that no longer exist remotely"""
+        if self._seen:
+            self.entries = {key: value for key, value in self.entries.items() if key in self._seen}
+        data = {'remote_root': self.remote_root, 'files': self.entries}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+class ParallelDownloader:
+    """Download a batch of files concurrently over several SFTP channels"""
+    # How failures are described in error messages
+    ACTION = "downloading"
+
+    def __init__(self, open_channel, workers=DEFAULT_WORKERS, segments=DEFAULT_SEGMENTS,
+                 segment_threshold=SEGMENT_THRESHOLD, progress_callback=None, progress_interval=0.1,
+                 job=None, file_callback=None, throttle=None):
+        # open_channel returns a new paramiko.SFTPClient each time it is called
+        self.open_channel = open_channel
+        # A TransferJob whose scheduler hands out transfer slots and can pause or cancel us
+        self.job = job
+        if job is not None:
+            job.add_cancel_hook(self.cancel)
+        self.workers = max(1, min(int(workers), MAX_WORKERS))
+        self.segments = max(1, min(int(segments), MAX_SEGMENTS))
+        self.segment_threshold = segment_threshold
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        # Called from the workers with each task once its file is in place
+        self.file_callback = file_callback
+        # Bandwidth limit, anything with consume(amount, cancelled) that blocks until amount may be read
+        self.throttle = throttle
+
+        self.stats = {
+            'total_files': 0,
+            'downloaded_files': 0,
+            'total_size': 0,
+            'downloaded_size': 0,
+            'input_complete': False
+        }
+        self.failed = []
+
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._last_report = 0.0
+
+        # (-size, sequence, task): the largest known file is always fetched next
+        self._queue = queue.PriorityQueue()
+        self._sequence = 0
+        self._channels = []
+        self._threads = []
+
+    def run(self, tasks):
+        """Download all tasks and return the ones that failed"""
+        tasks = list(tasks)
+        if not tasks:
+            self.stats['input_complete'] = True
+            self._report(force=True)
+            return self.failed
+
+        self.start(min(self.workers, len(tasks)))
+        self.add(tasks)
+        self.close_input()
+        return self.wait()
+
+    def start(self, channels=None):
+        """Open the channels and start the workers; tasks are then fed in with add()"""
+        self._channels = open_channels(self.open_channel, channels or self.workers)
+        self._threads = [threading.Thread(target=self._worker, args=(sftp,), daemon=True)
+                         for sftp in self._channels]
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, tasks):
+        """Queue more files while the transfer is running"""
+        with self._lock:
+            for task in tasks:
+                self._sequence += 1
+                self._queue.put((-task.size, self._sequence, task))
+                self.stats['total_files'] += 1
+                self.stats['total_size'] += task.size
+        self._report()
+
+    def account(self, total_files=0, total_size=0, downloaded_files=0, downloaded_size=0, failed=(),
+                completed=()):
+        """Count files transferred outside the workers, e.g. by a tar stream, in the stats
+
+        Tasks in completed are handed to file_callback like the workers' own.
+        """
+        with self._lock:
+            self.stats['total_files'] += total_files
+            self.stats['total_size'] += total_size
+            self.stats['downloaded_files'] += downloaded_files
+            self.stats['downloaded_size'] += downloaded_size
+            self.failed.extend(failed)
+        if self.file_callback:
+            for task in completed:
+                self.file_callback(task)
+        self._report()
+
+    def redownload(self, tasks):
+        """Fetch files that were already downloaded once more, and return all failures so far
+
+        Used after the first pass has finished, e.g. for files that failed verification.
+        """
+        tasks = list(tasks)
+        with self._lock:
+            for task in tasks:
+                self.stats['downloaded_files'] -= 1
+                self.stats['downloaded_size'] -= task.transferred
+                task.transferred = 0
+                task.error = None
+            self.stats['input_complete'] = False
+        self.start(min(self.workers, len(tasks)))
+        with self._lock:
+            for task in tasks:
+                self._sequence += 1
+                self._queue.put((-task.size, self._sequence, task))
+        self.close_input()
+        return self.wait()
+
+    def close_input(self):
+        """No more tasks will be added; workers exit once the queue is drained"""
+        with self._lock:
+            self.stats['input_complete'] = True
+            for _ in self._threads:
+                # Sorts after every real task
+                self._sequence += 1
+                self._queue.put((float("inf"), self._sequence, None))
+
+    def wait(self):
+        """Wait for the workers to finish and return the tasks that failed"""
+        try:
+            for thread in self._threads:
+                thread.join()
+        finally:
+            close_channels(self._channels)
+            self._channels = []
+
+        if self._cancelled.is_set():
+            self._drain_cancelled()
+        self._report(force=True)
+        return self.failed
+
+    def _drain_cancelled(self):
+        """Count the files a cancel left in the queue as failed, so summaries cover them"""
+        with self._lock:
+            while True:
+                try:
+                    task = self._queue.get_nowait()[2]
+                except queue.Empty:
+                    return
+                if task is not None:
+                    task.error = "cancelled"
+                    self.failed.append(task)
+
+    def cancel(self):
+        """Stop handing out new files and abort the ones in flight"""
+        self._cancelled.set()
+        with self._lock:
+            for _ in self._threads:
+                # Sorts before every real task so blocked workers wake up at once
+                self._sequence += 1
+                self._queue.put((float("-inf"), self._sequence, None))
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _worker(self, sftp):
+        while not self._cancelled.is_set():
+            task = self._queue.get()[2]
+            if task is None:
+                return
+            if self.job is None:
+                self._transfer(sftp, task)
+                continue
+
+            # Wait for a global transfer slot; this also blocks while the job is paused
+            if not self.job.acquire_slot():
+                task.error = "cancelled"
+                with self._lock:
+                    self.failed.append(task)
+                return
+            try:
+                self._transfer(sftp, task)
+            finally:
+                self.job.release_slot()
+
+    def _requeue(self, task):
+        with self._lock:
+            self._sequence += 1
+            self._queue.put((-task.size, self._sequence, task))
+
+    def _transfer(self, sftp, task):
+        """Transfer one file on the worker's own channel, keeping the stats and failures up to date"""
+        def progress_callback(transferred, total):
+            if self._cancelled.is_set():
+                raise TransferCancelled()
+            if self.job is not None and self.job.paused:
+                raise TransferPaused()
+            self._add_bytes(task, transferred)
+
+        try:
+            self._copy(sftp, task, progress_callback)
+        except TransferPaused:
+            # Partial data stays in the .part file and is resumed once the job continues
+            with self._lock:
+                self.stats['downloaded_size'] -= task.transferred
+                task.transferred = 0
+            self._requeue(task)
+            return
+        except Exception as e:
+            task.error = "cancelled" if isinstance(e, TransferCancelled) else str(e)
+            with self._lock:
+                # Bytes of a failed file should not count towards the total
+                self.stats['downloaded_size'] -= task.transferred
+                task.transferred = 0
+                self.failed.append(task)
+            if not isinstance(e, TransferCancelled):
+                print(f"Error {self.ACTION} {task.remote_path}: {e}")
+            return
+
+        with self._lock:
+            self.stats['downloaded_files'] += 1
+        if self.file_callback:
+            self.file_callback(task)
+        self._report(force=True)
+
+    def _copy(self, sftp, task, progress_callback):
+        """Download one file into place"""
+        def get_callback(transferred, total):
+            # Blocking here stops reading the channel, so its window closes and the server waits
+            self.consume_bandwidth(transferred - task.transferred)
+            progress_callback(transferred, total)
+
+        os.makedirs(os.path.dirname(task.local_path) or ".", exist_ok=True)
+        if task.size >= RESUME_MIN_SIZE:
+            self._fetch_resumable(sftp, task, progress_callback)
+        else:
+            # Small files are cheaper to fetch again than to resume
+            part_path = task.local_path + PART_SUFFIX
+            with open(part_path, "wb") as local:
+                size = sftp.getfo(task.remote_path, TimedWriter(local), callback=get_callback)
+                if local.tell() != size:
+                    raise IOError(f"size mismatch in get! {local.tell()} != {size}")
+            os.replace(part_path, task.local_path)
+        if task.mtime is not None:
+            # Keep the remote mtime so later syncs can recognise unchanged files
+            os.utime(task.local_path, (task.mtime, task.mtime))
+
+    def _fetch_resumable(self, sftp, task, progress_callback):
+        """Fetch a file into its .part file, continuing a previous attempt where possible
+
+        Files at or above segment_threshold are split into byte ranges that
+        are read concurrently over several channels.
+        """
+        partial = PartialDownload(task)
+        segments = self.segments if task.size >= self.segment_threshold else 1
+        transferred = partial.open(segments)
+        self._copy_ranges(sftp, task, partial, segments, transferred, progress_callback, self._fetch_range)
+        partial.finish()
+
+    def _copy_ranges(self, sftp, task, partial, segments, transferred, progress_callback, copy_range):
+        """Run copy_range for every unfinished byte range of partial, over up to segments channels
+
+        sftp is used for the first range; the others get channels of their own.
+        """
+        progress_callback(transferred, task.size)
+
+        pending = queue.Queue()
+        for index, (start, done, end) in enumerate(partial.ranges):
+            if done < end:
+                pending.put(index)
+
+        lock = threading.Lock()
+        abort = threading.Event()
+        errors = []
+
+        def report(count):
+            nonlocal transferred
+            with lock:
+                transferred += count
+                done = transferred
+            progress_callback(done, task.size)
+
+        def segment_thread(channel):
+            while not abort.is_set():
+                try:
+                    index = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    copy_range(channel, task, partial, index, report, abort)
+                except Exception as e:
+                    abort.set()
+                    errors.append(e)
+
+        extra_channels = open_channels(self.open_channel, min(segments, pending.qsize()) - 1, required=False)
+        threads = [threading.Thread(target=segment_thread, args=(channel,), daemon=True)
+                   for channel in [sftp] + extra_channels]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            close_channels(extra_channels)
+
+        if errors:
+            raise errors[0]
+
+    def _fetch_range(self, sftp, task, partial, index, report, abort):
+        """Copy the unfinished part of one byte range into the same range of the .part file"""
+        start, offset, end = partial.ranges[index]
+        fd = os.open(partial.part_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            with sftp.open(task.remote_path, "rb") as remote:
+                while offset < end and not abort.is_set():
+                    window_end = min(offset + SEGMENT_WINDOW, end)
+                    blocks = [(block, min(SEGMENT_BLOCK_SIZE, window_end - block))
+                              for block in range(offset, window_end, SEGMENT_BLOCK_SIZE)]
+                    for (block, length), data in zip(blocks, remote.readv(blocks)):
+                        if len(data) != length:
+                            raise IOError(f"Short read at offset {block} of {task.remote_path}")
+                        self.consume_bandwidth(length)
+                        write_at(fd, data, block)
+                        report(length)
+                    offset = window_end
+                    partial.mark(index, offset)
+        finally:
+            os.close(fd)
+
+    def consume_bandwidth(self, amount):
+        """Wait until the bandwidth limit allows amount more bytes"""
+        if self.throttle is not None and amount > 0:
+            self.throttle.consume(amount, self._cancelled)
+
+    def _add_bytes(self, task, transferred):
+        with self._lock:
+            self.stats['downloaded_size'] += transferred - task.transferred
+            task.transferred = transferred
+        self._report()
+
+    def _report(self, force=False):
+        """Forward a snapshot of the stats, at most once per progress_interval unless forced"""
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < self.progress_interval:
+                return
+            self._last_report = now
+            snapshot = dict(self.stats)
+        self.progress_callback(snapshot)
+
+
+_job_ids = itertools.count(1)
+
+
+class TransferJob:
+    """One submitted transfer with its own state, priority and stats"""
+    QUEUED = "queued"
+    RUNNING = "running"
+    PAUSED = "paused"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, scheduler, label, target, priority=0):
+        self.id = next(_job_ids)
+        self.label = label
+        self.priority = priority
+        self.state = TransferJob.QUEUED
+        self.stats = {}
+        self.error = None
+
+        self._scheduler = scheduler
+        self._target = target
+        self._thread = None
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._cancelled = threading.Event()
+        self._cancel_hooks = []
+        self._lock = threading.Lock()
+
+    @property
+    def paused(self):
+        return not self._resumed.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def finished(self):
+        return self.state in (TransferJob.DONE, TransferJob.FAILED, TransferJob.CANCELLED)
+
+    def add_cancel_hook(self, hook):
+        """Call hook when the job is cancelled, or right away if it already was"""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._cancel_hooks.append(hook)
+                return
+        hook()
+
+    def update_stats(self, stats):
+        self.stats = stats
+        self._scheduler._changed(self)
+
+    def acquire_slot(self):
+        """Wait for a global transfer slot; False if the job was cancelled meanwhile"""
+        return self._scheduler._acquire(self)
+
+    def release_slot(self):
+        self._scheduler._release()
+
+
+class TransferScheduler:
+    """Runs transfer jobs with priorities, a global cap on concurrent files, pause, resume and cancel
+
+    At most max_jobs jobs run at once; further jobs wait in priority order.
+    Every file a job transfers takes one of max_transfers slots, and waiting
+    files of higher priority jobs get free slots first.
+    """
+
+    def __init__(self, max_transfers=DEFAULT_MAX_TRANSFERS, max_jobs=DEFAULT_MAX_JOBS, on_change=None):
+        self.max_transfers = max(1, max_transfers)
+        self.max_jobs = max(1, max_jobs)
+        # on_change(job) is called from any thread whenever a job changes
+        self.on_change = on_change
+        self.jobs = []
+
+        self._cond = threading.Condition()
+        self._active_transfers = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def submit(self, label, target, priority=0):
+        """Queue target(job) to run as a job and return the job"""
+        job = TransferJob(self, label, target, priority)
+        with self._cond:
+            self.jobs.append(job)
+        self._changed(job)
+        self._start_jobs()
+        return job
+
+    def pause(self, job):
+        with self._cond:
+            if job.finished:
+                return
+            job._resumed.clear()
+            job.state = TransferJob.PAUSED
+            self._cond.notify_all()
+        self._changed(job)
+
+    def resume(self, job):
+        with self._cond:
+            if job.state != TransferJob.PAUSED:
+                return
+            job._resumed.set()
+            job.state = TransferJob.RUNNING if job in self._running() else TransferJob.QUEUED
+            self._cond.notify_all()
+        self._changed(job)
+        self._start_jobs()
+
+    def cancel(self, job):
+        with job._lock:
+            job._cancelled.set()
+            hooks, job._cancel_hooks = job._cancel_hooks, []
+        with self._cond:
+            job._resumed.set()
+            if job.state in (TransferJob.QUEUED, TransferJob.PAUSED) and job not in self._running():
+                job.state = TransferJob.CANCELLED
+            self._cond.notify_all()
+        for hook in hooks:
+            hook()
+        self._changed(job)
+
+    def set_priority(self, job, priority):
+        with self._cond:
+            job.priority = priority
+            self._cond.notify_all()
+        self._changed(job)
+        self._start_jobs()
+
+    def set_max_transfers(self, max_transfers):
+        with self._cond:
+            self.max_transfers = max(1, max_transfers)
+            self._cond.notify_all()
+
+    @property
+    def busy(self):
+        """True while any job is transferring, i.e. running and not paused"""
+        with self._cond:
+            return any(job.state == TransferJob.RUNNING for job in self.jobs)
+
+    def remove_finished(self):
+        with self._cond:
+            self.jobs = [job for job in self.jobs if not job.finished]
+
+    def _running(self):
+        return [job for job in self.jobs if job._thread is not None and not job.finished]
+
+    def _start_jobs(self):
+        """Start the highest priority queued jobs while there is room"""
+        started = []
+        with self._cond:
+            running = len(self._running())
+            queued = [job for job in self.jobs if job.state == TransferJob.QUEUED and job._thread is None]
+            queued.sort(key=lambda job: -job.priority)
+            for job in queued[:max(0, self.max_jobs - running)]:
+                job.state = TransferJob.RUNNING
+                job._thread = threading.Thread(target=self._run_job, args=(job,), daemon=True)
+                started.append(job)
+        for job in started:
+            self._changed(job)
+            job._thread.start()
+
+    def _run_job(self, job):
+        try:
+            job._target(job)
+            state = TransferJob.CANCELLED if job.cancelled else TransferJob.DONE
+        except Exception as e:
+            job.error = str(e)
+            state = TransferJob.CANCELLED if job.cancelled else TransferJob.FAILED
+        with self._cond:
+            job.state = state
+            self._cond.notify_all()
+        self._changed(job)
+        self._start_jobs()
+
+    def _acquire(self, job):
+        with self._cond:
+            ticket = (next(self._sequence), job)
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    if job.cancelled:
+                        return False
+                    if self._active_transfers < self.max_transfers and self._is_next(ticket):
+                        self._active_transfers += 1
+                        return True
+                    self._cond.wait()
+            finally:
+                self._waiting.remove(ticket)
+
+    def _is_next(self, ticket):
+        """True if ticket belongs to the highest priority, longest waiting runnable job"""
+        runnable = [waiting for waiting in self._waiting if not waiting[1].paused or waiting[1].cancelled]
+        if not runnable:
+            return False
+        return min(runnable, key=lambda waiting: (-waiting[1].priority, waiting[0])) is ticket
+
+    def _release(self):
+        with self._cond:
+            self._active_transfers -= 1
+            self._cond.notify_all()
+
+    def _changed(self, job):
+        if self.on_change is not None:
+            self.on_change(job)
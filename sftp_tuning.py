@@ -0,0 +1,209 @@
+import json
+import os
+import threading
+import time
+
+import paramiko
+
+# Per-user settings of the browser live in this directory
+APP_DIR = os.path.join(os.path.expanduser("~"), ".sftp_browser")
+TUNING_FILE = os.path.join(APP_DIR, "transport_tuning.json")
+
+# Auto-tune reads this much of a sample file for every combination it tries
+TUNE_SAMPLE_SIZE = 16 * 1024 * 1024
+TUNE_MIN_SAMPLE_SIZE = 1024 * 1024
+TUNE_BLOCK_SIZE = 32 * 1024
+
+# Ciphers and channel window sizes auto-tune tries, fastest candidates first
+TUNE_CIPHERS = ("aes128-gcm@openssh.com", "aes128-ctr", "aes256-gcm@openssh.com", "aes256-ctr")
+TUNE_WINDOW_SIZES = (2 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+
+AUTO_PROFILE = "auto"
+
+
+class TransportProfile:
+    """Cipher preference, channel window and packet size applied to a new Transport
+
+    None leaves paramiko's default in place.
+    """
+
+    def __init__(self, name, ciphers=None, window_size=None, max_packet_size=None, compress=False):
+        self.name = name
+        self.ciphers = tuple(ciphers) if ciphers else None
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.compress = compress
+
+    def create_transport(self, hostname, port, strict=False):
+        """Create an unconnected Transport with this profile applied
+
+        With strict set, only the profile's ciphers are offered, so the
+        handshake fails rather than falling back to another cipher.
+        """
+        kwargs = {}
+        if self.window_size:
+            kwargs['default_window_size'] = self.window_size
+        if self.max_packet_size:
+            kwargs['default_max_packet_size'] = self.max_packet_size
+        transport = paramiko.Transport((hostname, port), **kwargs)
+        if self.ciphers:
+            options = transport.get_security_options()
+            # Keep only ciphers this paramiko build knows, in our order of preference
+            supported = [cipher for cipher in self.ciphers if cipher in options.ciphers]
+            if strict:
+                if not supported:
+                    raise ValueError(f"paramiko does not support {', '.join(self.ciphers)}")
+                options.ciphers = tuple(supported)
+            elif supported:
+                options.ciphers = supported + [cipher for cipher in options.ciphers if cipher not in supported]
+        if self.compress:
+            transport.use_compression(True)
+        return transport
+
+    def to_dict(self):
+        return {
+            'ciphers': list(self.ciphers) if self.ciphers else None,
+            'window_size': self.window_size,
+            'max_packet_size': self.max_packet_size,
+            'compress': self.compress
+        }
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(name, data.get('ciphers'), data.get('window_size'),
+                   data.get('max_packet_size'), data.get('compress', False))
+
+    def describe(self):
+        parts = [self.ciphers[0] if self.ciphers else "default cipher"]
+        if self.window_size:
+            parts.append(f"{self.window_size // (1024 * 1024)} MB window")
+        if self.compress:
+            parts.append("compressed")
+        return ", ".join(parts)
+
+
+PROFILES = {
+    "default": TransportProfile("default"),
+    # Fast local networks: cheap AEAD ciphers, a large window and large packets
+    "lan": TransportProfile("lan", ("aes128-gcm@openssh.com", "aes128-ctr"),
+                            window_size=32 * 1024 * 1024, max_packet_size=256 * 1024),
+    # Long fat pipes: an even larger window to cover the bandwidth-delay product
+    "wan": TransportProfile("wan", ("aes128-gcm@openssh.com", "aes128-ctr"),
+                            window_size=128 * 1024 * 1024),
+    # Slow links: compression pays off for text-heavy trees
+    "slow-link": TransportProfile("slow-link", compress=True),
+}
+
+
+class TuningStore:
+    """Fastest profile found by auto-tune for each "user@host:port", kept on disk"""
+
+    def __init__(self, path=TUNING_FILE):
+        self.path = path
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self._profiles = {key: value for key, value in data.items() if isinstance(value, dict)}
+
+    def get(self, key):
+        """The tuned profile for key, or None if the host was never tuned"""
+        with self._lock:
+            data = self._profiles.get(key)
+        return TransportProfile.from_dict(AUTO_PROFILE, data) if data else None
+
+    def put(self, key, profile, rate):
+        with self._lock:
+            data = profile.to_dict()
+            data['rate'] = rate
+            data['tuned'] = time.time()
+            self._profiles[key] = data
+            snapshot = dict(self._profiles)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def resolve_profile(name, store=None, key=None):
+    """Profile for a setting: a named profile, or the tuned one for key when name is "auto" """
+    if name == AUTO_PROFILE:
+        tuned = store.get(key) if store is not None and key else None
+        return tuned or PROFILES["default"]
+    return PROFILES.get(name, PROFILES["default"])
+
+
+def measure_profile(profile, hostname, port, username, password, sample_path, sample_size):
+    """Connect with profile and return the read throughput of sample_path in bytes per second
+
+    Raises an exception if the server refuses the profile's cipher, so that
+    no rate is recorded for a cipher that was never used.
+    """
+    transport = profile.create_transport(hostname, port, strict=True)
+    try:
+        transport.connect(username=username, password=password)
+        if profile.ciphers and transport.local_cipher not in profile.ciphers:
+            raise Exception(f"server negotiated {transport.local_cipher} instead of {profile.ciphers[0]}")
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        with sftp.open(sample_path, "rb") as remote_file:
+            remote_file.prefetch(sample_size)
+            start = time.monotonic()
+            received = 0
+            while received < sample_size:
+                data = remote_file.read(min(TUNE_BLOCK_SIZE, sample_size - received))
+                if not data:
+                    break
+                received += len(data)
+            elapsed = time.monotonic() - start
+        sftp.close()
+    finally:
+        transport.close()
+    return received / elapsed if elapsed > 0 else 0.0
+
+
+def autotune(hostname, port, username, password, sample_path, sample_size,
+             ciphers=TUNE_CIPHERS, window_sizes=TUNE_WINDOW_SIZES, on_result=None, is_cancelled=None):
+    """Benchmark cipher and window combinations and return (fastest profile, its rate)
+
+    Ciphers are compared at the largest window first, then the window sizes
+    with the winning cipher. Ciphers the server refuses are skipped.
+    on_result(profile, rate) is called after every measurement, with a rate
+    of None for combinations that failed.
+    """
+    sample_size = min(sample_size, TUNE_SAMPLE_SIZE)
+    results = []
+
+    def measure(profile):
+        if is_cancelled is not None and is_cancelled():
+            return
+        try:
+            rate = measure_profile(profile, hostname, port, username, password, sample_path, sample_size)
+        except paramiko.AuthenticationException:
+            raise
+        except Exception as e:
+            print(f"Auto-tune: {profile.describe()} failed: {e}")
+            rate = None
+        if on_result is not None:
+            on_result(profile, rate)
+        if rate:
+            results.append((rate, profile))
+
+    for cipher in ciphers:
+        measure(TransportProfile(AUTO_PROFILE, (cipher,), window_size=max(window_sizes)))
+    if not results:
+        raise Exception("None of the candidate ciphers worked with this server")
+
+    best_cipher = max(results, key=lambda result: result[0])[1].ciphers
+    for window_size in sorted(window_sizes)[:-1]:
+        measure(TransportProfile(AUTO_PROFILE, best_cipher, window_size=window_size))
+
+    rate, profile = max(results, key=lambda result: result[0])
+    return profile, rate
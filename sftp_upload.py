@@ -0,0 +1,259 @@
+import hashlib
+import os
+import posixpath
+import stat
+import threading
+
+from sftp_listing import join_remote
+from sftp_transfer import (META_SUFFIX, PART_SUFFIX, RESUME_MIN_SIZE, ParallelDownloader, PartialDownload,
+                           TransferCancelled, TransferPaused, TransferTask, read_at, split_ranges)
+from sftp_tuning import APP_DIR
+
+# Sidecars of interrupted uploads live here, since the source tree is not ours to write to
+UPLOAD_STATE_DIR = os.path.join(APP_DIR, "uploads")
+
+# Bytes sent per SFTP write request. OpenSSH accepts up to 255 KB; paramiko's
+# own default is 32 KB, which some other servers insist on
+UPLOAD_REQUEST_SIZE = 255 * 1024
+MIN_REQUEST_SIZE = 32 * 1024
+# Bytes read from the local file per write() on the pipelined remote file
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# A byte range closes its remote file, which collects every write reply, and
+# records its progress after this many bytes
+UPLOAD_CHECKPOINT = 32 * 1024 * 1024
+
+
+def replace_remote(sftp, source, target):
+    """Rename source over target, atomically where the server has posix-rename"""
+    try:
+        sftp.posix_rename(source, target)
+    except IOError:
+        # Plain SFTP rename refuses to overwrite
+        try:
+            sftp.remove(target)
+        except IOError:
+            pass
+        sftp.rename(source, target)
+
+
+class PartialUpload(PartialDownload):
+    """The remote .part file of a resumable upload, with its sidecar kept locally"""
+
+    def __init__(self, task, sftp, resume_key=""):
+        super().__init__(task)
+        self.sftp = sftp
+        self.part_path = task.remote_path + PART_SUFFIX
+        # One sidecar per server and remote path; resume_key tells servers apart
+        name = hashlib.sha1(f"{resume_key}\0{task.remote_path}".encode("utf-8")).hexdigest()
+        self.meta_path = os.path.join(UPLOAD_STATE_DIR, name + META_SUFFIX)
+
+    def open(self, segments):
+        """Pick up a matching partial upload or start a fresh one, returning the bytes already sent"""
+        meta = self._read_meta()
+        if meta is not None:
+            self.ranges = [list(r) for r in meta['ranges']]
+            return sum(done - start for start, done, end in self.ranges)
+
+        os.makedirs(UPLOAD_STATE_DIR, exist_ok=True)
+        self.sftp.open(self.part_path, "wb").close()
+        self.ranges = [[start, start, end] for start, end in split_ranges(self.task.size, segments)]
+        self.save()
+        return 0
+
+    def _part_matches(self, meta):
+        # Ranges written out of order leave the remote file as long as the furthest one
+        written = max((done for start, done, end in meta['ranges']), default=0)
+        return self.sftp.stat(self.part_path).st_size >= written
+
+    def finish(self):
+        replace_remote(self.sftp, self.part_path, self.task.remote_path)
+        try:
+            os.remove(self.meta_path)
+        except OSError:
+            pass
+
+
+class ParallelUploader(ParallelDownloader):
+    """Upload a batch of local files concurrently over several SFTP channels
+
+    Shares ParallelDownloader's workers, job slots, bandwidth limit and
+    stats, keys included, so progress shows up like any download. Writes
+    are pipelined in requests of request_size bytes into a remote
+    "<name>.part" that is renamed into place. Files of at least
+    RESUME_MIN_SIZE continue where an earlier attempt stopped, and those at
+    or above segment_threshold are written in byte ranges over several
+    channels. Remote directories are created as files need them.
+    """
+    ACTION = "uploading"
+
+    def __init__(self, open_channel, request_size=UPLOAD_REQUEST_SIZE, resume_key="", **kwargs):
+        super().__init__(open_channel, **kwargs)
+        self.request_size = max(MIN_REQUEST_SIZE, request_size)
+        # Identifies the server in the sidecars of resumable uploads, e.g. "user@host:port"
+        self.resume_key = resume_key
+        self._made_dirs = set()
+        self._dirs_lock = threading.Lock()
+
+    def ensure_remote_dir(self, sftp, path):
+        """Create path and its missing parents on the server, asking at most once per directory"""
+        if not path or path == "/":
+            return
+        with self._dirs_lock:
+            if path in self._made_dirs:
+                return
+        self.ensure_remote_dir(sftp, posixpath.dirname(path))
+        try:
+            sftp.mkdir(path)
+        except IOError:
+            # Usually already there, possibly made by another worker just now
+            if not stat.S_ISDIR(sftp.stat(path).st_mode):
+                raise IOError(f"{path} exists and is not a directory")
+        with self._dirs_lock:
+            self._made_dirs.add(path)
+
+    def make_directories(self, paths):
+        """Create directories no uploaded file needed, such as empty ones"""
+        paths = [path for path in paths if path not in self._made_dirs]
+        if not paths:
+            return
+        sftp = self.open_channel()
+        try:
+            for path in paths:
+                if self.cancelled:
+                    return
+                try:
+                    self.ensure_remote_dir(sftp, path)
+                except IOError as e:
+                    print(f"Error creating {path}: {e}")
+        finally:
+            sftp.close()
+
+    def _copy(self, sftp, task, progress_callback):
+        """Upload one file into place"""
+        self.ensure_remote_dir(sftp, posixpath.dirname(task.remote_path))
+        if task.size >= RESUME_MIN_SIZE:
+            partial = PartialUpload(task, sftp, self.resume_key)
+            segments = self.segments if task.size >= self.segment_threshold else 1
+            transferred = partial.open(segments)
+            self._copy_ranges(sftp, task, partial, segments, transferred, progress_callback, self._send_range)
+            partial.finish()
+        else:
+            # Small files are cheaper to send again than to resume
+            self._put_small(sftp, task, progress_callback)
+        if task.mtime is not None:
+            # Keep the local mtime so later syncs can recognise unchanged files
+            sftp.utime(task.remote_path, (task.mtime, task.mtime))
+
+    def _pipeline(self, remote):
+        """Stop waiting for the reply to every write, and send larger writes"""
+        remote.set_pipelined(True)
+        remote.MAX_REQUEST_SIZE = self.request_size
+
+    def _put_small(self, sftp, task, progress_callback):
+        part_path = task.remote_path + PART_SUFFIX
+        transferred = 0
+        with open(task.local_path, "rb") as local:
+            with sftp.open(part_path, "wb") as remote:
+                self._pipeline(remote)
+                while True:
+                    data = local.read(UPLOAD_CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.consume_bandwidth(len(data))
+                    remote.write(data)
+                    transferred += len(data)
+                    progress_callback(transferred, task.size)
+        if transferred != task.size:
+            raise IOError(f"{task.local_path} changed size while it was uploaded")
+        replace_remote(sftp, part_path, task.remote_path)
+
+    def _send_range(self, sftp, task, partial, index, report, abort):
+        """Copy the unsent part of one byte range of the local file into the remote .part file"""
+        start, offset, end = partial.ranges[index]
+        fd = os.open(task.local_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            while offset < end and not abort.is_set():
+                checkpoint = min(offset + UPLOAD_CHECKPOINT, end)
+                stopped = None
+                with sftp.open(partial.part_path, "r+b") as remote:
+                    self._pipeline(remote)
+                    remote.seek(offset)
+                    while offset < checkpoint and not abort.is_set():
+                        length = min(UPLOAD_CHUNK_SIZE, checkpoint - offset)
+                        data = read_at(fd, length, offset)
+                        if len(data) != length:
+                            raise IOError(f"{task.local_path} shrank while it was uploaded")
+                        self.consume_bandwidth(length)
+                        remote.write(data)
+                        offset += length
+                        try:
+                            report(length)
+                        except (TransferCancelled, TransferPaused) as e:
+                            stopped = e
+                            break
+                # Closing waited for the reply to every write, so the range is stored up to here
+                partial.mark(index, offset)
+                if stopped is not None:
+                    raise stopped
+        finally:
+            os.close(fd)
+
+
+def scan_remote_state(scanner, remote_root):
+    """{remote path: (size, mtime)} of every file below remote_root, empty if it does not exist yet"""
+    state = {}
+
+    def on_directory(path, entries):
+        for entry in entries:
+            if not entry.is_dir:
+                state[join_remote(path, entry.filename)] = (entry.st_size, entry.st_mtime)
+
+    scanner.scan(remote_root, on_directory, keep_entries=False)
+    return state
+
+
+def feed_local_tree(uploader, local_root, remote_root, remote_state=None):
+    """Walk local_root and queue its files for upload below remote_root, directory by directory
+
+    With remote_state from scan_remote_state (sync mode), files whose remote
+    copy has the same size and modification time are skipped. Returns
+    (tasks queued, tasks skipped, remote directories of the tree).
+    """
+    tasks = []
+    skipped = []
+    directories = []
+    pending = [(local_root, remote_root)]
+    while pending and not uploader.cancelled:
+        local_dir, remote_dir = pending.pop()
+        directories.append(remote_dir)
+        try:
+            with os.scandir(local_dir) as entries:
+                entries = list(entries)
+        except OSError as e:
+            print(f"Error reading {local_dir}: {e}")
+            continue
+
+        batch = []
+        for entry in entries:
+            remote_path = join_remote(remote_dir, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append((entry.path, remote_path))
+                    continue
+                if not entry.is_file():
+                    continue
+                attrs = entry.stat()
+            except OSError as e:
+                print(f"Error reading {entry.path}: {e}")
+                continue
+            task = TransferTask(remote_path, entry.path, attrs.st_size, attrs.st_mtime)
+            remote = remote_state.get(remote_path) if remote_state else None
+            if remote is not None and remote[0] == task.size and remote[1] is not None \
+                    and int(remote[1]) == int(task.mtime):
+                skipped.append(task)
+            else:
+                batch.append(task)
+        if batch:
+            uploader.add(batch)
+            tasks.extend(batch)
+    return tasks, skipped, directories
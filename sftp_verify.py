@@ -0,0 +1,310 @@
+import concurrent.futures
+import hashlib
+import os
+import queue
+import re
+import shlex
+import threading
+
+from sftp_metrics import METRICS
+
+# Digest compared on both ends; the remote side needs check-file support for
+# it or a "<algorithm>sum" command
+VERIFY_ALGORITHM = "sha256"
+# Bytes read per update while hashing a local file
+HASH_CHUNK_SIZE = 1024 * 1024
+# Remote files hashed per exec'd command
+REMOTE_HASH_BATCH = 64
+# check-file is given up on after failing for this many files without ever working
+CHECK_FILE_PROBES = 8
+# Servers refuse check-file below their minimum block size, so smaller files
+# are hashed with the command and never count as failed probes
+CHECK_FILE_MIN_SIZE = 256
+# Extra downloads of a file whose digests keep disagreeing
+VERIFY_RETRIES = 2
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def hash_file(path, algorithm=VERIFY_ALGORITHM):
+    """Hex digest of a local file; runs in the hashing threads"""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_pool():
+    """Thread pool shared by all verifiers, one thread per core, started on first use
+
+    hashlib releases the GIL while it hashes, so the threads use every core.
+    Processes would be forked from a process full of threads holding locks.
+    """
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                               thread_name_prefix="hash")
+        return _hash_pool
+
+
+def shutdown_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        pool, _hash_pool = _hash_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_sum_output(output):
+    """Map file names to digests from the output of sha256sum and friends
+
+    Names containing a backslash or newline are escaped by coreutils, which
+    marks such lines with a leading backslash.
+    """
+    digests = {}
+    for line in output.splitlines():
+        escaped = line.startswith("\\")
+        if escaped:
+            line = line[1:]
+        digest, _, name = line.partition(" ")
+        if not name:
+            continue
+        # " name" in text mode, "*name" in binary mode
+        name = name[1:]
+        if escaped:
+            name = re.sub(r"\\(.)", lambda m: {"n": "\n", "r": "\r"}.get(m.group(1), m.group(1)), name)
+        digests[name] = digest.lower()
+    return digests
+
+
+class RemoteHasher:
+    """Digests of remote files computed by the server itself
+
+    Uses the SFTP check-file extension where the server has it, and
+    otherwise runs "<algorithm>sum" over an exec channel, many files per
+    command. Files check-file cannot hash are tried with the command. A
+    method is given up on once it keeps failing without ever working.
+    """
+
+    def __init__(self, transport, open_channel, algorithm=VERIFY_ALGORITHM):
+        self.transport = transport
+        self.open_channel = open_channel
+        self.algorithm = algorithm
+        # True once a method worked, False once given up on, None until tried
+        self.check_file = None
+        self.exec_sum = None
+        self._sftp = None
+        self._check_file_failures = 0
+
+    @property
+    def available(self):
+        return self.check_file is not False or self.exec_sum is not False
+
+    def digests(self, paths, sizes=None):
+        """Return {path: hex digest or None} for remote paths
+
+        sizes, {path: size} where known, keeps files too small for check-file away from it.
+        """
+        result = dict.fromkeys(paths)
+        was_available = self.available
+        if self.check_file is not False:
+            sizes = sizes or {}
+            self._check_file(result, [path for path in result
+                                      if sizes.get(path, CHECK_FILE_MIN_SIZE) >= CHECK_FILE_MIN_SIZE])
+        missing = [path for path, digest in result.items() if digest is None]
+        for start in range(0, len(missing), REMOTE_HASH_BATCH):
+            if self.exec_sum is False:
+                break
+            self._exec_sum(missing[start:start + REMOTE_HASH_BATCH], result)
+        if was_available and not self.available:
+            print(f"Server cannot compute {self.algorithm} digests; downloads are not verified")
+        return result
+
+    def close(self):
+        if self._sftp is not None:
+            try:
+                self._sftp.close()
+            except Exception:
+                pass
+            self._sftp = None
+
+    def _check_file(self, result, paths):
+        for path in paths:
+            try:
+                if self._sftp is None:
+                    self._sftp = self.open_channel()
+                with METRICS.timer("verify.check_file"):
+                    with self._sftp.open(path, "rb") as remote:
+                        result[path] = remote.check(self.algorithm, block_size=0).hex()
+                self.check_file = True
+            except IOError as e:
+                if self.check_file:
+                    print(f"Error getting the {self.algorithm} digest of {path}: {e}")
+                    continue
+                self._check_file_failures += 1
+                if self._check_file_failures >= CHECK_FILE_PROBES:
+                    self.check_file = False
+                    return
+
+    def _exec_sum(self, paths, result):
+        command = f"{self.algorithm}sum -- " + " ".join(shlex.quote(path) for path in paths)
+        try:
+            channel = self.transport.open_session()
+            channel.exec_command(command)
+        except Exception as e:
+            if self.exec_sum:
+                print(f"Error running {self.algorithm}sum: {e}")
+            else:
+                self.exec_sum = False
+            return
+        try:
+            with METRICS.timer("verify.exec_sum"):
+                output = channel.makefile("rb").read().decode("utf-8", "replace")
+                errors = channel.makefile_stderr("rb").read().decode("utf-8", "replace")
+                status = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+        found = parse_sum_output(output)
+        if not found and status != 0 and not self.exec_sum:
+            # Not installed (127) or not working: no point in asking again
+            self.exec_sum = False
+            return
+        self.exec_sum = True
+        for line in errors.splitlines():
+            print(f"Remote {self.algorithm}sum: {line}")
+        for path in paths:
+            if path in found:
+                result[path] = found[path]
+
+
+class IntegrityVerifier:
+    """Check downloaded files against digests computed on the server
+
+    submit() is called as each file lands. Its local digest is computed in
+    the thread pool while a background thread asks the server for the
+    remote one, so verification overlaps with the files still downloading.
+    finish() waits for the outstanding checks and returns the files whose
+    digests disagreed.
+    """
+
+    def __init__(self, transport, open_channel, algorithm=VERIFY_ALGORITHM):
+        self.algorithm = algorithm
+        self.remote = RemoteHasher(transport, open_channel, algorithm)
+        self.stats = {'verified': 0, 'mismatched': 0, 'unverified': 0}
+        self._mismatched = []
+        self._pending = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, task):
+        """Queue a downloaded file for verification; called from the download workers"""
+        if not self.remote.available:
+            with self._lock:
+                self.stats['unverified'] += 1
+            return
+        try:
+            future = hash_pool().submit(hash_file, task.local_path, self.algorithm)
+        except Exception as e:
+            print(f"Error hashing {task.local_path}: {e}")
+            with self._lock:
+                self.stats['unverified'] += 1
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._pending.put((task, future))
+
+    def finish(self):
+        """Wait for every submitted file to be checked and return the mismatched ones
+
+        The verifier can be used again afterwards, e.g. for the files downloaded again.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._pending.put(None)
+        if thread is not None:
+            thread.join()
+        with self._lock:
+            mismatched, self._mismatched = self._mismatched, []
+        return mismatched
+
+    def retry(self, tasks):
+        """Take back the mismatches of tasks about to be downloaded and checked again"""
+        with self._lock:
+            self.stats['mismatched'] -= len(tasks)
+
+    def close(self):
+        self.remote.close()
+
+    def _run(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            batch = [item]
+            # Hash whatever else has landed in the meantime with the same request
+            while len(batch) < REMOTE_HASH_BATCH:
+                try:
+                    item = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._pending.put(None)
+                    break
+                batch.append(item)
+            try:
+                remote = self.remote.digests([task.remote_path for task, _ in batch],
+                                             {task.remote_path: task.size for task, _ in batch})
+            except Exception as e:
+                print(f"Error getting remote digests: {e}")
+                remote = {}
+            for task, future in batch:
+                self._compare(task, future, remote.get(task.remote_path))
+
+    def _compare(self, task, future, remote_digest):
+        try:
+            local_digest = future.result()
+        except Exception as e:
+            print(f"Error hashing {task.local_path}: {e}")
+            local_digest = None
+
+        with self._lock:
+            if local_digest is None or remote_digest is None:
+                self.stats['unverified'] += 1
+            elif local_digest == remote_digest:
+                self.stats['verified'] += 1
+            else:
+                print(f"Checksum mismatch for {task.remote_path}")
+                task.error = f"{self.algorithm} mismatch"
+                self.stats['mismatched'] += 1
+                self._mismatched.append(task)
+
+
+def verify_downloads(downloader, verifier, retries=VERIFY_RETRIES):
+    """Download files whose digests disagreed again until they match or retries run out
+
+    Call once the downloader has finished. Files still mismatched at the end
+    are moved from the downloaded to the failed files and returned.
+    """
+    mismatched = verifier.finish()
+    for _ in range(retries):
+        if not mismatched or downloader.cancelled:
+            break
+        print(f"Downloading {len(mismatched)} files again after a checksum mismatch")
+        verifier.retry(mismatched)
+        downloader.redownload(mismatched)
+        mismatched = verifier.finish()
+    if mismatched:
+        downloader.account(downloaded_files=-len(mismatched),
+                           downloaded_size=-sum(task.size for task in mismatched), failed=mismatched)
+    verifier.close()
+    return mismatched